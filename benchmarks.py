@@ -0,0 +1,426 @@
+import os
+import sys
+import io
+import json
+import time
+import uuid
+import platform
+import argparse
+import tempfile
+import subprocess
+import statistics
+
+import cv2
+import numpy as np
+
+from facade_analysis import (PALETTE_BGR, SKY, WINDOW, DOOR, WALL, decode_mask, retrieve_window_bounds,
+    retrieve_max_building_height, find_window_clusters, get_cluster_info, run_batch)
+
+
+# benchmark locations and cases
+
+BENCHMARK_RESULTS_PATH = './data/benchmarks/results.jsonl'
+OLD_NOTEBOOKS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'old_notebooks')
+
+# facade masks of the size of the dataset (portrait, 900 pixels high and mostly 110 to 450 wide), from a narrow house to a wide apartment block with noisy labels
+MASK_CASES = [
+    {"width": 150, "height": 900, "floors": 3, "windows_per_floor": 2, "noise_fragments": 0},
+    {"width": 300, "height": 900, "floors": 5, "windows_per_floor": 4, "noise_fragments": 50},
+    {"width": 450, "height": 900, "floors": 8, "windows_per_floor": 6, "noise_fragments": 200},
+]
+# number of extruded buildings in the generated context meshes
+MESH_CASES = [
+    {"files": 10, "buildings_per_file": 50},
+    {"files": 40, "buildings_per_file": 100},
+]
+
+# a stage is a regression when its median time grows by more than this fraction
+REGRESSION_TOLERANCE = 0.1
+
+
+# synthetic facade masks
+
+def synthetic_mask(width=300, height=900, floors=4, windows_per_floor=6, noise_fragments=0, seed=0):
+    """draw a facade mask in the palette of the dataset: sky above the building, a wall with rows of windows and a door on the ground floor
+
+    The windows of a floor are placed at regular intervals with a small random offset, so they still overlap vertically like real windows do. Noise fragments are small blobs of window, door and sky pixels scattered over the wall, like the stray labels of a segmentation model.
+
+    Args:
+    width (int): width of the mask in pixels
+    height (int): height of the mask in pixels
+    floors (int): number of floors
+    windows_per_floor (int): number of windows on every floor, the ground floor has a door in place of one window
+    noise_fragments (int): number of stray blobs
+    seed (int): seed of the random offsets and fragments
+
+    Returns:
+    img (array): the mask in BGR, as read by cv2.imread
+    """
+    rng = np.random.default_rng(seed)
+    img = np.empty((height, width, 3), dtype=np.uint8)
+    img[:] = PALETTE_BGR[WALL]
+
+    # the building fills the image below a roof line at 10 to 20 percent of the height
+    roof = int(height * rng.uniform(0.1, 0.2))
+    img[:roof] = PALETTE_BGR[SKY]
+
+    floor_height = (height - roof) / max(floors, 1)
+    bay_width = width / max(windows_per_floor, 1)
+    window_height = floor_height * 0.5
+    window_width = bay_width * 0.5
+    jitter = max(1, int(floor_height * 0.05))
+    for floor in range(floors):
+        # floors are counted from the ground floor up
+        floor_top = height - (floor + 1) * floor_height
+        for bay in range(windows_per_floor):
+            x = int(bay * bay_width + (bay_width - window_width) / 2) + int(rng.integers(-jitter, jitter + 1))
+            if floor == 0 and bay == windows_per_floor // 2:
+                # the door runs from the ground up to the top of the windows
+                y = int(floor_top + floor_height * 0.25)
+                cv2.rectangle(img, (x, y), (x + int(window_width) - 1, height - 1), PALETTE_BGR[DOOR], -1)
+                continue
+            y = int(floor_top + floor_height * 0.25) + int(rng.integers(-jitter, jitter + 1))
+            cv2.rectangle(img, (x, y), (x + int(window_width) - 1, y + int(window_height) - 1), PALETTE_BGR[WINDOW], -1)
+
+    fragment_classes = [WINDOW, DOOR, SKY]
+    centers = np.column_stack([rng.integers(0, width, noise_fragments), rng.integers(roof, height, noise_fragments)])
+    radii = rng.integers(1, 6, noise_fragments)
+    for (x, y), radius, class_id in zip(centers.tolist(), radii.tolist(), rng.choice(fragment_classes, noise_fragments).tolist()):
+        cv2.circle(img, (x, y), radius, PALETTE_BGR[class_id], -1)
+    return img
+
+def write_synthetic_masks(mask_dir, count, seed=0, **mask_kwargs):
+    """write synthetic facade masks with file names like those of the dataset, for the batch benchmark
+
+    Args:
+    mask_dir (string): folder for the masks
+    count (int): number of masks
+    seed (int): seed of the first mask, the next masks get the following seeds
+    **mask_kwargs: size, floors, windows_per_floor and noise_fragments of the masks, see synthetic_mask
+
+    Returns:
+    mask_paths (list): locations of the masks
+    """
+    os.makedirs(mask_dir, exist_ok=True)
+    mask_paths = []
+    for i in range(count):
+        mask_path = os.path.join(mask_dir, f"{i:016d}_{10 + i % 10:.6f}.png")
+        cv2.imwrite(mask_path, synthetic_mask(seed=seed + i, **mask_kwargs))
+        mask_paths.append(mask_path)
+    return mask_paths
+
+
+# synthetic context meshes
+
+def _digital_twinning():
+    # the mesh functions live next to the notebooks, and need their dependencies (trimesh, shapely, pyvista)
+    if OLD_NOTEBOOKS_DIR not in sys.path:
+        sys.path.append(OLD_NOTEBOOKS_DIR)
+    import digital_twinning
+    return digital_twinning
+
+def synthetic_footprints(count, seed=0, block_size=20.0):
+    """generate rectangular building footprints on a grid of blocks, with random sizes and heights
+
+    Args:
+    count (int): number of footprints
+    seed (int): seed of the sizes and heights
+    block_size (float): size of the grid cell of every building, in meters
+
+    Returns:
+    footprints (list): 2D coordinates of every footprint, counter-clockwise
+    heights (array): height of every building
+    """
+    rng = np.random.default_rng(seed)
+    columns = int(np.ceil(np.sqrt(count)))
+    footprints = []
+    for i in range(count):
+        x0 = (i % columns) * block_size
+        y0 = (i // columns) * block_size
+        width, depth = rng.uniform(0.4, 0.9, 2) * block_size
+        footprints.append([(x0, y0), (x0 + width, y0), (x0 + width, y0 + depth), (x0, y0 + depth)])
+    return footprints, rng.uniform(6.0, 40.0, count)
+
+def write_extrusions(obj_dir, files, buildings_per_file, seed=0):
+    """write OBJ files of extruded footprints, standing in for the 3D BAG tiles in the mesh benchmarks
+
+    Args:
+    obj_dir (string): folder for the OBJ files
+    files (int): number of OBJ files
+    buildings_per_file (int): number of buildings in every file
+    seed (int): seed of the footprints
+
+    Returns:
+    footprints (list): 2D coordinates of all footprints
+    heights (array): height of every building
+    """
+    dt = _digital_twinning()
+    os.makedirs(obj_dir, exist_ok=True)
+    footprints, heights = synthetic_footprints(files * buildings_per_file, seed)
+    for i in range(files):
+        selection = slice(i * buildings_per_file, (i + 1) * buildings_per_file)
+        with open(os.path.join(obj_dir, f"tile_{i:04d}.obj"), "w") as obj_file:
+            dt.extrude_to_obj(footprints[selection], heights[selection], obj_file)
+    return footprints, heights
+
+
+# timing
+
+def time_call(func, *args, repeat=5, **kwargs):
+    """call a function a number of times and measure the wall-clock time of every call
+
+    Args:
+    func (callable): the function to time
+    *args: arguments of the function
+    repeat (int): number of calls
+    **kwargs: keyword arguments of the function
+
+    Returns:
+    timing (dict): "min", "median" and "mean" time in seconds and the number of calls ("repeat")
+    result: the return value of the last call, so the next stage can use it
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        times.append(time.perf_counter() - start)
+    timing = {"min": min(times), "median": statistics.median(times), "mean": statistics.fmean(times), "repeat": repeat}
+    return timing, result
+
+def case_name(params):
+    """describe the parameters of a benchmark case in a short, stable name, used to match the cases of different runs"""
+    return "_".join(f"{key}={value}" for key, value in sorted(params.items()))
+
+def bench_mask_stages(params, repeat=5):
+    """time every stage of the window and floor extraction separately on one synthetic mask
+
+    Args:
+    params (dict): arguments of synthetic_mask
+    repeat (int): number of calls of every stage
+
+    Returns:
+    results (list): one dict per stage with the case, stage, number of items and the timing
+    """
+    img = synthetic_mask(**params)
+    case = case_name(params)
+    results = []
+
+    def record(stage, timing, items):
+        results.append({"group": "mask", "case": case, "params": params, "stage": stage, "items": items, **timing})
+
+    timing, class_ids = time_call(decode_mask, img, repeat=repeat)
+    record("decode_mask", timing, img.shape[0] * img.shape[1])
+    timing, (bound_rects, img_shape) = time_call(retrieve_window_bounds, class_ids, display=False, repeat=repeat)
+    record("retrieve_window_bounds", timing, len(bound_rects))
+    timing, max_building_height = time_call(retrieve_max_building_height, class_ids, repeat=repeat)
+    record("retrieve_max_building_height", timing, img.shape[0] * img.shape[1])
+    timing, (window_clusters, duplicate_indices) = time_call(find_window_clusters, bound_rects, repeat=repeat)
+    record("find_window_clusters", timing, len(bound_rects))
+    timing, cluster_info = time_call(get_cluster_info, bound_rects, window_clusters, duplicate_indices, img_shape,
+        max_building_height, repeat=repeat)
+    record("get_cluster_info", timing, len(cluster_info))
+    return results
+
+def bench_batch(params, count=64, workers=None, repeat=3, engine="contours"):
+    """time run_batch over a folder of synthetic masks, including reading the masks and writing the results
+
+    Args:
+    params (dict): arguments of synthetic_mask, every mask gets its own seed
+    count (int): number of masks
+    workers (int): number of worker processes, defaults to the number of cores
+    repeat (int): number of runs
+    engine (string): floor detection engine, see facade_analysis.ENGINES
+
+    Returns:
+    results (list): one dict with the timing of the batch run
+    """
+    with tempfile.TemporaryDirectory() as work_dir:
+        mask_dir = os.path.join(work_dir, "masks")
+        write_synthetic_masks(mask_dir, count, **params)
+        timing, (processed, failed) = time_call(run_batch, mask_dirs=[mask_dir], output_path=os.path.join(work_dir, "results.jsonl"),
+            workers=workers, engine=engine, repeat=repeat)
+    if failed:
+        raise RuntimeError(f"{failed} of {count} synthetic masks could not be processed")
+    batch_params = {**params, "count": count, "workers": workers or os.cpu_count(), "engine": engine}
+    return [{"group": "batch", "case": case_name(batch_params), "params": batch_params, "stage": "run_batch", "items": processed, **timing}]
+
+def bench_mesh(files, buildings_per_file, repeat=3, seed=0):
+    """time joining generated extrusions into a context mesh and clipping it to a site
+
+    The site is a prism over the middle of the generated blocks; vertex_intersection is timed both with the general bound mesh and with the prism fast path.
+
+    Args:
+    files (int): number of OBJ files
+    buildings_per_file (int): number of extruded buildings in every file
+    repeat (int): number of calls of every stage
+    seed (int): seed of the footprints
+
+    Returns:
+    results (list): one dict per stage with the case, stage, number of items and the timing
+    """
+    import trimesh as tm
+
+    dt = _digital_twinning()
+
+    params = {"files": files, "buildings_per_file": buildings_per_file}
+    case = case_name(params)
+    results = []
+
+    def record(stage, timing, items):
+        results.append({"group": "mesh", "case": case, "params": params, "stage": stage, "items": items, **timing})
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        obj_dir = os.path.join(work_dir, "objs")
+        footprints, _ = write_extrusions(obj_dir, files, buildings_per_file, seed)
+        buildings = len(footprints)
+
+        timing, context_obj = time_call(dt.join_objs, obj_dir, repeat=repeat)
+        record("join_objs_obj", timing, buildings)
+        npy_path = os.path.join(work_dir, "context.npy")
+        timing, _ = time_call(dt.join_objs, obj_dir, npy_path, "npy", repeat=repeat)
+        record("join_objs_npy", timing, buildings)
+
+        content_mesh = tm.load(io.StringIO(context_obj), file_type="obj", force="mesh")
+        # the site covers the middle half of the blocks, up to above the highest building
+        x_min, y_min, _ = content_mesh.bounds[0]
+        x_max, y_max, _ = content_mesh.bounds[1]
+        x0, x1 = x_min + (x_max - x_min) / 4, x_max - (x_max - x_min) / 4
+        y0, y1 = y_min + (y_max - y_min) / 4, y_max - (y_max - y_min) / 4
+        site = [(x0, y0), (x1, y0), (x1, y1), (x0, y1)]
+        site_height = 50.0
+        bound_mesh = tm.Trimesh(*dt.extrusion_arrays([site], site_height))
+
+        timing, _ = time_call(dt.vertex_intersection, bound_mesh, content_mesh, repeat=repeat)
+        record("vertex_intersection", timing, len(content_mesh.vertices))
+        timing, _ = time_call(dt.vertex_intersection, bound_mesh, content_mesh, prism=(site, site_height), repeat=repeat)
+        record("vertex_intersection_prism", timing, len(content_mesh.vertices))
+    return results
+
+
+# storing and comparing runs
+
+def environment_info():
+    """describe the machine and library versions of a run, so runs on different machines are not compared by accident"""
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "git_commit": commit,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "opencv": cv2.__version__,
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "cpu_count": os.cpu_count(),
+    }
+
+def run_benchmarks(output_path=BENCHMARK_RESULTS_PATH, label=None, mask_cases=MASK_CASES, mesh_cases=MESH_CASES,
+        repeat=5, batch_count=64, workers=None, mesh=True):
+    """run all benchmarks and append the run as one line to a JSON lines file
+
+    Args:
+    output_path (string): location of the JSON lines file, None only returns the run
+    label (string): name of the run, e.g. the branch or change that is measured
+    mask_cases (list): arguments of synthetic_mask for the stage and batch benchmarks
+    mesh_cases (list): files and buildings_per_file of the mesh benchmarks
+    repeat (int): number of calls of every stage; the batch and mesh benchmarks use at most 3
+    batch_count (int): number of masks in the batch benchmark, 0 skips it
+    workers (int): number of worker processes of the batch benchmark
+    mesh (bool): run the mesh benchmarks, which need the dependencies of old_notebooks/digital_twinning.py
+
+    Returns:
+    run (dict): "run_id", "label", "timestamp", "environment" and "results", one dict per case and stage
+    """
+    results = []
+    for params in mask_cases:
+        results.extend(bench_mask_stages(params, repeat))
+        if batch_count:
+            results.extend(bench_batch(params, batch_count, workers, min(repeat, 3)))
+    if mesh:
+        for params in mesh_cases:
+            results.extend(bench_mesh(repeat=min(repeat, 3), **params))
+
+    run = {
+        "run_id": uuid.uuid4().hex,
+        "label": label,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "environment": environment_info(),
+        "results": results,
+    }
+    if output_path is not None:
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        with open(output_path, "a") as output:
+            output.write(json.dumps(run) + "\n")
+    return run
+
+def load_runs(results_path=BENCHMARK_RESULTS_PATH):
+    """read all benchmark runs from a JSON lines file, in the order they were run"""
+    with open(results_path) as results_file:
+        return [json.loads(line) for line in results_file if line.strip()]
+
+def find_run(runs, key):
+    """select a run by its label or (a prefix of) its run_id; the latest run wins if several match"""
+    for run in reversed(runs):
+        if run["label"] == key or run["run_id"].startswith(key):
+            return run
+    raise KeyError(f"no benchmark run with label or id {key!r}")
+
+def compare_runs(baseline, current, tolerance=REGRESSION_TOLERANCE):
+    """compare the median times of the stages that two runs have in common
+
+    Args:
+    baseline (dict): the reference run, as returned by run_benchmarks or load_runs
+    current (dict): the run to check
+    tolerance (float): fraction by which a stage may become slower before it counts as a regression
+
+    Returns:
+    comparison (list): per shared case and stage, the baseline and current median, their ratio and whether it is a regression
+    """
+    baseline_results = {(result["case"], result["stage"]): result for result in baseline["results"]}
+    comparison = []
+    for result in current["results"]:
+        reference = baseline_results.get((result["case"], result["stage"]))
+        if reference is None:
+            continue
+        ratio = result["median"] / reference["median"] if reference["median"] > 0 else float("inf")
+        comparison.append({
+            "group": result["group"],
+            "case": result["case"],
+            "stage": result["stage"],
+            "baseline": reference["median"],
+            "current": result["median"],
+            "ratio": ratio,
+            "regression": ratio > 1 + tolerance,
+        })
+    return comparison
+
+def print_comparison(comparison):
+    for row in comparison:
+        flag = "REGRESSION" if row["regression"] else ""
+        print(f"{row['group']:<6} {row['stage']:<28} {row['baseline'] * 1000:>10.3f} ms {row['current'] * 1000:>10.3f} ms "
+            f"{row['ratio']:>6.2f}x {flag}  {row['case']}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="time the facade and mesh pipeline on synthetic data")
+    parser.add_argument("--output", default=BENCHMARK_RESULTS_PATH, help="JSON lines file the run is appended to")
+    parser.add_argument("--label", help="name of the run")
+    parser.add_argument("--repeat", type=int, default=5, help="number of calls of every stage")
+    parser.add_argument("--batch-count", type=int, default=64, help="number of masks in the batch benchmark, 0 skips it")
+    parser.add_argument("--workers", type=int, help="number of worker processes of the batch benchmark")
+    parser.add_argument("--no-mesh", action="store_true", help="skip the mesh benchmarks")
+    parser.add_argument("--compare", help="label or run_id of the baseline run; exits with status 1 on a regression")
+    parser.add_argument("--tolerance", type=float, default=REGRESSION_TOLERANCE, help="allowed slowdown before a stage is a regression")
+    args = parser.parse_args()
+
+    baseline = find_run(load_runs(args.output), args.compare) if args.compare else None
+    run = run_benchmarks(args.output, args.label, repeat=args.repeat, batch_count=args.batch_count, workers=args.workers,
+        mesh=not args.no_mesh)
+    for result in run["results"]:
+        print(f"{result['group']:<6} {result['stage']:<28} {result['median'] * 1000:>10.3f} ms  {result['case']}")
+    if baseline is not None:
+        comparison = compare_runs(baseline, run, args.tolerance)
+        print_comparison(comparison)
+        sys.exit(1 if any(row["regression"] for row in comparison) else 0)
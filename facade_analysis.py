@@ -0,0 +1,715 @@
+import os
+import glob
+import json
+import queue
+import threading
+import traceback
+import zlib
+from functools import partial
+from multiprocessing import Pool, util
+
+import cv2
+import numpy as np
+import pandas as pd
+
+from metrics import timed
+
+
+# dataset locations
+
+DATASET_DIR = './data/Eijgenstein/Amsterdam_facade_dataset'
+TRAIN_MASK_DIR = os.path.join(DATASET_DIR, 'train_mask')
+VAL_MASK_DIR = os.path.join(DATASET_DIR, 'val_mask')
+IDS_CSV_PATH = './data/list_IDs.csv'
+BATCH_RESULTS_PATH = './data/facade_data/wwr_results.jsonl'
+DEBUG_DIR = './data/debug'
+
+# floor detection engines: "contours" clusters the bounding rectangles of the windows, "projection" reads the floors from the number of window pixels per row
+ENGINES = ("contours", "projection")
+
+# set FACADE_HEADLESS=1 to never open a window, e.g. on a server
+HEADLESS = os.environ.get("FACADE_HEADLESS", "") not in ("", "0")
+
+
+# label palette of the facade masks; the class ids of sky, window and door match the category ids in train.json and val.json
+
+SKY = 0
+WINDOW = 1
+DOOR = 2
+WALL = 3
+UNLABELLED = 255
+
+CLASS_NAMES = {SKY: "sky", WINDOW: "window", DOOR: "door", WALL: "wall"}
+
+# BGR values, as read by cv2.imread (HSV: wall [0,0,255], sky [60,185,160], window [102,211,180], door [14,241,255])
+PALETTE_BGR = {
+    SKY: (44, 160, 44),
+    WINDOW: (180, 119, 31),
+    DOOR: (14, 127, 255),
+    WALL: (255, 255, 255),
+}
+
+# per channel, a lookup table with a bit set for every class that has that channel value; a pixel belongs to a class when the bit is set in all three channels
+_CHANNEL_BITS = np.zeros((256, 1, 3), dtype=np.uint8)
+_BITS_TO_CLASS = np.full(256, UNLABELLED, dtype=np.uint8)
+for _bit, (_class_id, _bgr) in enumerate(PALETTE_BGR.items()):
+    for _channel, _value in enumerate(_bgr):
+        _CHANNEL_BITS[_value, 0, _channel] |= 1 << _bit
+    _BITS_TO_CLASS[1 << _bit] = _class_id
+
+
+# file handling
+
+def parse_mask_name(file_name):
+    """split a mask file name into the BAG identificatie and the photo distance
+
+    Args:
+    file_name (string): name of the mask file, e.g. "0363100012062180_5.220579.png"
+
+    Returns:
+    identificatie (string): BAG identificatie of the building
+    photo_dist (string): distance between the camera and the facade
+
+    Raises:
+    ValueError: if the name does not have the form <identificatie>_<photo_dist>.png
+    """
+    ID_segments = os.path.splitext(os.path.basename(file_name))[0].split("_")
+    if len(ID_segments) < 2:
+        raise ValueError(f"mask name {os.path.basename(file_name)!r} does not have the form <identificatie>_<photo_dist>.png")
+    return ID_segments[0], ID_segments[1]
+
+def read_files(mask_dir=TRAIN_MASK_DIR, IDs_csv_path=IDS_CSV_PATH):
+    """list all facade masks in a folder and save their IDs to a CSV file
+
+    The CSV file is only written when the IDs changed, so it keeps its modification time and the files derived from it (e.g. by filter_BAG) stay valid.
+
+    Args:
+    mask_dir (string): location of the facade masks
+    IDs_csv_path (string): location of the CSV file with all IDs
+
+    Returns:
+    list_files (list): names of all files in mask_dir
+    """
+    list_files = os.listdir(mask_dir)
+    IDs = []
+    for file in list_files:
+        identificatie, photo_dist = parse_mask_name(file)
+        IDs.append({
+            "identificatie": identificatie,
+            "photo_dist": photo_dist
+        })
+    file_df = pd.DataFrame(IDs)
+
+    # save to csv, unless it already holds the same IDs
+    csv_text = file_df.to_csv(index=False, header=True)
+    if os.path.exists(IDs_csv_path):
+        with open(IDs_csv_path, newline="") as csv_file:
+            if csv_file.read() == csv_text:
+                return list_files
+    with open(IDs_csv_path, "w", newline="") as csv_file:
+        csv_file.write(csv_text)
+    return list_files
+
+
+# mask decoding
+
+@timed("decode")
+def decode_mask(img):
+    """translate a facade mask to one class id per pixel, with a single lookup over the raw BGR values
+
+    Args:
+    img (array): the facade mask, as read by cv2.imread (BGR)
+
+    Returns:
+    class_ids (array): uint8 array with the shape of the image, holding SKY, WINDOW, DOOR, WALL or UNLABELLED for every pixel
+    """
+    channel_bits = cv2.split(cv2.LUT(img, _CHANNEL_BITS))
+    bits = cv2.bitwise_and(cv2.bitwise_and(channel_bits[0], channel_bits[1]), channel_bits[2])
+    class_ids = cv2.LUT(bits, _BITS_TO_CLASS)
+    return class_ids
+
+def class_mask(class_ids, class_id):
+    """select the pixels of one class, in the 0/255 format of cv2.inRange
+
+    Args:
+    class_ids (array): output of decode_mask
+    class_id (int): the class to select, e.g. WINDOW
+
+    Returns:
+    mask (array): uint8 array, 255 where the pixel belongs to the class and 0 elsewhere
+    """
+    return cv2.compare(class_ids, class_id, cv2.CMP_EQ)
+
+def encode_mask(class_ids):
+    """translate class ids back to a BGR image in the palette of the facade masks, e.g. for visualisation
+
+    Args:
+    class_ids (array): output of decode_mask
+
+    Returns:
+    img (array): the facade mask (BGR), unlabelled pixels are black
+    """
+    lookup = np.zeros((256, 3), dtype=np.uint8)
+    for class_id, bgr in PALETTE_BGR.items():
+        lookup[class_id] = bgr
+    return lookup[class_ids]
+
+def count_classes(class_ids):
+    """count the pixels of every class in a decoded facade mask
+
+    Args:
+    class_ids (array): output of decode_mask
+
+    Returns:
+    class_pixels (dict): number of pixels per class name
+    """
+    counts = np.bincount(class_ids.ravel(), minlength=256)
+    return {name: int(counts[class_id]) for class_id, name in CLASS_NAMES.items()}
+
+
+# window and floor extraction
+
+@timed("contours")
+def retrieve_window_bounds(class_ids, display=True):
+    """find the windows in a facade mask and simplify them to bounding rectangles
+
+    Args:
+    class_ids (array): the facade mask, decoded by decode_mask
+    display (bool): show the window mask and the bounding rectangles in a window (ignored in HEADLESS mode)
+
+    Returns:
+    boundRect (list): bounding rectangles of all windows, in order of x, y (top-left corner), width, height
+    img_shape (tuple): the shape of the input image
+    """
+    img_shape = class_ids.shape
+    mask = class_mask(class_ids, WINDOW)
+
+    if display:
+        show_image("img", mask)
+
+    contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+
+    # Approximate contours to polygons + get bounding rects
+    contours_poly = [None]*len(contours)
+    boundRect = [None]*len(contours)
+
+    for i, c in enumerate(contours):
+        contours_poly[i] = cv2.approxPolyDP(c, 3, True)
+        boundRect[i] = cv2.boundingRect(contours_poly[i])
+
+    if display:
+        show_image('Contours', draw_window_bounds(encode_mask(class_ids), boundRect))
+
+    return boundRect, img_shape
+
+@timed("contours")
+def retrieve_max_building_height(class_ids):
+    """find the top of the building, based on the wall in the facade mask
+
+    Args:
+    class_ids (array): the facade mask, decoded by decode_mask
+
+    Returns:
+    max_building_height (int): pixel row of the top of the building
+    """
+    wall_mask = class_mask(class_ids, WALL)
+
+    wall_contour, _ = cv2.findContours(wall_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    # Approximate contours to polygons + get bounding rects
+
+    for i in wall_contour:
+        wall_contours_poly = cv2.approxPolyDP(i, 3, True)
+        wall_boundRect = cv2.boundingRect(wall_contours_poly)
+    max_building_height = wall_boundRect[1]
+    return max_building_height
+
+def sweep_clusters(starts, ends, groups=None):
+    """label overlapping intervals with a cluster id, by sorting them once and sweeping over them
+
+    Intervals that only overlap through a chain of other intervals end up in the same cluster as well.
+
+    Args:
+    starts (array): lower bound of every interval
+    ends (array): upper bound of every interval
+    groups (array): optional group of every interval (e.g. the image it belongs to), intervals of different groups never share a cluster
+
+    Returns:
+    labels (array): cluster id of every interval, numbered in order of group and lower bound
+    cluster_bounds (array): lower and upper bound of every cluster
+    """
+    starts = np.asarray(starts)
+    ends = np.asarray(ends)
+    sweep_starts = starts
+    sweep_ends = ends
+    if groups is not None and len(starts):
+        # shift every group past the previous one, so a single sweep never merges intervals of different groups
+        span = ends.max() - min(starts.min(), 0) + 1
+        shift = np.asarray(groups) * span
+        sweep_starts = starts + shift
+        sweep_ends = ends + shift
+
+    # sort the intervals by their lower bound and sweep over them; a new cluster starts wherever an interval starts beyond the highest bound seen so far
+    order = np.argsort(sweep_starts, kind="stable")
+    running_end = np.maximum.accumulate(sweep_ends[order])
+    new_cluster = np.ones(len(order), dtype=bool)
+    new_cluster[1:] = sweep_starts[order][1:] > running_end[:-1]
+
+    # bounds of every cluster
+    first_in_cluster = np.flatnonzero(new_cluster)
+    if len(order):
+        cluster_bounds = np.column_stack([starts[order][first_in_cluster], np.maximum.reduceat(ends[order], first_in_cluster)])
+    else:
+        cluster_bounds = np.empty((0, 2), dtype=starts.dtype)
+
+    # map the cluster labels back to the original order
+    labels = np.empty(len(order), dtype=np.int64)
+    labels[order] = np.cumsum(new_cluster) - 1
+    return labels, cluster_bounds
+
+@timed("clustering")
+def find_window_clusters(bound_rects):
+    """group windows with overlapping vertical bounds into floors
+
+    Args:
+    bound_rects (list): bounding rectangles of all windows (x, y, width, height)
+
+    Returns:
+    window_clusters (list): for each window, the vertical bounds of the cluster it belongs to
+    duplicate_indices (dict): for each cluster boundary, the indices of the windows in that cluster, in order of the first window of each cluster
+    """
+    if len(bound_rects) == 0:
+        return [], {}
+    y_bounds = np.array([[border[1], border[1] + border[3]] for border in bound_rects])
+    labels, cluster_bounds = sweep_clusters(y_bounds[:, 0], y_bounds[:, 1])
+
+    cluster_bounds = cluster_bounds.tolist()
+    window_clusters = [cluster_bounds[label] for label in labels.tolist()]
+    duplicate_indices = {}
+    for index, boundary in enumerate(window_clusters):
+        duplicate_indices.setdefault(tuple(boundary), []).append(index)
+
+    return window_clusters, duplicate_indices
+
+CLUSTER_INFO_COLUMNS = ["window_count", "indices", "boundary", "avg_win_height", "floor_level", "roof_level",
+    "floor_height", "avg_sill_height", "window_area_sum", "wall_area", "WWR"]
+
+@timed("wwr")
+def get_cluster_info(bound_rects, window_clusters, duplicate_indices, img_shape, max_building_height):
+    """calculate window and floor information, including the WWR, for every window cluster
+
+    All clusters are handled at once with array reductions, and the result table is built a single time.
+
+    Args:
+    bound_rects (list): bounding rectangles of all windows (x, y, width, height)
+    window_clusters (list): for each window, the vertical bounds of its cluster
+    duplicate_indices (dict): for each cluster boundary, the indices of the windows in that cluster, from the ground floor up
+    img_shape (tuple): the shape of the facade mask
+    max_building_height (int): pixel row of the top of the building
+
+    Returns:
+    cluster_df (DataFrame): one row of window and floor information per window cluster
+    """
+    clusters = list(duplicate_indices.values())
+    if len(clusters) == 0:
+        return pd.DataFrame(columns=CLUSTER_INFO_COLUMNS)
+
+    # window sizes, reordered so the members of every cluster are contiguous
+    borders = np.asarray(bound_rects).reshape(-1, 4)
+    window_count = np.array([len(cluster) for cluster in clusters])
+    first_member = np.concatenate([[0], np.cumsum(window_count)[:-1]])
+    members = np.concatenate(clusters)
+    member_heights = borders[members, 3]
+
+    # group reductions per cluster
+    win_area_sum = np.add.reduceat(borders[members, 2] * member_heights, first_member)
+    avg_win_height = np.add.reduceat(member_heights, first_member) / window_count
+    boundary = np.asarray(window_clusters)[members[first_member]]
+
+    return floor_table(window_count, clusters, boundary, avg_win_height, win_area_sum, img_shape, max_building_height)
+
+def floor_table(window_count, indices, boundary, avg_win_height, win_area_sum, img_shape, max_building_height):
+    """derive the floor levels and the WWR from per-floor window statistics, and build the cluster_info table
+
+    Args:
+    window_count (array): number of windows per floor
+    indices (list): indices of the windows per floor
+    boundary (array): upper and lower bound of the windows per floor
+    avg_win_height (array): average window height per floor
+    win_area_sum (array): total window area per floor
+    img_shape (tuple): the shape of the facade mask
+    max_building_height (int): pixel row of the top of the building
+
+    Returns:
+    cluster_df (DataFrame): one row of window and floor information per floor, from the ground floor up
+    """
+    middle_boundary = boundary.sum(axis=1) / 2
+    avg_sill_height = middle_boundary + avg_win_height / 2
+    avg_top_window_height = middle_boundary - avg_win_height/2
+
+    # the roof of a floor lies at 2/3 between the top of its windows and the sill of the next floor, the last floor ends at the top of the building
+    next_sill = avg_sill_height[1:]
+    roof_level = np.append(next_sill + (2/3*(avg_top_window_height[:-1] - next_sill)), max_building_height)
+    floor_level = np.insert(roof_level[:-1], 0, img_shape[0])
+
+    floor_height = floor_level - roof_level
+    wall_area = floor_height * img_shape[1]
+    WWR = win_area_sum / wall_area
+
+    cluster_df = pd.DataFrame({
+        "window_count": window_count,
+        "indices": indices,
+        "boundary": boundary.tolist(),
+        "avg_win_height": avg_win_height,
+        "floor_level": floor_level,
+        "roof_level": roof_level,
+        "floor_height": floor_height,
+        "avg_sill_height": avg_sill_height,
+        "window_area_sum": win_area_sum,
+        "wall_area": wall_area,
+        "WWR": WWR,
+    })
+    return cluster_df
+
+def retrieve_floor_bands(class_ids, min_window_pixels=1):
+    """find the floors from the horizontal projection profile of the windows, without detecting individual windows
+
+    The profile holds the number of window pixels in every row. Every run of rows with windows is one floor band, which matches the clusters of find_window_clusters for windows that do not overlap vertically across floors.
+
+    Args:
+    class_ids (array): the facade mask, decoded by decode_mask
+    min_window_pixels (int): rows with fewer window pixels are ignored, e.g. to skip noise
+
+    Returns:
+    floor_bands (array): first row and the row after the last row of every band, from top to bottom
+    profile (array): number of window pixels in every row
+    """
+    mask = class_mask(class_ids, WINDOW)
+    profile = cv2.reduce(mask, 1, cv2.REDUCE_SUM, dtype=cv2.CV_32S).ravel() // 255
+    edges = np.diff((profile >= min_window_pixels).astype(np.int8), prepend=0, append=0)
+    floor_bands = np.column_stack([np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)])
+    return floor_bands, profile
+
+@timed("wwr")
+def get_projection_cluster_info(class_ids, max_building_height, min_window_pixels=1):
+    """calculate window and floor information, including the WWR, from the projection profile of the windows
+
+    Alternative for retrieve_window_bounds + find_window_clusters + get_cluster_info that costs a single pass over the pixels. The window area is the number of window pixels per band, the window height is the height of a rectangle with the widest row of the band and the same area, and the window count is the number of separate column runs in the band. As there are no individual windows, "indices" is empty.
+
+    Args:
+    class_ids (array): the facade mask, decoded by decode_mask
+    max_building_height (int): pixel row of the top of the building
+    min_window_pixels (int): rows with fewer window pixels are ignored
+
+    Returns:
+    cluster_df (DataFrame): the columns of get_cluster_info, one row per floor from the ground floor up
+    """
+    floor_bands, profile = retrieve_floor_bands(class_ids, min_window_pixels)
+    if len(floor_bands) == 0:
+        return pd.DataFrame(columns=CLUSTER_INFO_COLUMNS)
+
+    # per band statistics; the rows between two bands hold no windows, so reducing from the start of one band to the start of the next is enough
+    band_starts = floor_bands[:, 0]
+    cumulative = np.concatenate([[0], np.cumsum(profile)])
+    win_area_sum = cumulative[floor_bands[:, 1]] - cumulative[band_starts]
+    avg_win_height = win_area_sum / np.maximum.reduceat(profile, band_starts)
+
+    # separate windows next to each other show up as separate runs of columns with window pixels
+    columns = np.maximum.reduceat(class_mask(class_ids, WINDOW), band_starts, axis=0) > 0
+    window_count = np.count_nonzero(np.diff(columns.view(np.int8), axis=1, prepend=0) == 1, axis=1)
+
+    # from the ground floor up
+    floor_bands = floor_bands[::-1]
+    return floor_table(window_count[::-1], [[] for _ in floor_bands], floor_bands, avg_win_height[::-1], win_area_sum[::-1],
+        class_ids.shape, max_building_height)
+
+
+# visualisation
+
+def show_image(title, img):
+    """show an image in a window and wait for a keystroke, unless running in HEADLESS mode
+
+    Args:
+    title (string): title of the window
+    img (array): the image to show
+    """
+    if HEADLESS:
+        return
+    cv2.imshow(title, img)
+    cv2.waitKey(0) # Wait for a keystroke in the window
+
+def draw_window_bounds(img, bound_rects):
+    """draw the window bounding rectangles on a copy of a facade image
+
+    Args:
+    img (array): the facade mask (BGR)
+    bound_rects (list): output of retrieve_window_bounds
+
+    Returns:
+    polygon_img (array): the facade mask with a red rectangle around every window
+    """
+    polygon_img = img.copy()
+    for border in bound_rects:
+        color = (0,0,255)
+        polygon_img = cv2.rectangle(polygon_img, (int(border[0]), int(border[1])),
+        (int(border[0]+border[2]), int(border[1]+border[3])), color, 2)
+    return polygon_img
+
+def draw_floor_levels(img, cluster_info):
+    """draw the floor levels on a copy of a facade image
+
+    Args:
+    img (array): the facade mask (BGR)
+    cluster_info (DataFrame): output of get_cluster_info
+
+    Returns:
+    floors_img (array): the facade mask with a red line at the roof level of every floor
+    """
+    floors_img = img.copy()
+    floorimg_shape = floors_img.shape
+
+    #visualise floorlevels
+    for roof_level in cluster_info["roof_level"]:
+        color = (0,0,255)
+        cv2.line(floors_img, (0, int(roof_level)), #point 1
+        (floorimg_shape[1]-1, int(roof_level)), #point 2
+        color, 2)
+    return floors_img
+
+def visualise_floors(cluster_info, mask_path, output_path="data/cv2_floor_test.png", display=True):
+    """draw the floor levels on top of the facade mask and save the image
+
+    Args:
+    cluster_info (DataFrame): output of get_cluster_info
+    mask_path (string): location of the facade mask
+    output_path (string): location of the image with the floor levels
+    display (bool): show the image in a window (ignored in HEADLESS mode)
+    """
+    floors_img = draw_floor_levels(cv2.imread(mask_path), cluster_info)
+    if display:
+        show_image('floorlevels', floors_img)
+    cv2.imwrite(output_path, floors_img)
+
+class DebugWriter:
+    """render debug overlays for a sample of the facades and write them to disk on a background thread
+
+    Only the choice whether a facade is sampled happens on the calling thread; drawing and writing the overlay are done by the writer thread, so they never slow down the analysis itself.
+
+    Args:
+    output_dir (string): folder for the overlay images
+    sample_rate (float): fraction of the facades that get overlays, chosen from a hash of the file name so the sample is the same on every run
+    max_queue (int): number of overlays that may wait to be written, when the queue is full new overlays are dropped instead of waiting
+    """
+    def __init__(self, output_dir=DEBUG_DIR, sample_rate=0.01, max_queue=64):
+        self.output_dir = output_dir
+        self.sample_rate = sample_rate
+        self.dropped = 0
+        os.makedirs(output_dir, exist_ok=True)
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._thread = threading.Thread(target=self._write_overlays, name="DebugWriter", daemon=True)
+        self._thread.start()
+
+    def wants(self, file_name):
+        """check whether a facade belongs to the sample that gets overlays"""
+        return zlib.crc32(file_name.encode()) < self.sample_rate * 2**32
+
+    def submit(self, file_name, draw, *args):
+        """queue an overlay, draw(*args) is called on the writer thread and the result is saved as file_name"""
+        try:
+            self._queue.put_nowait((file_name, draw, args))
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        """write the overlays that are still waiting and stop the writer thread"""
+        self._queue.put((None, None, None))
+        self._thread.join()
+
+    def _write_overlays(self):
+        while True:
+            file_name, draw, args = self._queue.get()
+            if file_name is None:
+                break
+            try:
+                cv2.imwrite(os.path.join(self.output_dir, file_name), draw(*args))
+            except Exception:
+                # debug output should never break the analysis
+                pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+# batch processing
+
+def _to_builtin(value):
+    # numpy scalars and arrays are not JSON serialisable
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+def process_mask(mask_path, debug_writer=None, engine="contours"):
+    """run the complete window and floor extraction for a single facade mask, without opening any window
+
+    Args:
+    mask_path (string): location of the facade mask
+    debug_writer (DebugWriter): receives the window and floor overlays if the facade is in its sample
+    engine (string): floor detection engine, one of ENGINES
+
+    Returns:
+    record (dict): the IDs of the building, its floor information and window boxes, or the error if the mask could not be processed (with IDs None if its name could not be parsed)
+    """
+    record = {
+        "identificatie": None,
+        "photo_dist": None,
+        "split": os.path.basename(os.path.dirname(mask_path)),
+        "file_name": os.path.basename(mask_path),
+        "engine": engine,
+    }
+    try:
+        record["identificatie"], record["photo_dist"] = parse_mask_name(mask_path)
+        img = cv2.imread(mask_path)
+        if img is None:
+            raise ValueError(f"could not read image {mask_path}")
+        class_ids = decode_mask(img)
+        record["class_pixels"] = count_classes(class_ids)
+        max_building_height = retrieve_max_building_height(class_ids)
+        if engine == "contours":
+            bound_rects, img_shape = retrieve_window_bounds(class_ids, display=False)
+            window_clusters, duplicate_indices = find_window_clusters(bound_rects)
+            cluster_info = get_cluster_info(bound_rects, window_clusters, duplicate_indices, img_shape, max_building_height)
+        elif engine == "projection":
+            bound_rects = None
+            cluster_info = get_projection_cluster_info(class_ids, max_building_height)
+        else:
+            raise ValueError(f"unknown engine {engine!r}, choose one of {ENGINES}")
+        record["floors"] = cluster_info.to_dict("records")
+        # the window boxes that the "indices" of the floors refer to, e.g. for facade_columns
+        record["windows"] = [] if bound_rects is None else np.asarray(bound_rects).reshape(-1, 4).tolist()
+
+        if debug_writer is not None and debug_writer.wants(record["file_name"]):
+            stem = os.path.splitext(record["file_name"])[0]
+            if bound_rects is not None:
+                debug_writer.submit(stem + "_windows.png", draw_window_bounds, img, bound_rects)
+            debug_writer.submit(stem + "_floors.png", draw_floor_levels, img, cluster_info)
+    except Exception as e:
+        record["error"] = f"{type(e).__name__}: {e}"
+        record["traceback"] = traceback.format_exc()
+    return record
+
+def list_masks(mask_dirs=(TRAIN_MASK_DIR, VAL_MASK_DIR)):
+    """list the paths of all facade masks in one or more folders
+
+    Args:
+    mask_dirs (list): locations of the facade masks
+
+    Returns:
+    mask_paths (list): sorted paths of all .png files
+    """
+    mask_paths = []
+    for mask_dir in mask_dirs:
+        mask_paths.extend(sorted(glob.glob(os.path.join(mask_dir, "*.png"))))
+    return mask_paths
+
+# every worker process keeps its own debug writer, which is closed when the worker exits
+_worker_debug_writer = None
+
+def _init_worker(debug_dir, debug_sample_rate):
+    global _worker_debug_writer
+    if debug_sample_rate > 0:
+        _worker_debug_writer = DebugWriter(debug_dir, debug_sample_rate)
+        util.Finalize(_worker_debug_writer, _worker_debug_writer.close, exitpriority=10)
+
+def _process_mask_in_worker(mask_path, engine):
+    return process_mask(mask_path, _worker_debug_writer, engine)
+
+def iter_batch(mask_paths, workers=None, chunksize=4, debug_dir=DEBUG_DIR, debug_sample_rate=0.0, engine="contours"):
+    """process facade masks on a pool of worker processes, yielding each result as soon as it is finished
+
+    Args:
+    mask_paths (list): locations of the facade masks
+    workers (int): number of worker processes, defaults to the number of cores
+    chunksize (int): number of masks that is sent to a worker at once
+    debug_dir (string): folder for the debug overlays
+    debug_sample_rate (float): fraction of the facades that get debug overlays, 0 disables them
+    engine (string): floor detection engine, one of ENGINES
+
+    Yields:
+    record (dict): output of process_mask, in order of completion
+    """
+    if engine not in ENGINES:
+        raise ValueError(f"unknown engine {engine!r}, choose one of {ENGINES}")
+    pool = Pool(processes=workers, initializer=_init_worker, initargs=(debug_dir, debug_sample_rate))
+    try:
+        for record in pool.imap_unordered(partial(_process_mask_in_worker, engine=engine), mask_paths, chunksize=chunksize):
+            yield record
+        # let the workers exit normally, so their debug writers can finish
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+def run_batch(mask_dirs=(TRAIN_MASK_DIR, VAL_MASK_DIR), output_path=BATCH_RESULTS_PATH, workers=None, chunksize=4,
+        debug_dir=DEBUG_DIR, debug_sample_rate=0.0, engine="contours"):
+    """run the window and floor extraction over all facade masks and stream the results to a JSON lines file
+
+    Every line in the output holds one building. Masks that could not be processed are written with an "error" field instead of "floors", so a bad image does not abort the run. No windows are opened; debug overlays are only written for a sample of the facades.
+
+    Args:
+    mask_dirs (list): locations of the facade masks
+    output_path (string): location of the JSON lines file
+    workers (int): number of worker processes, defaults to the number of cores
+    chunksize (int): number of masks that is sent to a worker at once
+    debug_dir (string): folder for the debug overlays
+    debug_sample_rate (float): fraction of the facades that get debug overlays, 0 disables them
+    engine (string): floor detection engine, one of ENGINES, so the engines can be compared run by run
+
+    Returns:
+    processed (int): number of masks that were processed successfully
+    failed (int): number of masks that could not be processed
+    """
+    mask_paths = list_masks(mask_dirs)
+    processed = 0
+    failed = 0
+
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    with open(output_path, 'w') as output:
+        for record in iter_batch(mask_paths, workers=workers, chunksize=chunksize,
+                debug_dir=debug_dir, debug_sample_rate=debug_sample_rate, engine=engine):
+            if "error" in record:
+                failed += 1
+            else:
+                processed += 1
+            output.write(json.dumps(record, default=_to_builtin) + "\n")
+            output.flush()
+    return processed, failed
+
+def read_batch_results(results_path=BATCH_RESULTS_PATH):
+    """read the floors that run_batch wrote, indexed by building, e.g. as a loader for gis_layers.layer_cache
+
+    Args:
+    results_path (string): location of the JSON lines file of run_batch
+
+    Returns:
+    floors (dict): for every identificatie, the floors of all its facades, each with the file_name and photo_dist of its facade; masks that failed are left out
+    """
+    floors = {}
+    with open(results_path) as results_file:
+        for line in results_file:
+            record = json.loads(line)
+            if "error" in record:
+                continue
+            building_floors = floors.setdefault(record["identificatie"], [])
+            for floor in record["floors"]:
+                building_floors.append({"file_name": record["file_name"], "photo_dist": record["photo_dist"], **floor})
+    return floors
+
+if __name__ == "__main__":
+    processed, failed = run_batch()
+    print(f"processed {processed} masks, {failed} failed")
@@ -0,0 +1,248 @@
+import os
+import json
+import itertools
+
+import numpy as np
+import pandas as pd
+
+from facade_analysis import DATASET_DIR, SKY, WINDOW, parse_mask_name, sweep_clusters
+
+
+# annotation files of the facade dataset
+
+TRAIN_JSON = os.path.join(DATASET_DIR, 'train.json')
+VAL_JSON = os.path.join(DATASET_DIR, 'val.json')
+
+
+# loading and indexing
+
+def load_coco(json_path):
+    """read a COCO annotation file once and index its annotations by image
+
+    The annotations are sorted by image, so the annotations of one image are a contiguous slice between two offsets.
+
+    Args:
+    json_path (string): location of the COCO file, e.g. train.json
+
+    Returns:
+    coco (dict): with
+        "images" (DataFrame): id, file_name, identificatie, photo_dist, height and width of every image, sorted by id
+        "offsets" (array): the annotations of image row i are annotations offsets[i]:offsets[i+1]
+        "image_row" (array): row in "images" of every annotation
+        "category_id" (array): category of every annotation (SKY, WINDOW or DOOR)
+        "bbox" (array): bounding box of every annotation (x, y, width, height), in COCO pixel-edge coordinates
+        "segmentation" (list): polygons of every annotation
+    """
+    with open(json_path) as json_file:
+        data = json.load(json_file)
+
+    images = pd.DataFrame(data["images"], columns=["id", "file_name", "height", "width"])
+    images = images.sort_values("id", ignore_index=True)
+    IDs = [parse_mask_name(file_name) for file_name in images["file_name"]]
+    images.insert(2, "identificatie", [identificatie for identificatie, _ in IDs])
+    images.insert(3, "photo_dist", [photo_dist for _, photo_dist in IDs])
+
+    annotations = data["annotations"]
+    image_ids = np.array([annotation["image_id"] for annotation in annotations], dtype=np.int64)
+    image_row = np.searchsorted(images["id"].to_numpy(), image_ids)
+    order = np.argsort(image_row, kind="stable")
+
+    category_id = np.array([annotation["category_id"] for annotation in annotations], dtype=np.int64)
+    bbox = np.array([annotation["bbox"] for annotation in annotations], dtype=np.float64).reshape(-1, 4)
+    image_row = image_row[order]
+
+    return {
+        "images": images,
+        "offsets": np.searchsorted(image_row, np.arange(len(images) + 1)),
+        "image_row": image_row,
+        "category_id": category_id[order],
+        "bbox": bbox[order],
+        "segmentation": [annotations[i]["segmentation"] for i in order],
+    }
+
+def image_annotations(coco, image_id, category_id=None):
+    """select the annotations of a single image, without scanning the other images
+
+    Args:
+    coco (dict): output of load_coco
+    image_id (int): COCO id of the image
+    category_id (int): only return annotations of this category (e.g. WINDOW)
+
+    Returns:
+    bbox (array): bounding boxes of the annotations (x, y, width, height)
+    segmentation (list): polygons of the annotations
+    """
+    row = np.searchsorted(coco["images"]["id"].to_numpy(), image_id)
+    selection = np.arange(coco["offsets"][row], coco["offsets"][row + 1])
+    if category_id is not None:
+        selection = selection[coco["category_id"][selection] == category_id]
+    return coco["bbox"][selection], [coco["segmentation"][i] for i in selection]
+
+
+# window boxes and building tops
+
+def window_boxes(coco):
+    """collect the window boxes of all images, in the pixel coordinates of cv2.boundingRect
+
+    COCO boxes are given on pixel edges (the first pixel starts at -0.5), cv2 counts from the pixel centre, so the boxes are shifted by half a pixel.
+
+    Args:
+    coco (dict): output of load_coco
+
+    Returns:
+    image_row (array): row in coco["images"] of every window
+    boxes (array): x, y (top-left corner), width and height of every window
+    """
+    is_window = coco["category_id"] == WINDOW
+    boxes = coco["bbox"][is_window].copy()
+    boxes[:, :2] += 0.5
+    return coco["image_row"][is_window], boxes
+
+def building_tops(coco):
+    """find the top of the building in every image, from the outlines of the sky
+
+    The top of the building is the highest point where the sky ends: the highest vertex of the sky polygons that lies on the roofline. Vertices on the top edge of the image only close the polygon along the image border. Where the sky runs down the left or right edge of the image, next to the building, the vertices between two edges along that side are not on the roofline either; the vertex where the polygon turns away from the side is, as that is where the roof meets the border. Images without sky are taken to be filled by the building up to the top edge.
+
+    Args:
+    coco (dict): output of load_coco
+
+    Returns:
+    max_building_height (array): pixel row of the top of the building, for every row in coco["images"]
+    """
+    is_sky = np.flatnonzero(coco["category_id"] == SKY)
+    polygons = [polygon for i in is_sky for polygon in coco["segmentation"][i]]
+    polygon_rows = [coco["image_row"][i] for i in is_sky for _ in coco["segmentation"][i]]
+
+    vertex_x = np.fromiter(itertools.chain.from_iterable(polygon[0::2] for polygon in polygons), dtype=np.float64)
+    vertex_y = np.fromiter(itertools.chain.from_iterable(polygon[1::2] for polygon in polygons), dtype=np.float64)
+    vertex_count = np.asarray([len(polygon) // 2 for polygon in polygons], dtype=np.int64)
+    vertex_row = np.repeat(np.asarray(polygon_rows, dtype=np.int64), vertex_count)
+
+    # the previous and next vertex of every vertex, wrapping around within its polygon
+    polygon_start = np.repeat(np.cumsum(vertex_count) - vertex_count, vertex_count)
+    position = np.arange(len(vertex_x)) - polygon_start
+    vertex_total = np.repeat(vertex_count, vertex_count)
+    previous = polygon_start + (position - 1) % np.maximum(vertex_total, 1)
+    following = polygon_start + (position + 1) % np.maximum(vertex_total, 1)
+
+    width = coco["images"]["width"].to_numpy(dtype=np.float64)[vertex_row]
+    on_left = vertex_x <= 0.5
+    on_right = vertex_x >= width - 0.5
+    along_side = (on_left & on_left[previous] & on_left[following]) | (on_right & on_right[previous] & on_right[following])
+
+    roofline = (vertex_y > 0.5) & ~along_side
+    max_building_height = np.full(len(coco["images"]), np.inf)
+    np.minimum.at(max_building_height, vertex_row[roofline], vertex_y[roofline] + 0.5)
+    max_building_height[np.isinf(max_building_height)] = 0.0
+    return max_building_height
+
+
+# floor and WWR calculation
+
+def annotation_cluster_info(coco):
+    """calculate window and floor information, including the WWR, for all images of a COCO file at once
+
+    The window boxes of all images are clustered into floors in one sweep, and all floor statistics are computed with array reductions. The floors of every image are ordered from the ground floor up; the floor level and roof level follow the rules of facade_analysis.get_cluster_info.
+
+    Args:
+    coco (dict): output of load_coco
+
+    Returns:
+    cluster_df (DataFrame): one row per floor, with the image IDs followed by the columns of get_cluster_info
+    """
+    images = coco["images"]
+    window_row, boxes = window_boxes(coco)
+    max_building_height = building_tops(coco)
+
+    labels, cluster_bounds = sweep_clusters(boxes[:, 1], boxes[:, 1] + boxes[:, 3], groups=window_row)
+    cluster_count = len(cluster_bounds)
+
+    # group reductions per cluster
+    window_count = np.bincount(labels, minlength=cluster_count)
+    window_area_sum = np.bincount(labels, weights=boxes[:, 2] * boxes[:, 3], minlength=cluster_count)
+    avg_win_height = np.bincount(labels, weights=boxes[:, 3], minlength=cluster_count) / np.maximum(window_count, 1)
+    cluster_row = np.zeros(cluster_count, dtype=np.int64)
+    cluster_row[labels] = window_row
+
+    middle_boundary = cluster_bounds.sum(axis=1) / 2
+    avg_sill_height = middle_boundary + avg_win_height / 2
+    avg_top_window_height = middle_boundary - avg_win_height / 2
+
+    # order the floors of every image from the ground floor up
+    floor_order = np.lexsort((-cluster_bounds[:, 0], cluster_row))
+    cluster_row = cluster_row[floor_order]
+    first_floor = np.ones(cluster_count, dtype=bool)
+    first_floor[1:] = cluster_row[1:] != cluster_row[:-1]
+    top_floor = np.ones(cluster_count, dtype=bool)
+    top_floor[:-1] = first_floor[1:]
+
+    # the roof of a floor lies at 2/3 between the top of its windows and the sill of the floor above; the top floor ends at the top of the building
+    sill = avg_sill_height[floor_order]
+    top = avg_top_window_height[floor_order]
+    next_sill = np.roll(sill, -1)
+    roof_level = np.where(top_floor, max_building_height[cluster_row], next_sill + (2/3*(top - next_sill)))
+    floor_level = np.where(first_floor, images["height"].to_numpy()[cluster_row], np.roll(roof_level, 1))
+
+    floor_height = floor_level - roof_level
+    wall_area = floor_height * images["width"].to_numpy()[cluster_row]
+    WWR = window_area_sum[floor_order] / wall_area
+
+    # window indices per floor, counted within the windows of their image
+    window_index = np.arange(len(window_row)) - np.searchsorted(window_row, window_row)
+    member_order = np.argsort(labels, kind="stable")
+    members = np.split(window_index[member_order], np.cumsum(window_count)[:-1])
+
+    cluster_df = pd.DataFrame({
+        "identificatie": images["identificatie"].to_numpy()[cluster_row],
+        "photo_dist": images["photo_dist"].to_numpy()[cluster_row],
+        "file_name": images["file_name"].to_numpy()[cluster_row],
+        "window_count": window_count[floor_order],
+        "indices": [members[i].tolist() for i in floor_order],
+        "boundary": cluster_bounds[floor_order].tolist(),
+        "avg_win_height": avg_win_height[floor_order],
+        "floor_level": floor_level,
+        "roof_level": roof_level,
+        "floor_height": floor_height,
+        "avg_sill_height": sill,
+        "window_area_sum": window_area_sum[floor_order],
+        "wall_area": wall_area,
+        "WWR": WWR,
+    })
+    return cluster_df
+
+def run_annotations(json_paths=(TRAIN_JSON, VAL_JSON)):
+    """calculate the window and floor information of every annotated facade, without reading any image
+
+    Args:
+    json_paths (list): locations of the COCO files
+
+    Returns:
+    cluster_df (DataFrame): one row per floor of every image, with the split ("train" or "val") it belongs to
+    """
+    cluster_dfs = []
+    for json_path in json_paths:
+        cluster_df = annotation_cluster_info(load_coco(json_path))
+        cluster_df.insert(0, "split", os.path.splitext(os.path.basename(json_path))[0])
+        cluster_dfs.append(cluster_df)
+    return pd.concat(cluster_dfs, ignore_index=True)
+
+def annotation_floors(json_path):
+    """calculate the floors of every annotated facade of a COCO file, indexed by building, e.g. as a loader for gis_layers.layer_cache
+
+    Args:
+    json_path (string): location of the COCO file
+
+    Returns:
+    floors (dict): for every identificatie, the floors of all its facades as dicts with the columns of annotation_cluster_info
+    """
+    cluster_df = annotation_cluster_info(load_coco(json_path))
+    floors = {}
+    for floor in cluster_df.to_dict("records"):
+        floors.setdefault(floor["identificatie"], []).append(floor)
+    return floors
+
+
+if __name__ == "__main__":
+    cluster_df = run_annotations()
+    cluster_df.to_csv("./data/facade_data/annotation_wwr.csv", sep=";", index=False, header=True)
+    print(f"{cluster_df['file_name'].nunique()} facades, {len(cluster_df)} floors")
@@ -0,0 +1,386 @@
+import os
+import json
+
+import numpy as np
+import pandas as pd
+
+from facade_analysis import BATCH_RESULTS_PATH, CLUSTER_INFO_COLUMNS
+from facade_annotations import TRAIN_JSON, VAL_JSON, load_coco, window_boxes, annotation_cluster_info
+
+
+# columnar store of all windows and floors
+
+COLUMNS_PATH = './data/facade_data/facade_columns.bin'
+
+# every window box, in the order of bound_rects; floor is the index of its floor within its facade (-1 if it belongs to none)
+WINDOW_DTYPE = np.dtype([("x", "<f4"), ("y", "<f4"), ("width", "<f4"), ("height", "<f4"), ("floor", "<i4")])
+# every floor, from the ground floor up within its facade; the columns of get_cluster_info without the lists
+FLOOR_COLUMNS = [column for column in CLUSTER_INFO_COLUMNS if column not in ("indices", "boundary")]
+FLOOR_DTYPE = np.dtype([("window_count", "<i4"), ("boundary_top", "<f8"), ("boundary_bottom", "<f8")]
+    + [(column, "<f8") for column in FLOOR_COLUMNS if column != "window_count"])
+# every facade, sorted by identificatie and photo_dist; the mask name is f"{identificatie}_{photo_dist}.png"
+FACADE_DTYPE = np.dtype([("identificatie", "S16"), ("photo_dist", "S16")])
+
+# the arrays of a store, in the order they are written
+ARRAY_NAMES = ("building_ids", "building_offsets", "facades", "window_offsets", "floor_offsets", "windows", "floors")
+
+# file layout: magic, length of the JSON header (8 bytes, little endian), header, arrays; everything starts on a multiple of ALIGNMENT
+MAGIC = b"FACADECOLS\x00\x01"
+ALIGNMENT = 64
+
+# BAG height classes in metres, by the b3_h_70p height of the building
+HEIGHT_CLASSES = (0.0, 6.0, 9.0, 12.0, 15.0, 18.0, 24.0, np.inf)
+# bins of the WWR histograms of wwr_by_height_class
+WWR_BINS = np.linspace(0.0, 1.0, 11)
+
+
+# building the arrays
+
+def pack_columns(identificatie, photo_dist, windows, window_facade, floors, floor_facade):
+    """sort the windows and floors of all facades by building, and index them with offsets
+
+    The facades are sorted by identificatie and photo_dist; the windows and floors keep their order within their facade. The windows of facade i are then windows[window_offsets[i]:window_offsets[i+1]], and the facades of building j are facades[building_offsets[j]:building_offsets[j+1]], and likewise for the floors.
+
+    Args:
+    identificatie (array): BAG identificatie of every facade
+    photo_dist (array): photo distance of every facade, as in the mask name
+    windows (array): every window, of WINDOW_DTYPE
+    window_facade (array): facade of every window, as an index into identificatie
+    floors (array): every floor, of FLOOR_DTYPE
+    floor_facade (array): facade of every floor, as an index into identificatie
+
+    Returns:
+    columns (dict): the arrays of ARRAY_NAMES
+    """
+    facades = np.empty(len(identificatie), dtype=FACADE_DTYPE)
+    facades["identificatie"] = np.asarray(identificatie, dtype="S16")
+    facades["photo_dist"] = np.asarray(photo_dist, dtype="S16")
+    facade_order = np.lexsort((facades["photo_dist"], facades["identificatie"]))
+    facades = facades[facade_order]
+    facade_rank = np.empty_like(facade_order)
+    facade_rank[facade_order] = np.arange(len(facade_order))
+
+    window_facade = facade_rank[np.asarray(window_facade, dtype=np.int64)]
+    window_order = np.argsort(window_facade, kind="stable")
+    floor_facade = facade_rank[np.asarray(floor_facade, dtype=np.int64)]
+    floor_order = np.argsort(floor_facade, kind="stable")
+
+    building_ids, building_start = np.unique(facades["identificatie"], return_index=True)
+    return {
+        "building_ids": building_ids,
+        "building_offsets": np.append(building_start, len(facades)).astype(np.int64),
+        "facades": facades,
+        "window_offsets": np.searchsorted(window_facade[window_order], np.arange(len(facades) + 1)).astype(np.int64),
+        "floor_offsets": np.searchsorted(floor_facade[floor_order], np.arange(len(facades) + 1)).astype(np.int64),
+        "windows": np.asarray(windows, dtype=WINDOW_DTYPE)[window_order],
+        "floors": np.asarray(floors, dtype=FLOOR_DTYPE)[floor_order],
+    }
+
+def _floor_array(cluster_df):
+    # the floor columns of a cluster_info table as a FLOOR_DTYPE array
+    floors = np.zeros(len(cluster_df), dtype=FLOOR_DTYPE)
+    if len(cluster_df) == 0:
+        return floors
+    boundary = np.asarray(cluster_df["boundary"].tolist(), dtype=np.float64).reshape(-1, 2)
+    floors["boundary_top"] = boundary[:, 0]
+    floors["boundary_bottom"] = boundary[:, 1]
+    for column in FLOOR_COLUMNS:
+        floors[column] = cluster_df[column].to_numpy()
+    return floors
+
+def _window_floors(window_count, floor_first_window, floor_number, indices):
+    # the floor of every window, from the window indices of every floor; indices count from the first window of the facade of the floor
+    window_floor = np.full(window_count, -1, dtype=np.int32)
+    lengths = [len(floor_indices) for floor_indices in indices]
+    if sum(lengths) == 0:
+        return window_floor
+    members = np.concatenate([np.asarray(floor_indices, dtype=np.int64) for floor_indices in indices])
+    window_floor[np.repeat(floor_first_window, lengths) + members] = np.repeat(floor_number, lengths)
+    return window_floor
+
+def columns_from_annotations(json_paths=(TRAIN_JSON, VAL_JSON)):
+    """build the columnar store from the window annotations of the facade dataset, without reading any image
+
+    Args:
+    json_paths (list): locations of the COCO files
+
+    Returns:
+    columns (dict): the arrays of ARRAY_NAMES, see pack_columns
+    """
+    identificatie, photo_dist, windows, window_facade, floors, floor_facade, window_floor = [], [], [], [], [], [], []
+    facade_count = 0
+    for json_path in json_paths:
+        coco = load_coco(json_path)
+        images = coco["images"]
+        window_row, boxes = window_boxes(coco)
+        cluster_df = annotation_cluster_info(coco)
+        floor_row = pd.Index(images["file_name"]).get_indexer(cluster_df["file_name"])
+
+        # the floors of an image are contiguous and numbered from its ground floor, its windows start at the offset of the image
+        floor_number = np.arange(len(floor_row)) - np.searchsorted(floor_row, floor_row)
+        floor_first_window = np.searchsorted(window_row, floor_row)
+        window_floor.append(_window_floors(len(window_row), floor_first_window, floor_number, cluster_df["indices"]))
+
+        image_windows_array = np.zeros(len(window_row), dtype=WINDOW_DTYPE)
+        for i, field in enumerate(("x", "y", "width", "height")):
+            image_windows_array[field] = boxes[:, i]
+        windows.append(image_windows_array)
+        window_facade.append(window_row + facade_count)
+        floors.append(_floor_array(cluster_df))
+        floor_facade.append(floor_row + facade_count)
+        identificatie.append(images["identificatie"].to_numpy())
+        photo_dist.append(images["photo_dist"].to_numpy())
+        facade_count += len(images)
+
+    windows = np.concatenate(windows)
+    windows["floor"] = np.concatenate(window_floor)
+    return pack_columns(np.concatenate(identificatie), np.concatenate(photo_dist), windows, np.concatenate(window_facade),
+        np.concatenate(floors), np.concatenate(floor_facade))
+
+def columns_from_records(records):
+    """build the columnar store from the records of facade_analysis.process_mask, e.g. as written by run_batch
+
+    Records that failed are left out. Records without window boxes (the projection engine, or results of before the boxes were recorded) only add their floors.
+
+    Args:
+    records (iterable): output of process_mask
+
+    Returns:
+    columns (dict): the arrays of ARRAY_NAMES, see pack_columns
+    """
+    identificatie, photo_dist, windows, window_facade, floors, floor_facade = [], [], [], [], [], []
+    for record in records:
+        if "error" in record:
+            continue
+        facade = len(identificatie)
+        identificatie.append(record["identificatie"])
+        photo_dist.append(record["photo_dist"])
+
+        cluster_df = pd.DataFrame(record["floors"], columns=CLUSTER_INFO_COLUMNS)
+        floors.append(_floor_array(cluster_df))
+        floor_facade.append(np.full(len(cluster_df), facade, dtype=np.int64))
+
+        boxes = np.asarray(record.get("windows") or [], dtype=np.float64).reshape(-1, 4)
+        facade_windows = np.zeros(len(boxes), dtype=WINDOW_DTYPE)
+        for i, field in enumerate(("x", "y", "width", "height")):
+            facade_windows[field] = boxes[:, i]
+        if len(boxes):
+            facade_windows["floor"] = _window_floors(len(boxes), np.zeros(len(cluster_df), dtype=np.int64), np.arange(len(cluster_df)),
+                cluster_df["indices"])
+        windows.append(facade_windows)
+        window_facade.append(np.full(len(boxes), facade, dtype=np.int64))
+
+    if not identificatie:
+        return pack_columns([], [], np.zeros(0, WINDOW_DTYPE), [], np.zeros(0, FLOOR_DTYPE), [])
+    return pack_columns(identificatie, photo_dist, np.concatenate(windows), np.concatenate(window_facade),
+        np.concatenate(floors), np.concatenate(floor_facade))
+
+def columns_from_batch(results_path=BATCH_RESULTS_PATH):
+    """build the columnar store from the JSON lines file of facade_analysis.run_batch, see columns_from_records"""
+    with open(results_path) as results_file:
+        return columns_from_records(json.loads(line) for line in results_file)
+
+
+# saving and loading
+
+def _aligned(offset):
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+def save_columns(columns, path=COLUMNS_PATH):
+    """write the arrays of a store to a single file that load_columns maps into memory
+
+    The file holds a JSON header with the dtype, shape and position of every array, followed by the raw arrays. It is written next to its destination and moved in place, so a reader never sees half a file.
+
+    Args:
+    columns (dict): the arrays of ARRAY_NAMES
+    path (string): location of the file
+    """
+    arrays = [np.ascontiguousarray(columns[name]) for name in ARRAY_NAMES]
+    entries = []
+    offset = 0
+    for name, array in zip(ARRAY_NAMES, arrays):
+        entries.append({"name": name, "descr": np.lib.format.dtype_to_descr(array.dtype), "shape": list(array.shape), "offset": offset})
+        offset = _aligned(offset + array.nbytes)
+    header = json.dumps({"arrays": entries}).encode("utf-8")
+    data_start = _aligned(len(MAGIC) + 8 + len(header))
+
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = path + ".tmp"
+    with open(temp_path, "wb") as output:
+        output.write(MAGIC)
+        output.write(len(header).to_bytes(8, "little"))
+        output.write(header)
+        for entry, array in zip(entries, arrays):
+            output.seek(data_start + entry["offset"])
+            output.write(array.tobytes())
+    os.replace(temp_path, path)
+
+def load_columns(path=COLUMNS_PATH):
+    """map a store written by save_columns into memory, without reading the arrays
+
+    All arrays are read-only views on one memory map, so loading costs the same for any number of facades, and the pages are shared between the processes that map the same file.
+
+    Args:
+    path (string): location of the file
+
+    Returns:
+    columns (FacadeColumns): the store
+    """
+    with open(path, "rb") as input_file:
+        magic = input_file.read(len(MAGIC))
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a facade columns file")
+        header_length = int.from_bytes(input_file.read(8), "little")
+        header = json.loads(input_file.read(header_length))
+    data_start = _aligned(len(MAGIC) + 8 + header_length)
+
+    buffer = np.memmap(path, dtype=np.uint8, mode="r")
+    arrays = {}
+    for entry in header["arrays"]:
+        dtype = np.lib.format.descr_to_dtype(entry["descr"])
+        count = int(np.prod(entry["shape"], dtype=np.int64))
+        start = data_start + entry["offset"]
+        arrays[entry["name"]] = buffer[start:start + count * dtype.itemsize].view(dtype).reshape(entry["shape"])
+    return FacadeColumns(arrays)
+
+
+# querying
+
+class FacadeColumns:
+    """windows and floors of all facades, indexed by building
+
+    Args:
+    columns (dict): the arrays of ARRAY_NAMES, from pack_columns or load_columns
+    """
+    def __init__(self, columns):
+        for name in ARRAY_NAMES:
+            setattr(self, name, columns[name])
+
+    def __len__(self):
+        return len(self.building_ids)
+
+    def building_index(self, identificatie):
+        """find the position of every building in a list, -1 for buildings that are not in the store"""
+        keys = np.atleast_1d(np.asarray(identificatie, dtype="S16"))
+        index = np.searchsorted(self.building_ids, keys)
+        found = index < len(self.building_ids)
+        found[found] = self.building_ids[index[found]] == keys[found]
+        return np.where(found, index, -1)
+
+    def building(self, identificatie):
+        """the facades, windows and floors of one building, as views on the store without copying
+
+        Args:
+        identificatie (string): BAG identificatie of the building
+
+        Returns:
+        facades (array): the facades of the building, of FACADE_DTYPE
+        windows (array): their windows, of WINDOW_DTYPE, facade after facade
+        floors (array): their floors, of FLOOR_DTYPE, facade after facade
+
+        Raises:
+        KeyError: if the building is not in the store
+        """
+        index = int(self.building_index([identificatie])[0])
+        if index < 0:
+            raise KeyError(identificatie)
+        first, last = self.building_offsets[index], self.building_offsets[index + 1]
+        return (self.facades[first:last],
+            self.windows[self.window_offsets[first]:self.window_offsets[last]],
+            self.floors[self.floor_offsets[first]:self.floor_offsets[last]])
+
+    def floor_facade(self):
+        """the facade of every floor, as an index into facades"""
+        return np.repeat(np.arange(len(self.facades)), np.diff(self.floor_offsets))
+
+    def facade_building(self):
+        """the building of every facade, as an index into building_ids"""
+        return np.repeat(np.arange(len(self.building_ids)), np.diff(self.building_offsets))
+
+    def facade_wwr(self):
+        """the WWR of every facade: the window area of all its floors over their wall area
+
+        Returns:
+        WWR (array): one value per facade, NaN for facades without floors
+        """
+        floor_facade = self.floor_facade()
+        window_area = np.bincount(floor_facade, weights=self.floors["window_area_sum"], minlength=len(self.facades))
+        wall_area = np.bincount(floor_facade, weights=self.floors["wall_area"], minlength=len(self.facades))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.where(wall_area > 0, window_area / wall_area, np.nan)
+
+    def building_values(self, values):
+        """align a value per building, e.g. its BAG height, with the buildings of the store
+
+        Args:
+        values (Series): values indexed by identificatie; IDs without their leading zero are padded to 16 digits
+
+        Returns:
+        aligned (array): the value of every building in building_ids, NaN where it is missing
+        """
+        keys = np.asarray(values.index.astype(str).str.zfill(16), dtype="S16")
+        order = np.argsort(keys, kind="stable")
+        keys = keys[order]
+        index = np.searchsorted(keys, self.building_ids)
+        found = index < len(keys)
+        found[found] = keys[index[found]] == self.building_ids[found]
+        aligned = np.full(len(self.building_ids), np.nan)
+        aligned[found] = values.to_numpy(dtype=np.float64)[order][index[found]]
+        return aligned
+
+
+def wwr_by_height_class(columns, heights, bins=HEIGHT_CLASSES, wwr_bins=WWR_BINS):
+    """summarise the WWR of the facades per BAG height class of their building, for the whole store at once
+
+    Args:
+    columns (FacadeColumns): the store
+    heights (Series): height of every building in metres, indexed by identificatie, e.g. from gis_layers.read_building_heights
+    bins (list): increasing bounds of the height classes
+    wwr_bins (list): increasing bounds of the WWR histogram
+
+    Returns:
+    summary_df (DataFrame): per height class the number of buildings and facades, the mean and quartiles of the facade WWR, and the number of facades per WWR bin
+    """
+    facade_building = columns.facade_building()
+    facade_height = columns.building_values(heights)[facade_building]
+    WWR = columns.facade_wwr()
+    valid = ~np.isnan(facade_height) & ~np.isnan(WWR)
+
+    height_class = np.digitize(facade_height[valid], bins) - 1
+    WWR = WWR[valid]
+    class_count = len(bins) - 1
+    in_range = (height_class >= 0) & (height_class < class_count)
+    height_class, WWR, facade_building = height_class[in_range], WWR[in_range], facade_building[valid][in_range]
+
+    # sort once by class and WWR, so every class is a slice and its quantiles are positions in that slice
+    order = np.lexsort((WWR, height_class))
+    height_class, WWR, facade_building = height_class[order], WWR[order], facade_building[order]
+    class_offsets = np.searchsorted(height_class, np.arange(class_count + 1))
+    histogram = np.zeros((class_count, len(wwr_bins) - 1), dtype=np.int64)
+    np.add.at(histogram, (height_class, np.clip(np.digitize(WWR, wwr_bins) - 1, 0, len(wwr_bins) - 2)), 1)
+
+    rows = []
+    for i in range(class_count):
+        class_WWR = WWR[class_offsets[i]:class_offsets[i + 1]]
+        quartiles = np.quantile(class_WWR, [0.25, 0.5, 0.75]) if len(class_WWR) else [np.nan] * 3
+        rows.append({
+            "height_class": f"{bins[i]:g}-{bins[i + 1]:g} m",
+            "buildings": len(np.unique(facade_building[class_offsets[i]:class_offsets[i + 1]])),
+            "facades": len(class_WWR),
+            "WWR_mean": class_WWR.mean() if len(class_WWR) else np.nan,
+            "WWR_q25": quartiles[0],
+            "WWR_median": quartiles[1],
+            "WWR_q75": quartiles[2],
+        })
+    summary_df = pd.DataFrame(rows)
+    for j in range(len(wwr_bins) - 1):
+        summary_df[f"WWR_{wwr_bins[j]:.2g}-{wwr_bins[j + 1]:.2g}"] = histogram[:, j]
+    return summary_df
+
+
+if __name__ == "__main__":
+    columns = columns_from_batch() if os.path.exists(BATCH_RESULTS_PATH) else columns_from_annotations()
+    save_columns(columns)
+    print(f"{len(columns['building_ids'])} buildings, {len(columns['facades'])} facades, "
+        f"{len(columns['windows'])} windows, {len(columns['floors'])} floors")
@@ -0,0 +1,325 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+
+import numpy as np
+import pandas as pd
+
+from facade_analysis import (TRAIN_MASK_DIR, VAL_MASK_DIR, DEBUG_DIR, ENGINES, CLUSTER_INFO_COLUMNS, iter_batch, list_masks,
+    _to_builtin)
+
+
+# results store
+
+RESULTS_DB_PATH = './data/facade_data/facade_results.sqlite'
+
+# part of the pipeline parameters; increase it when the window or floor extraction changes, so every mask is processed again
+PIPELINE_VERSION = 1
+
+# floors of a facade are stored per row; indices and boundary are JSON lists
+FLOOR_COLUMNS = ["identificatie", "photo_dist", "content_hash", "floor_index"] + CLUSTER_INFO_COLUMNS
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS manifest (
+    mask_path TEXT PRIMARY KEY,
+    identificatie TEXT NOT NULL,
+    photo_dist TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    content_hash TEXT NOT NULL,
+    params_hash TEXT NOT NULL,
+    processed_at REAL NOT NULL,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS manifest_facade ON manifest (identificatie, photo_dist);
+CREATE TABLE IF NOT EXISTS facades (
+    identificatie TEXT NOT NULL,
+    photo_dist TEXT NOT NULL,
+    split TEXT,
+    file_name TEXT,
+    engine TEXT,
+    content_hash TEXT NOT NULL,
+    params_hash TEXT,
+    class_pixels TEXT,
+    PRIMARY KEY (identificatie, photo_dist, content_hash)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS floors (
+    identificatie TEXT NOT NULL,
+    photo_dist TEXT NOT NULL,
+    content_hash TEXT NOT NULL,
+    floor_index INTEGER NOT NULL,
+    window_count INTEGER,
+    indices TEXT,
+    boundary TEXT,
+    avg_win_height REAL,
+    floor_level REAL,
+    roof_level REAL,
+    floor_height REAL,
+    avg_sill_height REAL,
+    window_area_sum REAL,
+    wall_area REAL,
+    WWR REAL,
+    PRIMARY KEY (identificatie, photo_dist, content_hash, floor_index)
+) WITHOUT ROWID;
+"""
+
+
+def connect(db_path=RESULTS_DB_PATH):
+    """open the results store, creating its tables if they do not exist yet
+
+    The store uses write-ahead logging, so the Hops server can keep reading while a rerun writes. Stores of before the results were keyed on the content of the masks are emptied, so every mask is processed again.
+
+    Args:
+    db_path (string): location of the SQLite file
+
+    Returns:
+    conn (Connection): connection to the store
+    """
+    if os.path.dirname(db_path):
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+    conn = sqlite3.connect(db_path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    floor_columns = [row[1] for row in conn.execute("PRAGMA table_info(floors)")]
+    if floor_columns and "content_hash" not in floor_columns:
+        conn.executescript("DROP TABLE floors; DROP TABLE facades; DROP TABLE manifest;")
+    conn.executescript(SCHEMA)
+    return conn
+
+def file_sha256(file_name, chunk_size=2**20):
+    """calculate the SHA-256 hash of a file, reading it in chunks"""
+    file_hash = hashlib.sha256()
+    with open(file_name, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+def pipeline_params(engine="contours"):
+    """collect the parameters that change the output of the floor extraction
+
+    Args:
+    engine (string): floor detection engine, one of ENGINES
+
+    Returns:
+    params (dict): engine and PIPELINE_VERSION
+    """
+    return {"engine": engine, "pipeline_version": PIPELINE_VERSION}
+
+def params_sha256(params):
+    return hashlib.sha256(json.dumps(params, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+# incremental processing
+
+def plan_update(conn, mask_paths, params_hash):
+    """compare the masks on disk with the manifest and decide which need to be processed
+
+    A mask of which the size and modification time did not change is trusted to be unchanged without reading it. Otherwise its content is hashed, so a mask that was only touched or copied is not processed again.
+
+    Args:
+    conn (Connection): connection to the store
+    mask_paths (list): locations of the facade masks
+    params_hash (string): hash of the pipeline parameters of this run
+
+    Returns:
+    todo (list): (mask_path, size, mtime_ns, content_hash) of every mask to process
+    unchanged (int): number of masks that are up to date
+    removed (list): masks in the manifest that are not in mask_paths (absolute paths)
+    """
+    manifest = {row[0]: row[1:] for row in conn.execute("SELECT mask_path, size, mtime_ns, content_hash, params_hash FROM manifest")}
+    todo = []
+    unchanged = 0
+    touched = []
+    for mask_path in mask_paths:
+        stat = os.stat(mask_path)
+        entry = manifest.pop(os.path.abspath(mask_path), None)
+        if entry is not None and entry[:2] == (stat.st_size, stat.st_mtime_ns) and entry[3] == params_hash:
+            unchanged += 1
+            continue
+        content_hash = file_sha256(mask_path)
+        if entry is not None and entry[2] == content_hash and entry[3] == params_hash:
+            touched.append((stat.st_size, stat.st_mtime_ns, os.path.abspath(mask_path)))
+            unchanged += 1
+            continue
+        todo.append((mask_path, stat.st_size, stat.st_mtime_ns, content_hash))
+
+    if touched:
+        with conn:
+            conn.executemany("UPDATE manifest SET size = ?, mtime_ns = ? WHERE mask_path = ?", touched)
+    return todo, unchanged, list(manifest)
+
+def _floor_values(floor):
+    # sqlite3 only takes builtin numbers, the lists are stored as JSON
+    values = []
+    for column in CLUSTER_INFO_COLUMNS:
+        value = floor[column]
+        if column in ("indices", "boundary"):
+            value = json.dumps(value, default=_to_builtin)
+        elif isinstance(value, np.generic):
+            value = value.item()
+        values.append(value)
+    return tuple(values)
+
+def _drop_unused_results(conn, key):
+    # the results of a mask content are kept as long as a mask with that content is in the manifest
+    if conn.execute("SELECT 1 FROM manifest WHERE identificatie = ? AND photo_dist = ? AND content_hash = ?", key).fetchone() is None:
+        conn.execute("DELETE FROM floors WHERE identificatie = ? AND photo_dist = ? AND content_hash = ?", key)
+        conn.execute("DELETE FROM facades WHERE identificatie = ? AND photo_dist = ? AND content_hash = ?", key)
+
+def store_record(conn, record, mask_path, size, mtime_ns, content_hash, params_hash):
+    """replace the results of one facade in the store and record its inputs in the manifest
+
+    The results are stored per mask content. Copies of the same mask (e.g. in train_mask and val_mask) share their results, while copies that differ keep their own, so one copy that fails or changes does not touch the results of the others.
+
+    Args:
+    conn (Connection): connection to the store, the caller commits
+    record (dict): output of facade_analysis.process_mask
+    mask_path (string): location of the facade mask
+    size (int): size of the mask file in bytes
+    mtime_ns (int): modification time of the mask file
+    content_hash (string): SHA-256 hash of the mask file
+    params_hash (string): hash of the pipeline parameters
+    """
+    mask_path = os.path.abspath(mask_path)
+    previous = conn.execute("SELECT identificatie, photo_dist, content_hash FROM manifest WHERE mask_path = ?", (mask_path,)).fetchone()
+    # masks of which the name could not be parsed are kept in the manifest with empty IDs, so they are not tried again until they change
+    key = (record["identificatie"] or "", record["photo_dist"] or "", content_hash)
+    conn.execute("DELETE FROM floors WHERE identificatie = ? AND photo_dist = ? AND content_hash = ?", key)
+    if "error" in record:
+        conn.execute("DELETE FROM facades WHERE identificatie = ? AND photo_dist = ? AND content_hash = ?", key)
+    else:
+        conn.execute("INSERT OR REPLACE INTO facades VALUES (?, ?, ?, ?, ?, ?, ?, ?)", key[:2] + (record["split"], record["file_name"],
+            record["engine"], content_hash, params_hash, json.dumps(record["class_pixels"], default=_to_builtin)))
+        conn.executemany(f"INSERT INTO floors VALUES ({', '.join('?' * len(FLOOR_COLUMNS))})",
+            [key + (floor_index,) + _floor_values(floor) for floor_index, floor in enumerate(record["floors"])])
+    conn.execute("INSERT OR REPLACE INTO manifest VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", (mask_path,) + key[:2]
+        + (size, mtime_ns, content_hash, params_hash, time.time(), record.get("error")))
+    if previous is not None and tuple(previous) != key:
+        _drop_unused_results(conn, tuple(previous))
+
+def remove_masks(conn, mask_paths):
+    """delete masks that no longer exist from the manifest, together with their results
+
+    The same mask can be in more than one folder (e.g. in train_mask and val_mask); the results are kept as long as a copy with the same content remains.
+
+    Args:
+    conn (Connection): connection to the store
+    mask_paths (list): absolute locations of the removed masks
+    """
+    with conn:
+        for mask_path in mask_paths:
+            row = conn.execute("SELECT identificatie, photo_dist, content_hash FROM manifest WHERE mask_path = ?", (mask_path,)).fetchone()
+            conn.execute("DELETE FROM manifest WHERE mask_path = ?", (mask_path,))
+            if row is not None:
+                _drop_unused_results(conn, tuple(row))
+
+def update_store(mask_dirs=(TRAIN_MASK_DIR, VAL_MASK_DIR), db_path=RESULTS_DB_PATH, workers=None, chunksize=4,
+        debug_dir=DEBUG_DIR, debug_sample_rate=0.0, engine="contours", commit_every=256):
+    """process only the facade masks that are new or changed, or of which the pipeline parameters changed, and store their floors
+
+    Masks that failed are recorded in the manifest with their error as well, so they are only tried again when they or the parameters change. Masks that were deleted from the folders are removed from the store.
+
+    Args:
+    mask_dirs (list): locations of the facade masks
+    db_path (string): location of the SQLite file
+    workers (int): number of worker processes, defaults to the number of cores
+    chunksize (int): number of masks that is sent to a worker at once
+    debug_dir (string): folder for the debug overlays
+    debug_sample_rate (float): fraction of the processed facades that get debug overlays, 0 disables them
+    engine (string): floor detection engine, one of ENGINES
+    commit_every (int): number of facades per transaction, so an interrupted run keeps most of its work
+
+    Returns:
+    counts (dict): number of masks "processed", "failed", "unchanged" and "removed"
+    """
+    if engine not in ENGINES:
+        raise ValueError(f"unknown engine {engine!r}, choose one of {ENGINES}")
+    params_hash = params_sha256(pipeline_params(engine))
+    conn = connect(db_path)
+    try:
+        mask_paths = list_masks(mask_dirs)
+        todo, unchanged, removed = plan_update(conn, mask_paths, params_hash)
+        # only masks of the folders of this run are removed, a run over a single folder keeps the others
+        scanned_dirs = {os.path.abspath(mask_dir) for mask_dir in mask_dirs}
+        removed = [mask_path for mask_path in removed if os.path.dirname(mask_path) in scanned_dirs]
+        remove_masks(conn, removed)
+
+        inputs = {mask_path: (size, mtime_ns, content_hash) for mask_path, size, mtime_ns, content_hash in todo}
+        # records come back in order of completion, their mask is found again by split and file name
+        by_name = {(os.path.basename(os.path.dirname(mask_path)), os.path.basename(mask_path)): mask_path for mask_path in inputs}
+        processed = 0
+        failed = 0
+        pending = 0
+        for record in iter_batch(list(inputs), workers=workers, chunksize=chunksize, debug_dir=debug_dir,
+                debug_sample_rate=debug_sample_rate, engine=engine):
+            mask_path = by_name[(record["split"], record["file_name"])]
+            store_record(conn, record, mask_path, *inputs[mask_path], params_hash)
+            if "error" in record:
+                failed += 1
+            else:
+                processed += 1
+            pending += 1
+            if pending >= commit_every:
+                conn.commit()
+                pending = 0
+        conn.commit()
+    finally:
+        conn.close()
+    return {"processed": processed, "failed": failed, "unchanged": unchanged, "removed": len(removed)}
+
+
+# queries
+
+# floors with the file name of their facade
+FLOORS_QUERY = "SELECT floors.*, facades.file_name FROM floors JOIN facades USING (identificatie, photo_dist, content_hash)"
+
+def _floors_df(rows):
+    floors_df = pd.DataFrame(rows, columns=FLOOR_COLUMNS + ["file_name"])
+    for column in ("indices", "boundary"):
+        floors_df[column] = [json.loads(value) for value in floors_df[column]]
+    return floors_df
+
+def building_floors(identificatie, db_path=RESULTS_DB_PATH, chunk_size=500):
+    """read the floors of all facades of one or more buildings, with lookups in the primary key instead of a scan
+
+    Args:
+    identificatie (string or list): BAG identificatie of the building, or a list of them that is looked up in batches of chunk_size
+    db_path (string): location of the SQLite file
+    chunk_size (int): number of IDs per query
+
+    Returns:
+    floors_df (DataFrame): identificatie, photo_dist, content_hash, floor_index, the columns of get_cluster_info and the file_name of the facade, one row per floor; copies of a facade that differ in content each have their own floors
+    """
+    IDs = [str(identificatie)] if isinstance(identificatie, str) else [str(ID) for ID in identificatie]
+    rows = []
+    conn = sqlite3.connect(db_path)
+    try:
+        for start in range(0, len(IDs), chunk_size):
+            chunk = IDs[start:start + chunk_size]
+            rows += conn.execute(FLOORS_QUERY + f" WHERE floors.identificatie IN ({', '.join('?' * len(chunk))})"
+                " ORDER BY floors.identificatie, floors.photo_dist, floors.content_hash, floors.floor_index", chunk).fetchall()
+    finally:
+        conn.close()
+    return _floors_df(rows)
+
+def read_floors(db_path=RESULTS_DB_PATH):
+    """read the floors of all facades in the store, e.g. to export them to a CSV file
+
+    Args:
+    db_path (string): location of the SQLite file
+
+    Returns:
+    floors_df (DataFrame): one row per floor of every facade, see building_floors
+    """
+    conn = sqlite3.connect(db_path)
+    try:
+        rows = conn.execute(FLOORS_QUERY + " ORDER BY floors.identificatie, floors.photo_dist, floors.content_hash, floors.floor_index").fetchall()
+    finally:
+        conn.close()
+    return _floors_df(rows)
+
+
+if __name__ == "__main__":
+    counts = update_store()
+    print(", ".join(f"{count} {name}" for name, count in counts.items()))
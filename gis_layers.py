@@ -0,0 +1,371 @@
+import os
+import io
+import sys
+import json
+import threading
+from collections import OrderedDict
+
+import flatgeobuf as fgb
+import geopandas as gpd
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyogrio
+
+
+# layers that are converted to indexed FlatGeobuf files by convert_layers
+
+SOURCE_LAYERS = [
+    './data/joined_gdf.geojson',
+    './data/Eijgenstein/BAG WWR Dang and Eijgenstein/BAG_wwr.shp',
+    './data/roadnetwork_ams_centre.shp',
+]
+FGB_DIR = './data/fgb'
+
+# BAG buildings and the IDs of the buildings in the facade dataset, joined by filter_BAG
+BAG_PATH = './data/baglod12citycentre.geojson'
+IDS_CSV_PATH = './data/list_IDs.csv'
+JOINED_PATH = './data/joined_gdf.geojson'
+
+
+# reading GIS layers
+
+def feature_point(geometry):
+    """reduce a GeoJSON geometry to a single point
+
+    Points are returned as they are, other geometries are represented by the average of the vertices of their first part (the exterior ring for polygons).
+
+    Args:
+    geometry (dict): GeoJSON geometry
+
+    Returns:
+    point (tuple): x, y, z coordinates, z is 0 if the geometry is 2D
+    """
+    coordinates = geometry["coordinates"]
+    geometry_type = geometry["type"]
+    if geometry_type == "Point":
+        vertices = [coordinates]
+    elif geometry_type in ("MultiPoint", "LineString"):
+        vertices = coordinates
+    elif geometry_type in ("Polygon", "MultiLineString"):
+        vertices = coordinates[0]
+    elif geometry_type == "MultiPolygon":
+        vertices = coordinates[0][0]
+    else:
+        raise ValueError(f"unsupported geometry type {geometry_type}")
+
+    # a closed ring repeats its first vertex, which should not be counted twice
+    if len(vertices) > 1 and vertices[0] == vertices[-1]:
+        vertices = vertices[:-1]
+    x = sum(vertex[0] for vertex in vertices) / len(vertices)
+    y = sum(vertex[1] for vertex in vertices) / len(vertices)
+    z = sum(vertex[2] if len(vertex) > 2 else 0.0 for vertex in vertices) / len(vertices)
+    return (x, y, z)
+
+def read_geojson_points(filepath):
+    """read a GeoJSON file and keep only one point and the attributes of every feature
+
+    Args:
+    filepath (string): location of the GeoJSON file
+
+    Returns:
+    layer (dict): "points" (list of x, y, z tuples) and "properties" (list of attribute dicts), one entry per feature with a geometry
+    """
+    with open(filepath) as json_file:
+        data = json.load(json_file)
+
+    points = []
+    properties = []
+    for feature in data["features"]:
+        if not feature.get("geometry"):
+            continue
+        points.append(feature_point(feature["geometry"]))
+        properties.append(feature.get("properties") or {})
+    return {"points": points, "properties": properties}
+
+def filter_points(layer, attribute=None, value=None):
+    """select the points of the features of which an attribute has a given value
+
+    Args:
+    layer (dict): output of read_geojson_points
+    attribute (string): name of the attribute, all points are returned if this is empty
+    value (string): value to compare with, compared as text so it can be typed in Grasshopper
+
+    Returns:
+    points (list): x, y, z tuples of the matching features
+    """
+    if not attribute:
+        return layer["points"]
+    return [point for point, feature_properties in zip(layer["points"], layer["properties"])
+        if str(feature_properties.get(attribute)) == str(value)]
+
+def group_points(layer, attribute, values):
+    """select the points of the features for many values of an attribute at once, in a single pass over the features
+
+    Args:
+    layer (dict): output of read_geojson_points
+    attribute (string): name of the attribute
+    values (list): values to compare with, compared as text
+
+    Returns:
+    groups (list): for every value, the x, y, z tuples of the matching features
+    """
+    by_value = {str(value): [] for value in values}
+    for point, feature_properties in zip(layer["points"], layer["properties"]):
+        group = by_value.get(str(feature_properties.get(attribute)))
+        if group is not None:
+            group.append(point)
+    return [by_value[str(value)] for value in values]
+
+
+# joining the BAG with the facade dataset
+
+def read_facade_IDs(IDs_csv_path=IDS_CSV_PATH):
+    """read the IDs of the buildings in the facade dataset, as the keys used to join them with the BAG
+
+    Args:
+    IDs_csv_path (string): location of the CSV file with identificatie and photo_dist
+
+    Returns:
+    IDs_pdf (DataFrame): identificatie (string) and photo_dist of every facade
+    """
+    IDs_pdf = pd.read_csv(IDs_csv_path)
+    IDs_pdf["identificatie"] = IDs_pdf["identificatie"].astype(str)
+    return IDs_pdf
+
+def read_building_heights(joined_path=JOINED_PATH, column="b3_h_70p"):
+    """read one height per building from the BAG attributes of the facade buildings, without reading the geometry
+
+    Args:
+    joined_path (string): location of the output of filter_BAG
+    column (string): 3D BAG height attribute, e.g. "b3_h_70p" or "b3_h_max"
+
+    Returns:
+    heights (Series): height in metres, indexed by identificatie padded to its 16 digits
+    """
+    heights_df = pyogrio.read_dataframe(joined_path, columns=["identificatie", column], read_geometry=False)
+    heights_df["identificatie"] = heights_df["identificatie"].astype(str).str.zfill(16)
+    return heights_df.groupby("identificatie")[column].first()
+
+def iter_BAG_matches(bag_path, IDs, batch_size=65536):
+    """stream the BAG buildings in batches and keep only those of which the ID is in a set of IDs
+
+    Only one batch of the BAG is in memory at a time, so this also works for BAG extracts that are larger than memory.
+
+    Args:
+    bag_path (string): location of the BAG file, any format GDAL can read (GeoJSON, GeoPackage, FlatGeobuf, ...)
+    IDs (iterable): building IDs to keep, the last 15 characters of the BAG identificatie (without "NL.IMBAG.Pand.")
+    batch_size (int): number of BAG features per batch
+
+    Yields:
+    matches (GeoDataFrame): the matching buildings of one batch, with the shortened identificatie
+    """
+    ID_set = pa.array(sorted(set(IDs)), type=pa.string())
+    with pyogrio.open_arrow(bag_path, batch_size=batch_size, use_pyarrow=True) as (meta, reader):
+        geometry_name = meta["geometry_name"] or "wkb_geometry"
+        for batch in reader:
+            identificatie = pc.utf8_slice_codeunits(batch.column("identificatie").cast(pa.string()), -15)
+            is_match = pc.is_in(identificatie, value_set=ID_set)
+            if not pc.any(is_match).as_py():
+                continue
+
+            batch = batch.filter(is_match)
+            batch = batch.set_column(batch.schema.get_field_index("identificatie"), "identificatie", pc.filter(identificatie, is_match))
+            matches = batch.to_pandas()
+            geometry = gpd.GeoSeries.from_wkb(matches.pop(geometry_name), crs=meta["crs"])
+            yield gpd.GeoDataFrame(matches, geometry=geometry)
+
+def filter_BAG(bag_path=BAG_PATH, IDs_csv_path=IDS_CSV_PATH, output_path=JOINED_PATH, batch_size=65536, formats=("geojson", "parquet", "fgb")):
+    """select the BAG buildings that are in the facade dataset, for visualisation in QGIS and the Hops components
+
+    The facade IDs are read first, after which the BAG is streamed in batches and only the matching buildings are kept. The result is written as GeoJSON and in the binary GeoParquet and (spatially indexed) FlatGeobuf formats, which load much faster.
+
+    Args:
+    bag_path (string): location of the BAG file
+    IDs_csv_path (string): location of the CSV file with the IDs of the facade dataset
+    output_path (string): location of the GeoJSON file, the other formats are written next to it with their own extension
+    batch_size (int): number of BAG features that are read at a time
+    formats (list): output formats, any of "geojson", "parquet" and "fgb"
+
+    Returns:
+    output_paths (list): locations of the files that were written
+    """
+    IDs_pdf = read_facade_IDs(IDs_csv_path)
+    matches = list(iter_BAG_matches(bag_path, IDs_pdf["identificatie"], batch_size))
+    if matches:
+        BAG_gdf = pd.concat(matches, ignore_index=True)
+    else:
+        BAG_gdf = gpd.GeoDataFrame(columns=["identificatie", "geometry"], geometry="geometry", crs=pyogrio.read_info(bag_path)["crs"])
+    joined_gdf = BAG_gdf.merge(IDs_pdf, on="identificatie")
+
+    base_path = os.path.splitext(output_path)[0]
+    output_paths = []
+    if "geojson" in formats:
+        joined_gdf.to_file(base_path + ".geojson", driver="GeoJSON")
+        output_paths.append(base_path + ".geojson")
+    if "parquet" in formats:
+        joined_gdf.to_parquet(base_path + ".parquet")
+        output_paths.append(base_path + ".parquet")
+    if "fgb" in formats:
+        joined_gdf.to_file(base_path + ".fgb", driver="FlatGeobuf", SPATIAL_INDEX="YES")
+        output_paths.append(base_path + ".fgb")
+    return output_paths
+
+
+# FlatGeobuf files with a spatial index
+
+def convert_to_fgb(source_path, fgb_path=None):
+    """convert a GeoJSON file or shapefile to a FlatGeobuf file with a packed Hilbert R-tree index
+
+    Args:
+    source_path (string): location of the GeoJSON file or shapefile
+    fgb_path (string): location of the FlatGeobuf file, defaults to the source location with the .fgb extension
+
+    Returns:
+    fgb_path (string): location of the FlatGeobuf file
+    """
+    if fgb_path is None:
+        fgb_path = os.path.splitext(source_path)[0] + ".fgb"
+    layer_gdf = gpd.read_file(source_path)
+    layer_gdf.to_file(fgb_path, driver="FlatGeobuf", SPATIAL_INDEX="YES")
+    return fgb_path
+
+def convert_layers(source_paths=SOURCE_LAYERS, fgb_dir=FGB_DIR):
+    """convert all GIS layers that are used in the Hops components to indexed FlatGeobuf files
+
+    Args:
+    source_paths (list): locations of the GeoJSON files and shapefiles, missing files are skipped
+    fgb_dir (string): folder for the FlatGeobuf files
+
+    Returns:
+    fgb_paths (list): locations of the FlatGeobuf files that were written
+    """
+    os.makedirs(fgb_dir, exist_ok=True)
+    fgb_paths = []
+    for source_path in source_paths:
+        if not os.path.exists(source_path):
+            continue
+        file_name = os.path.splitext(os.path.basename(source_path))[0] + ".fgb"
+        fgb_paths.append(convert_to_fgb(source_path, os.path.join(fgb_dir, file_name)))
+    return fgb_paths
+
+def corners_to_bbox(corners):
+    """translate corner points (e.g. the four corners of a rectangle, or the eight corners of a box) to a 2D bounding box
+
+    Args:
+    corners (list): points with x and y coordinates, as tuples or rhino3dm.Point3d
+
+    Returns:
+    bbox (tuple): min x, min y, max x, max y
+    """
+    xs = [corner[0] if isinstance(corner, (tuple, list)) else corner.X for corner in corners]
+    ys = [corner[1] if isinstance(corner, (tuple, list)) else corner.Y for corner in corners]
+    return (min(xs), min(ys), max(xs), max(ys))
+
+def read_bytes(filepath):
+    """read a whole file into memory, e.g. a FlatGeobuf file that is queried often, as a loader for layer_cache"""
+    with open(filepath, "rb") as source_file:
+        return source_file.read()
+
+def query_fgb(fgb_path, bbox):
+    """read only the features of a FlatGeobuf file that intersect a bounding box
+
+    The spatial index of the file is searched first, so only the byte ranges of the matching features are read.
+
+    Args:
+    fgb_path (string or bytes): location of the FlatGeobuf file, or its contents as read by read_bytes
+    bbox (tuple): min x, min y, max x, max y, in the coordinate system of the file
+
+    Returns:
+    features (list): GeoJSON features that intersect the bounding box
+    """
+    if isinstance(fgb_path, (bytes, bytearray, memoryview)):
+        return list(fgb.Reader(io.BytesIO(fgb_path), bbox=tuple(bbox)))
+    with open(fgb_path, "rb") as fgb_file:
+        return list(fgb.Reader(fgb_file, bbox=tuple(bbox)))
+
+
+# caching
+
+def layer_nbytes(layer):
+    """estimate the memory of a parsed layer, following its containers and counting every object once
+
+    Parsed layers take many times the size of their file (e.g. a float in a Python list takes 32 bytes, against a few characters in the JSON file), so the size of the file is no measure of their memory. Arrays and data frames report the size of their own buffers.
+
+    Args:
+    layer (object): output of a loader, e.g. bytes, or dicts and lists of numbers and strings
+
+    Returns:
+    nbytes (int): estimated size in bytes
+    """
+    seen = set()
+    pending = [layer]
+    nbytes = 0
+    while pending:
+        obj = pending.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        if isinstance(obj, (pd.DataFrame, pd.Series)):
+            usage = obj.memory_usage(deep=True)
+            nbytes += int(usage.sum()) if isinstance(obj, pd.DataFrame) else int(usage)
+            continue
+        nbytes += int(getattr(obj, "nbytes", 0)) or sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            pending.extend(obj.keys())
+            pending.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            pending.extend(obj)
+    return nbytes
+
+class LayerCache:
+    """LRU cache for parsed GIS layers, keyed on the path of the file and the loader, and checked against the modification time of the file
+
+    The same file can be cached once per loader, e.g. as raw bytes and as parsed points. A layer is parsed again as soon as its file changes on disk. The size of a layer is estimated from the parsed objects with layer_nbytes, and the least recently used layers are evicted when the total exceeds max_bytes.
+
+    Args:
+    max_bytes (int): memory cap for all cached layers together
+    """
+    def __init__(self, max_bytes=256 * 2**20):
+        self.max_bytes = max_bytes
+        self._layers = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, filepath, loader):
+        """return the cached layer of a file, or load it with loader(filepath) if it is missing or outdated"""
+        path = os.path.abspath(filepath)
+        key = (path, loader)
+        stat = os.stat(path)
+        version = (stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            cached = self._layers.get(key)
+            if cached is not None and cached[0] == version:
+                self._layers.move_to_end(key)
+                return cached[1]
+
+        # parse and measure outside of the lock, so other layers can still be served
+        layer = loader(path)
+        size = layer_nbytes(layer)
+        with self._lock:
+            if key in self._layers:
+                self._bytes -= self._layers.pop(key)[2]
+            self._layers[key] = (version, layer, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes and len(self._layers) > 1:
+                _, (_, _, evicted_size) = self._layers.popitem(last=False)
+                self._bytes -= evicted_size
+        return layer
+
+    def clear(self):
+        with self._lock:
+            self._layers.clear()
+            self._bytes = 0
+
+
+layer_cache = LayerCache()
+
+
+if __name__ == "__main__":
+    for fgb_path in convert_layers():
+        print(fgb_path)
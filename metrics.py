@@ -0,0 +1,392 @@
+import os
+import glob
+import json
+import time
+import uuid
+import bisect
+import atexit
+import threading
+from functools import wraps
+from contextlib import contextmanager
+
+
+# latency buckets in seconds, from half a millisecond to a minute
+SECONDS_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# payload size buckets in bytes, from 1 KiB to 64 MiB
+BYTES_BUCKETS = tuple(2**power for power in range(10, 27, 2))
+
+# content type of the Prometheus text exposition format
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+# metric types
+
+def _format_labels(label_names, label_values, extra=""):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(label_names, label_values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Counter:
+    """monotonically increasing count, per combination of label values
+
+    Args:
+    name (string): name of the metric, ending in _total by convention
+    documentation (string): description shown in the HELP line
+    label_names (list): names of the labels, given as keyword arguments to inc
+    """
+    kind = "counter"
+
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels[name]) for name in self.label_names)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def snapshot(self):
+        """the values of every label combination, as JSON serialisable lists"""
+        with self._lock:
+            return [[list(key), value] for key, value in self._values.items()]
+
+    @staticmethod
+    def _merge_into(values, snapshot):
+        for key, value in snapshot:
+            key = tuple(key)
+            values[key] = values.get(key, 0) + value
+
+    def merge(self, snapshot):
+        """add the values of a snapshot, e.g. of another process"""
+        with self._lock:
+            self._merge_into(self._values, snapshot)
+
+    def samples(self, snapshots=()):
+        with self._lock:
+            values = dict(self._values)
+        for snapshot in snapshots:
+            self._merge_into(values, snapshot)
+        return [f"{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}" for key, value in values.items()]
+
+class Histogram:
+    """distribution of observed values over fixed buckets, per combination of label values
+
+    Every observation is one binary search and a few additions under a lock, so it can stay on in production.
+
+    Args:
+    name (string): name of the metric
+    documentation (string): description shown in the HELP line
+    label_names (list): names of the labels, given as keyword arguments to observe
+    buckets (list): increasing upper bounds of the buckets, the +Inf bucket is added
+    """
+    kind = "histogram"
+
+    def __init__(self, name, documentation, label_names=(), buckets=SECONDS_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels[name]) for name in self.label_names)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # counts per bucket (the last one is +Inf), sum and count
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def snapshot(self):
+        """the bucket counts, sum and count of every label combination, as JSON serialisable lists"""
+        with self._lock:
+            return [[list(key), list(counts), total, count] for key, (counts, total, count) in self._values.items()]
+
+    @staticmethod
+    def _merge_into(values, snapshot):
+        for key, counts, total, count in snapshot:
+            state = values.setdefault(tuple(key), [[0] * len(counts), 0.0, 0])
+            state[0] = [a + b for a, b in zip(state[0], counts)]
+            state[1] += total
+            state[2] += count
+
+    def merge(self, snapshot):
+        """add the observations of a snapshot, e.g. of another process"""
+        with self._lock:
+            self._merge_into(self._values, snapshot)
+
+    def samples(self, snapshots=()):
+        with self._lock:
+            values = {key: [list(counts), total, count] for key, (counts, total, count) in self._values.items()}
+        for snapshot in snapshots:
+            self._merge_into(values, snapshot)
+        lines = []
+        for key, (counts, total, count) in values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = _format_labels(self.label_names, key, f'le="{_format_value(float(bound))}"')
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            labels = _format_labels(self.label_names, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+class MetricsRegistry:
+    """collection of metrics that is rendered together for the /metrics route
+
+    Processes that serve the same app (e.g. gunicorn workers) can share their metrics through a folder, see share; every process then renders the sum of all of them.
+    """
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+        self._shared_path = None
+
+    def _register(self, metric):
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                if type(existing) is not type(metric) or existing.label_names != metric.label_names:
+                    raise ValueError(f"metric {metric.name} is already registered with other labels")
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name, documentation, label_names=()):
+        """create a counter, or return the one with the same name that is already registered"""
+        return self._register(Counter(name, documentation, label_names))
+
+    def histogram(self, name, documentation, label_names=(), buckets=SECONDS_BUCKETS):
+        """create a histogram, or return the one with the same name that is already registered"""
+        return self._register(Histogram(name, documentation, label_names, buckets))
+
+    def snapshot(self):
+        """the values of all metrics, e.g. to send them to another process
+
+        Returns:
+        snapshot (dict): JSON serialisable values per metric name
+        """
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return {metric.name: metric.snapshot() for metric in metrics}
+
+    def merge(self, snapshot):
+        """add the values of a snapshot of another process; metrics that are not registered here are skipped"""
+        for name, values in snapshot.items():
+            metric = self._metrics.get(name)
+            if metric is not None:
+                metric.merge(values)
+
+    def clear(self):
+        """forget all values, e.g. in a forked process that only reports what it records itself"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        for metric in metrics:
+            with metric._lock:
+                metric._values = {}
+
+    def render(self):
+        """write all metrics in the Prometheus text exposition format, summed with those of the processes it shares with
+
+        Returns:
+        text (string): HELP, TYPE and sample lines of every metric
+        """
+        with self._lock:
+            metrics = list(self._metrics.values())
+        shared = self._read_shared()
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {_escape(metric.documentation)}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples([snapshot[metric.name] for snapshot in shared if metric.name in snapshot]))
+        return "\n".join(lines) + "\n"
+
+    def share(self, directory, interval=1.0):
+        """share the metrics of this process with the other processes that share the same folder
+
+        A thread writes the snapshot of this process to its own file in the folder every interval seconds, and render adds the files of the other processes, so a scrape sees at most interval seconds old values of the other processes. Files of processes that exited are kept, so counters never go down when a worker is restarted; start every server with an empty folder. Call this in every process after it was forked, e.g. in the post_fork hook of gunicorn.
+
+        Args:
+        directory (string): folder that the processes share
+        interval (float): seconds between writes
+        """
+        os.makedirs(directory, exist_ok=True)
+        self._shared_path = os.path.join(directory, f"{os.getpid()}-{uuid.uuid4().hex}.json")
+
+        def write_periodically():
+            while self._shared_path is not None:
+                self._write_shared()
+                time.sleep(interval)
+
+        threading.Thread(target=write_periodically, name="metrics-share", daemon=True).start()
+        atexit.register(self._write_shared)
+
+    def _write_shared(self):
+        shared_path = self._shared_path
+        if shared_path is None:
+            return
+        with open(shared_path + ".tmp", "w") as shared_file:
+            json.dump(self.snapshot(), shared_file)
+        os.replace(shared_path + ".tmp", shared_path)
+
+    def _read_shared(self):
+        shared_path = self._shared_path
+        if shared_path is None:
+            return []
+        snapshots = []
+        for path in glob.glob(os.path.join(os.path.dirname(shared_path), "*.json")):
+            if path == shared_path:
+                continue
+            try:
+                with open(path) as shared_file:
+                    snapshots.append(json.load(shared_file))
+            except (OSError, ValueError):
+                # a file of a process that is starting, or that was removed
+                continue
+        return snapshots
+
+    def _reset_locks(self):
+        # a process forked while another thread held a lock would wait forever on its copy of that lock
+        self._lock = threading.Lock()
+        for metric in self._metrics.values():
+            metric._lock = threading.Lock()
+        # the sharing thread is not forked along; the child shares only when it calls share itself
+        self._shared_path = None
+
+
+registry = MetricsRegistry()
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=registry._reset_locks)
+
+
+# pipeline stages
+
+STAGE_SECONDS = registry.histogram("pipeline_stage_seconds", "duration of the facade and mesh pipeline stages", ["stage"])
+STAGE_ERRORS = registry.counter("pipeline_stage_errors_total", "pipeline stages that raised an exception", ["stage"])
+
+@contextmanager
+def timed(stage):
+    """record the duration of a pipeline stage, as a context manager or as a decorator
+
+    Calls are counted by the _count of the histogram; exceptions are counted separately and raised again. Worker processes (e.g. of facade_analysis.run_batch) keep their own metrics, only the stages that run in the server process show up on /metrics.
+
+    Args:
+    stage (string): name of the stage, e.g. "decode", "contours", "clustering", "wwr" or "mesh_clip"
+
+    Example:
+    @timed("decode")
+    def decode_mask(img): ...
+
+    with timed("mesh_clip"):
+        ...
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        STAGE_ERRORS.inc(stage=stage)
+        raise
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - start, stage=stage)
+
+
+# Hops components
+
+HOPS_REQUESTS = registry.counter("hops_requests_total", "solve requests per component and result", ["component", "status"])
+HOPS_PHASE_SECONDS = registry.histogram("hops_phase_seconds",
+    "duration of the phases of a solve: parse (JSON), inputs (to geometry), solve (handler), outputs (from geometry), serialise (JSON)",
+    ["component", "phase"])
+HOPS_REQUEST_BYTES = registry.histogram("hops_request_bytes", "size of the solve request bodies", ["component"], BYTES_BUCKETS)
+HOPS_RESPONSE_BYTES = registry.histogram("hops_response_bytes", "size of the solve response bodies", ["component"], BYTES_BUCKETS)
+
+# phase times of the solve that is running on this thread
+_solve_state = threading.local()
+
+def _add_phase(phase, seconds):
+    phases = getattr(_solve_state, "phases", None)
+    if phases is not None:
+        phases[phase] = phases.get(phase, 0.0) + seconds
+
+def _timed_phase(func, phase):
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _add_phase(phase, time.perf_counter() - start)
+    return wrapper
+
+def _instrument_params(comp):
+    # the conversion of every parameter is timed separately from the JSON handling around it
+    if getattr(comp, "_metrics_instrumented", False):
+        return
+    for param in comp.inputs:
+        param.from_input = _timed_phase(param.from_input, "inputs")
+    for param in comp.outputs:
+        param.from_result = _timed_phase(param.from_result, "outputs")
+    comp._metrics_instrumented = True
+
+def instrument_hops(hops):
+    """record the count, result, phase durations and payload sizes of every solve of a Hops app
+
+    The solve methods of this Hops instance are wrapped; components registered before or after this call are all covered. JSON parsing and serialisation are the time of preparing the inputs and outputs minus the time spent converting the parameters to and from geometry.
+
+    Args:
+    hops (HopsBase): the Hops middleware, as returned by ghhops_server.Hops(app)
+
+    Returns:
+    hops (HopsBase): the same instance
+    """
+    process_solve_request = hops._process_solve_request
+    prepare_inputs = _timed_phase(hops._prepare_inputs, "prepare_inputs")
+    solve = _timed_phase(hops._solve, "solve")
+    prepare_outputs = _timed_phase(hops._prepare_outputs, "prepare_outputs")
+
+    def instrumented_solve_request(comp, payload):
+        _instrument_params(comp)
+        _solve_state.phases = phases = {}
+        start = time.perf_counter()
+        ok = False
+        try:
+            ok, results = process_solve_request(comp, payload)
+            return ok, results
+        finally:
+            total = time.perf_counter() - start
+            _solve_state.phases = None
+            HOPS_REQUESTS.inc(component=comp.uri, status="ok" if ok else "error")
+            HOPS_PHASE_SECONDS.observe(total, component=comp.uri, phase="total")
+            if "prepare_inputs" in phases:
+                HOPS_PHASE_SECONDS.observe(phases.get("inputs", 0.0), component=comp.uri, phase="inputs")
+                HOPS_PHASE_SECONDS.observe(max(phases["prepare_inputs"] - phases.get("inputs", 0.0), 0.0), component=comp.uri, phase="parse")
+            if "solve" in phases:
+                HOPS_PHASE_SECONDS.observe(phases["solve"], component=comp.uri, phase="solve")
+            if "prepare_outputs" in phases:
+                HOPS_PHASE_SECONDS.observe(phases.get("outputs", 0.0), component=comp.uri, phase="outputs")
+                HOPS_PHASE_SECONDS.observe(max(phases["prepare_outputs"] - phases.get("outputs", 0.0), 0.0), component=comp.uri, phase="serialise")
+            HOPS_REQUEST_BYTES.observe(len(payload), component=comp.uri)
+            if ok:
+                # the Hops JSON is ASCII only, so its length in characters is its size in bytes
+                HOPS_RESPONSE_BYTES.observe(len(results), component=comp.uri)
+
+    hops._process_solve_request = instrumented_solve_request
+    hops._prepare_inputs = prepare_inputs
+    hops._solve = solve
+    hops._prepare_outputs = prepare_outputs
+    return hops
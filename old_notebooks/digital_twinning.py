@@ -1,16 +1,30 @@
 from collections import defaultdict
 # from lxml import etree
 import json
-import copy
 import numpy as np
+import pandas as pd
 import requests
+import requests.adapters
 import shapely
+import shapely.affinity
 import trimesh as tm 
 import os
+import io
+import re
+import time
+import tempfile
+import warnings
+import hashlib
+import concurrent.futures
 import glob
 import zipfile
 import pyvista as pv
-import csv
+try:
+    from metrics import timed
+except ImportError:
+    # metrics.py lives in the repository root; without it on the path the mesh stages are not timed
+    def timed(stage):
+        return lambda func: func
 # from ladybug.sunpath import Sunpath
 
 
@@ -30,35 +44,118 @@ def tri_to_pv(tri_mesh):
     pv_mesh = pv.PolyData(tri_mesh.vertices, faces)
     return pv_mesh
 
-def save_to_clean_csv(lattice, final_dir):
-    """remove empty lines in beginning of CSV file that disrupt the readability
-
+def lattice_metadata(lattice):
+    """collect the metadata that topogenesis writes in the header of a lattice CSV
 
     Args:
-    temporary_dir: 
-    final_dir: 
+    lattice (topogenesis.lattice): the lattice
+
     Returns:
+    metadata (dict): "minbound", "shape" and "unit" arrays, one value per axis
     """
-    
-    
-    l = len(final_dir)
-    temporary_dir = final_dir[:l-4] + '_temp.csv'
+    return {
+        "minbound": np.asarray(lattice.minbound),
+        "shape": np.array(lattice.shape),
+        "unit": np.asarray(lattice.unit),
+    }
+
+def _csv_format(dtype):
+    # the formats of pandas.DataFrame.to_csv(float_format='%g') that topogenesis uses
+    if np.issubdtype(dtype, np.floating):
+        return "%g"
+    if np.issubdtype(dtype, np.integer):
+        return "%d"
+    return "%s"
+
+def _format_csv_rows(columns, line_terminator):
+    # format the rows of a chunk of columns with a single % operation
+    line_format = ",".join(_csv_format(column.dtype) for column in columns) + line_terminator
+    rows = np.column_stack([column.astype(object) for column in columns])
+    text = (line_format * len(rows)) % tuple(rows.ravel().tolist())
+    if any(np.issubdtype(column.dtype, np.floating) and np.isnan(column).any() for column in columns):
+        # pandas writes missing values as empty fields
+        text = re.sub(r"(?<![^,\n])nan(?=[,\r])", "", text)
+    return text
+
+def save_to_clean_csv(lattice, final_dir, chunk_size=2**16):
+    """save a lattice to a CSV file without the empty lines that disrupt the readability, in one pass
+
+    The output is the same as writing the lattice with lattice.to_csv and removing the empty lines in the beginning: the metadata (minbound, shape and unit per axis), followed by the index and value of every cell. The cells are formatted and written a chunk at a time, without a temporary file.
+
+    Args:
+    lattice (topogenesis.lattice): the lattice
+    final_dir (string): location of the CSV file
+    chunk_size (int): number of cells that are written at a time
+    """
+    metadata = lattice_metadata(lattice)
+    values = np.asarray(lattice).ravel()
+    line_terminator = "\r\n"
+
+    with open(final_dir, "w", newline="") as output:
+        output.write("minbound,shape,unit" + line_terminator)
+        output.write(_format_csv_rows([metadata["minbound"], metadata["shape"], metadata["unit"]], line_terminator))
+        output.write("IX,IY,IZ,value" + line_terminator)
+        for start in range(0, len(values), chunk_size):
+            cells = np.arange(start, min(start + chunk_size, len(values)))
+            ix, iy, iz = np.unravel_index(cells, lattice.shape)
+            output.write(_format_csv_rows([ix, iy, iz, values[cells]], line_terminator))
+
+def save_lattice(lattice, file_path, chunk_size=2**20):
+    """save a lattice as CSV or in a binary format, chosen by the extension of file_path
 
-    csv_path = os.path.relpath(temporary_dir)
-    lattice.to_csv(csv_path)
+    ".csv" writes the same file as save_to_clean_csv. ".parquet" writes the IX, IY, IZ and value columns, with the metadata (minbound, shape and unit) as JSON in the key-value metadata of the file. ".npz" writes the values as a 3D array, with the metadata as arrays next to it.
 
-    index = 0
-    with open(temporary_dir) as input, open(final_dir, 'w', newline='') as output:
+    Args:
+    lattice (topogenesis.lattice): the lattice
+    file_path (string): location of the file
+    chunk_size (int): number of cells that are written at a time (CSV and Parquet)
+    """
+    extension = os.path.splitext(file_path)[1].lower()
+    metadata = lattice_metadata(lattice)
+    if extension == ".csv":
+        save_to_clean_csv(lattice, file_path, chunk_size)
+    elif extension == ".npz":
+        np.savez(file_path, values=np.asarray(lattice), **metadata)
+    elif extension == ".parquet":
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        values = np.asarray(lattice).ravel()
+        schema = pa.schema(
+            [("IX", pa.int64()), ("IY", pa.int64()), ("IZ", pa.int64()), ("value", pa.from_numpy_dtype(values.dtype))],
+            metadata={"lattice": json.dumps({key: value.tolist() for key, value in metadata.items()})},
+        )
+        with pq.ParquetWriter(file_path, schema) as writer:
+            for start in range(0, len(values), chunk_size):
+                cells = np.arange(start, min(start + chunk_size, len(values)))
+                ix, iy, iz = np.unravel_index(cells, lattice.shape)
+                writer.write_table(pa.table([ix, iy, iz, values[cells]], schema=schema))
+    else:
+        raise ValueError(f"unknown lattice file format {extension}")
+
+def load_lattice(file_path):
+    """read the values and metadata of a lattice that was saved with save_lattice in a binary format
 
-        writer = csv.writer(output)
-        for row in csv.reader(input):
-            index +=1
-            if index > 8: 
-                writer.writerow(row)
-            else: 
-                if any(field.strip() for field in row):
-                    writer.writerow(row)
-    os.remove(temporary_dir)
+    Args:
+    file_path (string): location of the .npz or .parquet file
+
+    Returns:
+    values (array): value of every cell, as a 3D array
+    metadata (dict): "minbound", "shape" and "unit" arrays, as needed to make a topogenesis.lattice again
+    """
+    if file_path.lower().endswith(".npz"):
+        with np.load(file_path) as data:
+            values = data["values"]
+            metadata = {key: data[key] for key in ("minbound", "shape", "unit")}
+        return values, metadata
+
+    import pyarrow.parquet as pq
+
+    table = pq.read_table(file_path)
+    metadata = {key: np.array(value) for key, value in json.loads(table.schema.metadata[b"lattice"]).items()}
+    values = np.empty(tuple(metadata["shape"]), dtype=table.schema.field("value").type.to_pandas_dtype())
+    values[table["IX"].to_numpy(), table["IY"].to_numpy(), table["IZ"].to_numpy()] = table["value"].to_numpy()
+    return values, metadata
 
 
 # 3D BAG specific functions
@@ -122,33 +219,190 @@ def read_json_dict(json_file_path):
             new_tiles_dict.append(tile)
     return new_tiles_dict
 
-def download_3DBAG_gpkg(tile_list):
+GPKG_URL = "https://data.3dbag.nl/gpkg/v21031_7425c21b/3dbag_v21031_7425c21b_{tile}.gpkg"
+OBJ_ZIP_URL = "https://data.3dbag.nl/obj/v21031_7425c21b/3dbag_v21031_7425c21b_{tile}.zip"
+
+def create_session(pool_size=8):
+    """create a requests session that keeps its connections open, so they are reused for every tile
+
+    Args:
+    pool_size (int): number of connections that are kept open, should be at least the number of concurrent downloads
+
+    Returns:
+    session (requests.Session): the session
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+def file_sha256(file_name, chunk_size=2**20):
+    """calculate the SHA-256 checksum of a file, without reading it into memory at once"""
+    sha256 = hashlib.sha256()
+    with open(file_name, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+def _remote_size(session, url, response=None):
+    # size of the file on the server, from the Content-Range of a 416 response ("bytes */<size>") or else from a HEAD request; None if unknown
+    content_range = response.headers.get("Content-Range", "") if response is not None else ""
+    if content_range.startswith("bytes */") and content_range[len("bytes */"):].isdigit():
+        return int(content_range[len("bytes */"):])
+    try:
+        r = session.head(url, allow_redirects=True, timeout=60)
+    except requests.RequestException:
+        return None
+    size = r.headers.get("Content-Length")
+    return int(size) if r.ok and size is not None else None
+
+def is_downloaded(session, url, file_name, sha256=None):
+    """check whether a file was already downloaded completely
+
+    Downloads are only moved to their final name when they are complete, so an existing file is checked against the checksum if it is known, otherwise against the size the server reports. If the server does not report a size, the existing file is trusted.
+
+    Args:
+    session (requests.Session): session for the size request
+    url (string): location of the file on the server
+    file_name (string): location of the file on disk
+    sha256 (string): expected SHA-256 checksum, if known
+
+    Returns:
+    downloaded (bool): True if the file on disk is complete
+    """
+    if not os.path.exists(file_name):
+        return False
+    if sha256 is not None:
+        return file_sha256(file_name) == sha256
+    size = _remote_size(session, url)
+    return size is None or size == os.path.getsize(file_name)
+
+def download_file(session, url, file_name, sha256=None, retries=4, backoff=1.0, chunk_size=2**20):
+    """download a single file to disk in chunks, resuming a partial download if there is one
+
+    The file is written to file_name + ".part" and only renamed to file_name when it is complete, so file_name never holds a partial download. After a failed attempt, the download is resumed with a Range request after waiting backoff, 2*backoff, 4*backoff, ... seconds. A partial file that is not smaller than the file on the server is only accepted when it has the same size; otherwise it is a stale download (e.g. of an older version of the tile) and the download starts over.
+
+    Args:
+    session (requests.Session): session for the requests
+    url (string): location of the file on the server
+    file_name (string): location of the file on disk
+    sha256 (string): expected SHA-256 checksum, a download that does not match it is started over
+    retries (int): number of attempts after the first one fails
+    backoff (float): waiting time in seconds before the first retry
+    chunk_size (int): number of bytes that are written at a time
+
+    Returns:
+    file_name (string): location of the file on disk
+    """
+    if is_downloaded(session, url, file_name, sha256):
+        return file_name
+
+    part_name = file_name + ".part"
+    for attempt in range(retries + 1):
+        try:
+            resume_from = os.path.getsize(part_name) if os.path.exists(part_name) else 0
+            while True:
+                headers = {"Range": f"bytes={resume_from}-"} if resume_from else {}
+                with session.get(url, headers=headers, stream=True, allow_redirects=True, timeout=60) as r:
+                    if r.status_code == 416 and resume_from:
+                        # the partial file is not smaller than the file on the server: complete, or stale and started over
+                        if _remote_size(session, url, r) == resume_from:
+                            break
+                        os.remove(part_name)
+                        resume_from = 0
+                        continue
+                    r.raise_for_status()
+                    # a server that does not support ranges sends the whole file again
+                    mode = "ab" if r.status_code == 206 else "wb"
+                    with open(part_name, mode) as f:
+                        for chunk in r.iter_content(chunk_size=chunk_size):
+                            f.write(chunk)
+                break
+
+            if sha256 is not None and file_sha256(part_name) != sha256:
+                os.remove(part_name)
+                raise IOError(f"checksum mismatch for {url}")
+            os.replace(part_name, file_name)
+            return file_name
+        except (requests.RequestException, IOError) as e:
+            # client errors (e.g. a tile that does not exist) do not go away by trying again
+            response = getattr(e, "response", None)
+            if attempt == retries or (response is not None and response.status_code < 500):
+                raise
+            time.sleep(backoff * 2**attempt)
+
+def download_files(downloads, workers=8, **kwargs):
+    """download many files concurrently, sharing one session
+
+    Args:
+    downloads (list): (url, file_name) pairs
+    workers (int): maximum number of concurrent downloads
+    kwargs: passed on to download_file
+
+    Returns:
+    file_names (list): locations of the files on disk, in the order of downloads
+    """
+    with create_session(workers) as session, concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(download_file, session, url, file_name, **kwargs) for url, file_name in downloads]
+        return [future.result() for future in futures]
+
+def download_3DBAG_gpkg(tile_list, dir_new='../data/QGIS_data', url=GPKG_URL, workers=8):
 
     """For each needed tile, download the corresponding 3d geopackage 
 
     Args: 
     tile_list (list): list of all tiles that are to be downloaded
+    dir_new (string): folder for the geopackages
+    url (string): location of the geopackages, with {tile} in place of the tile id
+    workers (int): maximum number of concurrent downloads
+
+    Returns:
+    file_names (list): locations of the geopackages
     """
-    for tile in tile_list:
-        url = "https://data.3dbag.nl/gpkg/v21031_7425c21b/3dbag_v21031_7425c21b_" +str(tile) +str(".gpkg")
-        r = requests.get(url, allow_redirects=True)
-        file_name = '../data/QGIS_data/tile_' +str(tile) +str(".gpkg")
-        with open(file_name, 'wb') as f:
-            f.write(r.content)
+    downloads = [(url.format(tile=tile), os.path.join(dir_new, 'tile_' +str(tile) +".gpkg")) for tile in tile_list]
+    return download_files(downloads, workers)
 
-def download_3DBAG_obj_zip(tile_list):
+def download_3DBAG_obj_zip(tile_list, dir_new='../data', url=OBJ_ZIP_URL, workers=8):
     """ For each needed tile, download the corresponding 3d obj file 
     Args: 
     tile_list (list): list of all tiles that are to be downloaded
+    dir_new (string): folder for the zip files
+    url (string): location of the zip files, with {tile} in place of the tile id
+    workers (int): maximum number of concurrent downloads
+
+    Returns:
+    file_names (list): locations of the zip files
     """
-    for tile in tile_list:
-        url = "https://data.3dbag.nl/obj/v21031_7425c21b/3dbag_v21031_7425c21b_" +str(tile) +str(".zip")
-        r = requests.get(url, allow_redirects=True)
-        file_name = '../data/tile_' +str(tile) +".zip"
-        with open(file_name, 'wb') as f:
-            f.write(r.content)
+    downloads = [(url.format(tile=tile), os.path.join(dir_new, 'tile_' +str(tile) +".zip")) for tile in tile_list]
+    return download_files(downloads, workers)
 
-def unpack_objs(download_tiles, dir_base, dir_new):
+def index_zip_members(dir_base, lod="lod22"):
+    """list the OBJ files in all 3D BAG zip files in a folder, reading the directory of every zip file once
+
+    Args:
+    dir_base (string): location of all zip-files
+    lod (string): level of detail of the OBJ files, as in the names of the files (e.g. "lod22")
+
+    Returns:
+    members (dict): for every tile id (string), the zip file and the name of its OBJ file in the zip file
+    """
+    obj_name = re.compile(re.escape(lod) + r"_3d_(.+)\.obj$")
+    members = {}
+    for arc_name in glob.iglob(os.path.join(dir_base, "*.zip")):
+        with zipfile.ZipFile(arc_name) as zf:
+            for file in zf.namelist():
+                match = obj_name.search(file)
+                if match:
+                    members[match.group(1)] = (arc_name, file)
+    return members
+
+def _extract_member(arc_name, file, dir_new):
+    # every thread opens its own handle, zipfile handles should not be shared between threads
+    with zipfile.ZipFile(arc_name) as zf:
+        return zf.extract(file, dir_new)
+
+def unpack_objs(download_tiles, dir_base, dir_new, workers=8, remove_zips=True):
     """
     extract the OBJ files from multiple 3D BAG zip files
     
@@ -156,30 +410,193 @@ def unpack_objs(download_tiles, dir_base, dir_new):
     download_tiles (list): a list with all tiles that are to be downloaded
     dir_base (string)= location of all zip-files
     dir_new (string): location of all extracted OBJ files
+    workers (int): number of OBJ files that are extracted at the same time
+    remove_zips (bool): remove the zip files from which OBJ files were extracted, unless they also hold tiles that were not extracted
 
+    Returns:
+    file_names (list): locations of the extracted OBJ files; tiles without an OBJ file in any zip file are left out with a warning
     """
+    members = index_zip_members(dir_base)
+    tiles = [str(tile) for tile in download_tiles]
+    missing = [tile for tile in tiles if tile not in members]
+    if missing:
+        warnings.warn(f"no OBJ file found in the zip files for {len(missing)} tiles: {', '.join(missing)}")
+    needed = [members[tile] for tile in tiles if tile in members]
+    # zipfile creates missing folders with a check-then-create, which races between threads, so they are made beforehand
+    for folder in {os.path.dirname(os.path.join(dir_new, file)) for _, file in needed} | {dir_new}:
+        os.makedirs(folder, exist_ok=True)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        file_names = list(executor.map(lambda member: _extract_member(*member, dir_new), needed))
+
+    if remove_zips:
+        extracted_zips = {arc_name for arc_name, _ in needed}
+        kept_zips = {arc_name for tile, (arc_name, _) in members.items() if tile not in tiles}
+        for zip_file in extracted_zips - kept_zips:
+            os.remove(zip_file)
+    return file_names
+
+def _load_member(arc_name, file):
+    with zipfile.ZipFile(arc_name) as zf:
+        data = zf.read(file)
+    return tm.load_mesh(io.BytesIO(data), file_type="obj")
+
+def iter_zipped_objs(download_tiles, dir_base, workers=8):
+    """load the OBJ files of multiple tiles straight from the 3D BAG zip files, without extracting them to disk
 
-    file_names = []
-    for tile in download_tiles: 
-        end_obj = "lod22_3d_" +str(tile) +".obj"
-
-        # based on https://stackoverflow.com/a/56229328
-        for arc_name in glob.iglob(os.path.join(dir_base, "*.zip")):
-            arc_dir_name = os.path.splitext(os.path.basename(arc_name))[0]
-            zf = zipfile.ZipFile(arc_name)
-            for file in zf.namelist():
-                if file.endswith(end_obj):
-                    file_names.append(file)
-                    zf.extract(file, dir_new)
-            zf.close()
+    Args:
+    download_tiles (list): tiles of which the OBJ files are loaded
+    dir_base (string): location of all zip-files
+    workers (int): number of OBJ files that are read and parsed at the same time
 
-        # remove all .zip files
-        zip_file = '../data/tile_' +str(tile) +".zip"
-        os.remove(zip_file)
+    Yields:
+    tile (string): tile id
+    mesh (Trimesh.Scene or Trimesh.trimesh): the loaded OBJ file, as tm.load_mesh would return it
+    """
+    members = index_zip_members(dir_base)
+    tiles = [str(tile) for tile in download_tiles if str(tile) in members]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        for tile, mesh in zip(tiles, executor.map(lambda tile: _load_member(*members[tile]), tiles)):
+            yield tile, mesh
 
 
 # functions for generating meshes
 
+def side_faces(vert_count):
+    """vertex indices (starting at 0) of the triangles of the vertical faces of an extrusion
+
+    The bottom ring has the indices 0 ... vert_count-1 and the top ring vert_count ... 2*vert_count-1. Every side gets two triangles, and the last side wraps around to the first vertex.
+
+    Args:
+    vert_count (int): amount of vertices of the extruded polygon
+
+    Returns:
+    faces (array): two triangles per side, one row per triangle
+    """
+    index = np.arange(vert_count)
+    next_index = (index + 1) % vert_count
+    faces = np.empty((vert_count, 2, 3), dtype=np.int64)
+    faces[:, 0] = np.column_stack([index + vert_count, next_index, index])
+    faces[:, 1] = np.column_stack([next_index + vert_count, next_index, index + vert_count])
+    return faces.reshape(-1, 3)
+
+def _cap_faces(ring):
+    # triangulate the polygon like trimesh.creation.extrude_polygon, with the triangles counter-clockwise seen from above
+    cap_vertices, cap_faces = tm.creation.triangulate_polygon(shapely.geometry.Polygon(ring))
+    ring_index = {tuple(vertex): i for i, vertex in enumerate(ring)}
+    cap_faces = np.array([[ring_index[tuple(cap_vertices[i])] for i in face] for face in cap_faces], dtype=np.int64).reshape(-1, 3)
+    ab = ring[cap_faces[:, 1]] - ring[cap_faces[:, 0]]
+    ac = ring[cap_faces[:, 2]] - ring[cap_faces[:, 0]]
+    is_ccw = ab[:, 0] * ac[:, 1] - ab[:, 1] * ac[:, 0] > 0
+    return np.where(is_ccw[:, None], cap_faces, cap_faces[:, ::-1])
+
+def extrusion_arrays(footprints, heights, caps=True):
+    """extrude many polygons in the Z-direction from Z=0 to their height, as one set of vertex and face arrays
+
+    The vertices and vertical faces of all polygons are made at once with array operations, only the caps are triangulated per polygon (like in trimesh.creation.extrude_polygon). The faces point outwards, whichever way a polygon runs.
+
+    Args:
+    footprints (list): 2D coordinates of every polygon, the first coordinate may be repeated at the end
+    heights (float or list): extrusion height, for all polygons or for every polygon
+    caps (bool): add the bottom and top faces, without them only the vertical faces are made
+
+    Returns:
+    vertices (array): for every polygon, its bottom ring followed by its top ring
+    faces (array): vertex indices (starting at 0) of the triangles
+    """
+    rings = []
+    for input_coords in footprints:
+        ring = np.asarray(input_coords, dtype=float)[:, :2]
+        if len(ring) > 1 and (ring[0] == ring[-1]).all():
+            ring = ring[:-1]
+        rings.append(ring)
+    if not rings:
+        return np.empty((0, 3)), np.empty((0, 3), dtype=np.int64)
+    heights = np.broadcast_to(np.asarray(heights, dtype=float), (len(rings),))
+
+    # the vertices of polygon k start at offset[k]: first its bottom ring, then its top ring
+    vert_counts = np.array([len(ring) for ring in rings])
+    offsets = 2 * (np.cumsum(vert_counts) - vert_counts)
+    coords = np.concatenate(rings)
+    count = np.repeat(vert_counts, vert_counts)
+    offset = np.repeat(offsets, vert_counts)
+    ring_start = offset // 2
+    index = np.arange(len(coords)) - ring_start
+    next_index = (index + 1) % count
+
+    vertices = np.empty((2 * len(coords), 3))
+    vertices[offset + index, :2] = coords
+    vertices[offset + index, 2] = 0.0
+    vertices[offset + count + index, :2] = coords
+    vertices[offset + count + index, 2] = np.repeat(heights, vert_counts)
+
+    # two triangles per side, the last side wraps around to the first vertex (see side_faces)
+    faces = np.empty((len(coords), 2, 3), dtype=np.int64)
+    faces[:, 0] = np.column_stack([offset + count + index, offset + next_index, offset + index])
+    faces[:, 1] = np.column_stack([offset + count + next_index, offset + next_index, offset + count + index])
+
+    # these side faces point outwards for clockwise polygons, so they are flipped for counter-clockwise ones
+    x, y = coords.T
+    x_next, y_next = coords[ring_start + next_index].T
+    is_ccw = np.add.reduceat(x * y_next - x_next * y, offsets // 2) > 0
+    flip = np.repeat(is_ccw, vert_counts)
+    faces[flip] = faces[flip][:, :, ::-1]
+    faces = faces.reshape(-1, 3)
+
+    if caps:
+        # bottom triangles point down (clockwise seen from above), top triangles up
+        cap_faces = []
+        for ring, ring_offset in zip(rings, offsets):
+            top = _cap_faces(ring)
+            cap_faces.append(top[:, ::-1] + ring_offset)
+            cap_faces.append(top + ring_offset + len(ring))
+        faces = np.vstack([faces] + cap_faces)
+    return vertices, faces
+
+def _format_rows(prefix, rows, row_format, chunk_size=65536):
+    # format a whole chunk of rows with a single % operation, instead of one string per row
+    line_format = prefix + " " + " ".join([row_format] * rows.shape[1]) + "\n"
+    for start in range(0, len(rows), chunk_size):
+        chunk = rows[start:start + chunk_size]
+        yield (line_format * len(chunk)) % tuple(chunk.ravel().tolist())
+
+def write_obj(file_obj, vertices, faces, precision=2, chunk_size=65536):
+    """write vertex and face arrays as OBJ text, a chunk of lines at a time
+
+    Args:
+    file_obj (file): text file or buffer to write to
+    vertices (array): vertex coordinates, one row per vertex
+    faces (array): vertex indices (starting at 0) of the faces, one row per face
+    precision (int): number of decimals of the coordinates
+    chunk_size (int): number of lines that are formatted and written at a time
+    """
+    file_obj.write("g\n")
+    for chunk in _format_rows("v", np.asarray(vertices, dtype=float), f"%.{precision}f", chunk_size):
+        file_obj.write(chunk)
+    for chunk in _format_rows("f", np.asarray(faces, dtype=np.int64) + 1, "%i", chunk_size):
+        file_obj.write(chunk)
+
+@timed("mesh_extrude")
+def extrude_to_obj(footprints, heights, file_obj=None, caps=True, precision=2):
+    """extrude many polygons (e.g. building footprints) and write them to one OBJ file
+
+    Args:
+    footprints (list): 2D coordinates of every polygon
+    heights (float or list): extrusion height, for all polygons or for every polygon
+    file_obj (file): text file or buffer to write to; if None, the OBJ text is returned
+    caps (bool): add the bottom and top faces
+    precision (int): number of decimals of the coordinates
+
+    Returns:
+    obj (string): the OBJ text, only if file_obj is None
+    """
+    vertices, faces = extrusion_arrays(footprints, heights, caps)
+    if file_obj is not None:
+        write_obj(file_obj, vertices, faces, precision)
+        return None
+    buffer = io.StringIO()
+    write_obj(buffer, vertices, faces, precision)
+    return buffer.getvalue()
+
 def area_to_3d_obj(input_coords, height):
     """
     function to create a 3d OBJ mesh out of a list of points by extruding them in the Z-direction. the initial coordinates are being set to Z=0
@@ -189,16 +606,12 @@ def area_to_3d_obj(input_coords, height):
     height (float): 
 
     returns: 
-    b_box_obj (Trimesh.trimesh): an extruded OBJ of the input coordinates
+    b_box_obj (string): an extruded OBJ of the input coordinates, in the OBJ format
     """
-    
-    b_box_polygon = shapely.geometry.Polygon(input_coords)
-    b_box_mesh = tm.creation.extrude_polygon(b_box_polygon, height, transform=None)
-    b_box_obj = tm.exchange.obj.export_obj(b_box_mesh)
-    return b_box_obj
+    return extrude_to_obj([input_coords], height)
 
 def generate_vertices(in_coor_array, height):
-    """ Extrude input coordinates to a set of 3d vertices (this function is deprecated and replaced by .... function)
+    """ Extrude input coordinates to a set of 3d vertices (this function is deprecated and replaced by extrude_to_obj)
 
     Args:
     in_coor_array (array): the mesh that describes the bounds
@@ -206,23 +619,14 @@ def generate_vertices(in_coor_array, height):
     
     Returns: a list with all vertex locations in 3 dimensions, in the OBJ format
     """
-    # def vertex_to_obj(coordinates):
-    #     return " ".join(['v'] + ["%.2f" % i for i in coordinates])
-    
+    in_coor_array = np.asarray(in_coor_array, dtype=float)
     vert_count = len(in_coor_array)
-    z = [0, height]
-    vertices_obj = ['g']
-    for value in z:
-    # translate input coordinates to 3d vertices for generating an obj file
-        base_vertices = np.c_[in_coor_array, [value]*vert_count]
-        for coordinate in base_vertices:
-            x = " ".join(['v'] + ["%.2f" % i for i in coordinate])
-            vertices_obj.append(x)
-    return vertices_obj
+    vertices = np.vstack([np.c_[in_coor_array, np.zeros(vert_count)], np.c_[in_coor_array, np.full(vert_count, height)]])
+    return ['g'] + "".join(_format_rows("v", vertices, "%.2f")).splitlines()
  
 def generate_faces(vert_count): 
     """
-    Generate vertical face elements for the extrusion as triangles
+    Generate vertical face elements for the extrusion as triangles (this function is deprecated and replaced by extrude_to_obj)
 
     Args:
     vert_count (int): amount of vertices that define the OBJ
@@ -230,22 +634,7 @@ def generate_faces(vert_count):
     Returns:
     faces_obj (list): list with all faces of an extruded object, in the OBJ format
     """
-    faces_obj = ['g']
-    index = 0
-
-    while vert_count > index:
-        index +=1
-        vertices = [[[index+ vert_count, 1, index], [index + vert_count, index+1, index]], [[1 + vert_count, 1, vert_count + index], [index + vert_count + 1, index + 1, index + vert_count]]]
-        for triangle_type in vertices: 
-        # if the vertex is the last one in the list, generate the face with the first vertex on the list
-            if vert_count == (index): 
-                x = " ".join(['f'] + ["%i" % i for i in (triangle_type[0])])
-                faces_obj.append(x)
-            # if not, generate a face with the next vertex on the list
-            else: 
-                x = " ".join(['f'] + ["%i" % i for i in (triangle_type[1])])
-                faces_obj.append(x)
-    return faces_obj
+    return ['g'] + "".join(_format_rows("f", side_faces(vert_count) + 1, "%i")).splitlines()
 
 
 # functions for selecting and filtering
@@ -265,138 +654,625 @@ def buffer(b_box, scalar):
     return b_box
 
 def overlap(boundary, input_locations): 
-    # TODO: Add the docstrings
+    """find the 3D BAG tiles that overlap a bounding box
 
-    # open the csv with all possible tile numbers and locations (coordinates)
-    # input_locations.set_index('tile_id', inplace=True)
+    For looking up many bounding boxes, build a TileIndex once and query that instead.
 
-    #check whether a tile has overlap with the bounding box
-    input_locations["x_bmin_tmax"] =  boundary[0] < input_locations["x2"]
-    input_locations["x_bmax_tmin"] =  input_locations["x1"] < boundary[2]
-    input_locations["y_bmin_tmax"] =  boundary[1] < input_locations["y2"]
-    input_locations["y_bmax_tmin"] =  input_locations["y1"] < boundary[3]
+    Args:
+    boundary (list): bounding box (x_min, y_min, x_max, y_max)
+    input_locations (list or DataFrame): output of read_json_dict, or a DataFrame with the columns "tile_id", "x1", "y1", "x2", "y2"; it is not modified
 
-    condition_matrix = input_locations[["x_bmin_tmax","x_bmax_tmin","y_bmin_tmax","y_bmax_tmin"]].to_numpy()
-    indices = (condition_matrix.sum(axis=1) == 4)
-    tile_ids = np.argwhere(indices)
-    download_tiles = (tile_ids + 1).flatten().tolist()
-    return download_tiles
+    Returns:
+    download_tiles (list): tile_id of every tile that overlaps the bounding box
+    """
+    return TileIndex(input_locations).query_bbox(boundary)
 
-def join_objs(dir_name_base):
-    # TODO: Add the docstrings
+class TileIndex:
+    """spatial index of the 3D BAG tiles, built once and reused for every bounding box or polygon that is looked up
+
+    The tile envelopes are stored in an STRtree, so a lookup only checks the tiles near the query instead of every tile. A tile is selected when it shares more than an edge or corner with the query.
+
+    Args:
+    tiles (list or DataFrame): output of read_json_dict, or a DataFrame with the columns "tile_id", "x1", "y1", "x2", "y2"
+    """
+    def __init__(self, tiles):
+        if not isinstance(tiles, pd.DataFrame):
+            tiles = pd.DataFrame(tiles[1:], columns=tiles[0])
+        self.tile_ids = tiles["tile_id"].to_numpy()
+        self.bounds = tiles[["x1", "y1", "x2", "y2"]].to_numpy(dtype=float)
+        self.tree = shapely.STRtree(shapely.box(*self.bounds.T))
+
+    def query_bbox(self, b_box, scalar=0.0):
+        """find the tiles that overlap a bounding box
+
+        Args:
+        b_box (list): bounding box (x_min, y_min, x_max, y_max), it is not modified
+        scalar (float): buffer margin, as a fraction of the size of the bounding box (see buffer)
+
+        Returns:
+        tile_ids (list): tile_id of every overlapping tile
+        """
+        return self.query_bboxes([b_box], scalar)[0]
+
+    def query_bboxes(self, b_boxes, scalar=0.0):
+        """find the tiles that overlap each of a batch of bounding boxes, in a single query of the tree
+
+        Args:
+        b_boxes (array): bounding boxes (x_min, y_min, x_max, y_max), one per row
+        scalar (float): buffer margin, as a fraction of the size of each bounding box (see buffer)
+
+        Returns:
+        tile_ids (list): for every bounding box, the tile_id of every overlapping tile
+        """
+        b_boxes = np.array(b_boxes, dtype=float).reshape(-1, 4)
+        margin = np.abs(b_boxes[:, 2:] - b_boxes[:, :2]) * scalar
+        b_boxes = np.hstack([b_boxes[:, :2] - margin, b_boxes[:, 2:] + margin])
+
+        box_index, tile_index = self.tree.query(shapely.box(*b_boxes.T))
+        # the tree also returns tiles that only touch a bounding box, these are left out
+        b = b_boxes[box_index]
+        t = self.bounds[tile_index]
+        inside = (b[:, 0] < t[:, 2]) & (t[:, 0] < b[:, 2]) & (b[:, 1] < t[:, 3]) & (t[:, 1] < b[:, 3])
+        return self._group(box_index[inside], tile_index[inside], len(b_boxes))
+
+    def query_polygon(self, input_coords, scalar=0.0):
+        """find the tiles that overlap a polygon, e.g. a project site or street segment outline
+
+        Args:
+        input_coords (list): 2D coordinates of the polygon
+        scalar (float): buffer margin, as a fraction of the size of the bounding box of the polygon; the polygon is scaled around the centre of its bounding box so that its bounding box grows like in buffer
+
+        Returns:
+        tile_ids (list): tile_id of every overlapping tile
+        """
+        polygon = shapely.geometry.Polygon(input_coords)
+        if scalar:
+            x_min, y_min, x_max, y_max = polygon.bounds
+            polygon = shapely.affinity.scale(polygon, 1 + 2*scalar, 1 + 2*scalar, origin=((x_min + x_max) / 2, (y_min + y_max) / 2))
+
+        tile_index = self.tree.query(polygon, predicate="intersects")
+        tile_index = tile_index[~shapely.touches(self.tree.geometries[tile_index], polygon)]
+        return self._group(np.zeros(len(tile_index), dtype=int), tile_index, 1)[0]
+
+    def _group(self, query_index, tile_index, query_count):
+        # sort the tiles per query in the order of the tile list, and split them per query
+        if query_count == 0:
+            return []
+        order = np.lexsort((tile_index, query_index))
+        splits = np.searchsorted(query_index[order], np.arange(1, query_count))
+        return [self.tile_ids[indices].tolist() for indices in np.split(tile_index[order], splits)]
+
+def _mesh_parts(mesh):
+    # tm.load_mesh returns a scene for files with multiple geometries
+    if isinstance(mesh, tm.Scene):
+        return list(mesh.geometry.values())
+    return [mesh]
+
+def write_ply(ply_path, vertices, faces, chunk_size=2**20):
+    """write a triangle mesh to a binary PLY file, a chunk of rows at a time so the arrays can be memory-mapped
+
+    Args:
+    ply_path (string): location of the PLY file
+    vertices (array): vertex coordinates, one row per vertex
+    faces (array): vertex indices of the triangles, one row per face
+    chunk_size (int): number of rows that are converted at a time
+    """
+    header = (
+        "ply\nformat binary_little_endian 1.0\n"
+        f"element vertex {len(vertices)}\nproperty double x\nproperty double y\nproperty double z\n"
+        f"element face {len(faces)}\nproperty list uchar int vertex_indices\nend_header\n"
+    )
+    face_dtype = np.dtype([("count", "u1"), ("indices", "<i4", (3,))])
+    with open(ply_path, "wb") as f:
+        f.write(header.encode("ascii"))
+        for start in range(0, len(vertices), chunk_size):
+            f.write(np.ascontiguousarray(vertices[start:start + chunk_size], dtype="<f8").tobytes())
+        for start in range(0, len(faces), chunk_size):
+            chunk = np.empty(len(faces[start:start + chunk_size]), dtype=face_dtype)
+            chunk["count"] = 3
+            chunk["indices"] = faces[start:start + chunk_size]
+            f.write(chunk.tobytes())
+
+def load_context_arrays(output_path, mmap_mode="r"):
+    """open the vertices and faces of a context mesh that join_objs wrote in the "npy" format, without reading them into memory
+
+    Args:
+    output_path (string): output_path that was given to join_objs
+    mmap_mode (string): memory-map mode, see np.load; None reads the arrays into memory
+
+    Returns:
+    vertices (array): vertex coordinates, one row per vertex
+    faces (array): vertex indices of the triangles, one row per face
+    """
+    base_path = os.path.splitext(output_path)[0]
+    return np.load(base_path + "_vertices.npy", mmap_mode=mmap_mode), np.load(base_path + "_faces.npy", mmap_mode=mmap_mode)
+
+@timed("mesh_join")
+def join_objs(dir_name_base, output_path=None, output_format="obj", meshes=None):
+    """combine all OBJ files in a folder into one context mesh
+
+    Only one OBJ file is in memory at a time. The first pass parses every file once, stores its vertices and faces in temporary binary files and counts them. The second pass fills arrays of the final size with them, shifting the face indices by the number of vertices before them. For the binary formats these arrays are memory-mapped, so the combined mesh never has to fit in memory. Spilling the parts writes the mesh to disk twice, but parses every file only once and also works for meshes that can only be iterated once, such as those of iter_zipped_objs.
+
+    Args:
+    dir_name_base (string): location of the OBJ files
+    output_path (string): location of the output file; required for the binary formats, optional for "obj"
+    output_format (string): "obj" (text), "ply" (binary PLY) or "npy" (output_path with the _vertices.npy and _faces.npy suffixes, see load_context_arrays)
+    meshes (iterable): loaded meshes to combine instead of the OBJ files in dir_name_base, e.g. the meshes of iter_zipped_objs
 
-    all_scenes = []
-
-    # load all files
-    for arc_name in glob.iglob(os.path.join(dir_name_base, "*.obj")):
-        mesh = tm.load_mesh(arc_name)
-        all_scenes.append(mesh)
-
-    #from all scenes, append the vertices to one array (all_v) and the faces to another (all_f)
-    all_v = []
-    all_f = []
-    for scene in all_scenes:
-        for _, mesh in scene.geometry.items():
-            all_v.append(np.array(mesh.vertices))
-            all_f.append(np.array(mesh.faces))
-
-    # as all vertices are now in one list and the faces are generated based on the index of each vertex, these values should be adjusted to the new vertex indices. 
-    adjusted_all_f = []
-    vcount = 0
-    for vs, fs in zip(all_v, all_f):
-        fs += vcount
-        adjusted_all_f.append(fs)
-        vcount += vs.shape[0]
-
-    #concatenate all faces and all vertices into an array
-    v_array = np.concatenate(all_v)
-    f_array = np.concatenate(adjusted_all_f)
-
-    # translate the vertices and faces to an .obj format
-    combined_mesh = tm.Trimesh(v_array, f_array)
+    Returns:
+    context_mesh (string): the combined mesh in the OBJ format, for "obj"; otherwise the location of the output file(s)
+    """
+    if output_format not in ("obj", "ply", "npy"):
+        raise ValueError(f"unknown output format {output_format}")
+    if output_format != "obj" and output_path is None:
+        raise ValueError(f"an output path is required for the {output_format} format")
+    if meshes is None:
+        meshes = (tm.load_mesh(arc_name) for arc_name in sorted(glob.glob(os.path.join(dir_name_base, "*.obj"))))
+
+    with tempfile.TemporaryDirectory() as spill_dir:
+        # first pass: parse every file once, spill its arrays to disk and count the vertices and faces
+        parts = []
+        v_total = 0
+        f_total = 0
+        for mesh in meshes:
+            for part in _mesh_parts(mesh):
+                spill_path = os.path.join(spill_dir, str(len(parts)))
+                np.save(spill_path + "_v.npy", np.asarray(part.vertices, dtype=np.float64))
+                np.save(spill_path + "_f.npy", np.asarray(part.faces, dtype=np.int64))
+                parts.append(spill_path)
+                v_total += len(part.vertices)
+                f_total += len(part.faces)
+
+        # second pass: fill the arrays of the combined mesh, offsetting the face indices with the vertices before them
+        if output_format == "npy":
+            base_path = os.path.splitext(output_path)[0]
+            array_dir, suffix = os.path.dirname(base_path), os.path.basename(base_path)
+            output_paths = [base_path + "_vertices.npy", base_path + "_faces.npy"]
+        else:
+            array_dir, suffix = spill_dir, "combined"
+        v_array = np.lib.format.open_memmap(os.path.join(array_dir, suffix + "_vertices.npy"), mode="w+", dtype=np.float64, shape=(v_total, 3))
+        f_array = np.lib.format.open_memmap(os.path.join(array_dir, suffix + "_faces.npy"), mode="w+", dtype=np.int64, shape=(f_total, 3))
+        vcount = 0
+        fcount = 0
+        for spill_path in parts:
+            # read the parts without memory-mapping them, so no open file keeps the temporary folder from being deleted (on Windows)
+            vs = np.load(spill_path + "_v.npy")
+            fs = np.load(spill_path + "_f.npy")
+            v_array[vcount:vcount + len(vs)] = vs
+            f_array[fcount:fcount + len(fs)] = fs + vcount
+            vcount += len(vs)
+            fcount += len(fs)
+
+        if output_format == "npy":
+            v_array.flush()
+            f_array.flush()
+            del v_array, f_array
+            return output_paths
+        if output_format == "ply":
+            write_ply(output_path, v_array, f_array)
+            del v_array, f_array
+            return output_path
+
+        # translate the vertices and faces to an .obj format
+        combined_mesh = tm.Trimesh(np.array(v_array), np.array(f_array))
+        del v_array, f_array
     context_mesh = tm.exchange.obj.export_obj(combined_mesh)
+    if output_path is not None:
+        with open(output_path, "w") as f:
+            f.write(context_mesh)
     return context_mesh
 
-def vertex_intersection(bound_mesh, content_mesh):
-    """[summary]
+def prism_contains(input_coords, height, points):
+    """check which points lie inside an extruded polygon, as made by area_to_3d_obj, with a 2D point-in-polygon test and a height check
+
+    Args:
+    input_coords (list): 2D coordinates of the polygon
+    height (float): extrusion height, the prism runs from Z=0 to Z=height
+    points (array): 3D points, one row per point
+
+    Returns:
+    inside (array): True for every point inside the prism (or on its boundary)
+    """
+    points = np.asarray(points, dtype=float)
+    polygon = shapely.geometry.Polygon(input_coords)
+    shapely.prepare(polygon)
+    in_range = (points[:, 2] >= 0.0) & (points[:, 2] <= height)
+    inside = np.zeros(len(points), dtype=bool)
+    inside[in_range] = shapely.intersects_xy(polygon, points[in_range, 0], points[in_range, 1])
+    return inside
+
+def _vertex_submesh(content_mesh, v_keep):
+    # keep the selected vertices and the faces of which all vertices are kept, like update_vertices and update_faces on a copy
+    f_keep = v_keep[content_mesh.faces].all(axis=1)
+    new_index = np.cumsum(v_keep) - 1
+    return tm.Trimesh(content_mesh.vertices[v_keep], new_index[content_mesh.faces[f_keep]], process=False)
+
+@timed("mesh_clip")
+def clip_mesh(content_mesh, bound_mesh=None, prism=None):
+    """split a mesh into the part inside and the part outside of a bound, classifying every vertex only once
+
+    A face belongs to a part when all its vertices do, so faces that cross the bound are in neither part. For bounds that are an extruded polygon, pass the polygon and height as prism: a 2D point-in-polygon test is much faster than the ray test that is needed for a general bound mesh.
+
+    Args:
+    content_mesh (Trimesh): the content mesh
+    bound_mesh (Trimesh): the mesh that describes the bounds, only used if prism is not given
+    prism (tuple): input_coords and height of an extruded polygon that describes the bounds (see area_to_3d_obj)
+
+    Returns:
+    inside_mesh (Trimesh): the part of the content mesh inside the bounds
+    outside_mesh (Trimesh): the part of the content mesh outside the bounds
+    """
+    if prism is not None:
+        v_inside = prism_contains(*prism, content_mesh.vertices)
+    else:
+        v_inside = bound_mesh.contains(content_mesh.vertices)
+    return _vertex_submesh(content_mesh, v_inside), _vertex_submesh(content_mesh, ~v_inside)
+
+def vertex_intersection(bound_mesh, content_mesh, prism=None):
+    """keep the part of a mesh that lies inside a bound, use clip_mesh if the outside part is needed as well
 
     Args:
         bound_mesh (Trimesh): the mesh that describes the bounds
         content_mesh (Trimesh): the content mesh
+        prism (tuple): input_coords and height of an extruded polygon that describes the bounds, see clip_mesh
 
     Returns:
         Trimesh: the trimmed mesh
     """
-    # check which one of the vertices of the content_mesh is inside the bound_mesh
-    v_inside = bound_mesh.contains(content_mesh.vertices)
-    # check which one of the faces of the content_mesh correspond to the vertices of it that fall inside the bound_mesh
-    f_inside = v_inside[content_mesh.faces].all(axis=1)
-    # making a deep copy of the content_mesh
-    inside_mesh = copy.deepcopy(content_mesh)
-    # removing the external vertices
-    inside_mesh.update_vertices(v_inside)
-    # removing the external faces
-    inside_mesh.update_faces(f_inside)
-    return inside_mesh
-
-def vertex_difference(bound_mesh, content_mesh):
-    """[summary]
+    return clip_mesh(content_mesh, bound_mesh, prism)[0]
+
+def vertex_difference(bound_mesh, content_mesh, prism=None):
+    """keep the part of a mesh that lies outside a bound, use clip_mesh if the inside part is needed as well
 
     Args:
         bound_mesh (Trimesh): the mesh that describes the bounds
         content_mesh (Trimesh): the content mesh
+        prism (tuple): input_coords and height of an extruded polygon that describes the bounds, see clip_mesh
 
     Returns:
         Trimesh: the trimmed mesh
     """
-    # check which one of the vertices of the content_mesh is inside the bound_mesh
-    v_inside = bound_mesh.contains(content_mesh.vertices)
-    # find the vertices that fall outside
-    v_outside = (1 - v_inside).astype(bool)
-    # check which one of the faces of the content_mesh correspond to the vertices of it that fall outside the bound_mesh
-    f_outside = v_outside[content_mesh.faces].all(axis=1)
-    # making a deep copy of the content_mesh
-    outside_mesh = copy.deepcopy(content_mesh)
-    # removing the internal vertices
-    outside_mesh.update_vertices(v_outside)
-    # removing the internal faces
-    outside_mesh.update_faces(f_outside)
-    return outside_mesh
-
-# def sun_positions():
-#     # TODO: Add the docstrings
-#     # initiate sunpath
-#     sp = Sunpath(longitude=4.3571, latitude=52.0116)
-
-#     # defining sun hours
-#     sun_vectors = []
-#     day_multiples = 30
-#     for d in range(365):
-#         if d % day_multiples==0:
-#             for h in range(24):
-#                 i = d*24 + h
-#                 # compute the sun object
-#                 sun = sp.calculate_sun_from_hoy(i)
-#                 # extract the sun vector
-#                 sun_vector = sun.sun_vector.to_array()
-#                 # Removing the sun vectors under the horizon 
-#                 if sun_vector[2] > 0.0:
-#                     sun_vectors.append(sun_vector)
-
-#     sun_vectors = np.array(sun_vectors)
-    
-#     return sun_vectors
+    return clip_mesh(content_mesh, bound_mesh, prism)[1]
+
+# sky view and solar exposure
+
+def sun_positions(longitude=4.9041, latitude=52.3676, day_multiples=30):
+    """calculate the sun vectors for every hour of every day_multiples-th day of the year, leaving out the hours the sun is below the horizon
+
+    The position of the sun is calculated with the NOAA approximation of the equation of time and the declination, with x pointing east, y north and z up (like the RD coordinates of the BAG).
 
-def sky_positions():
+    Args:
+    longitude (float): longitude of the site in degrees, defaults to Amsterdam
+    latitude (float): latitude of the site in degrees
+    day_multiples (int): one day out of every day_multiples days is sampled
+
+    Returns:
+    sun_vectors (array): unit vectors towards the sun, one per sampled hour above the horizon
+    """
+    day, hour = np.meshgrid(np.arange(0, 365, day_multiples), np.arange(24), indexing="ij")
+    day = day.ravel()
+    hour = hour.ravel() + 0.5
+    gamma = 2 * np.pi / 365 * (day + (hour - 12) / 24)
+    eqtime = 229.18 * (0.000075 + 0.001868*np.cos(gamma) - 0.032077*np.sin(gamma) - 0.014615*np.cos(2*gamma) - 0.040849*np.sin(2*gamma))
+    declination = (0.006918 - 0.399912*np.cos(gamma) + 0.070257*np.sin(gamma) - 0.006758*np.cos(2*gamma)
+        + 0.000907*np.sin(2*gamma) - 0.002697*np.cos(3*gamma) + 0.00148*np.sin(3*gamma))
+    # hour angle from the true solar time, with the hours in UTC
+    hour_angle = np.radians((hour*60 + eqtime + 4*longitude) / 4 - 180)
+    lat = np.radians(latitude)
+
+    sun_vectors = np.column_stack([
+        -np.cos(declination) * np.sin(hour_angle),
+        np.cos(lat)*np.sin(declination) - np.sin(lat)*np.cos(declination)*np.cos(hour_angle),
+        np.sin(lat)*np.sin(declination) + np.cos(lat)*np.cos(declination)*np.cos(hour_angle),
+    ])
+    # Removing the sun vectors under the horizon 
+    return sun_vectors[sun_vectors[:, 2] > 0.0]
+
+def sky_positions(subdivisions=2):
     #Create a sphere to put points on that represent the sky 
-    sphere_mesh = tm.creation.icosphere(subdivisions=2, radius= 300.0, color=None)
+    sphere_mesh = tm.creation.icosphere(subdivisions=subdivisions, radius= 300.0)
     sphere_vectors = np.copy(sphere_mesh.vertices)
-    sky_vectors = []
-    for v in sphere_vectors:
-        if v[2] > 0.0:
-            sky_vectors.append(v)
+    sky_vectors = sphere_vectors[sphere_vectors[:, 2] > 0.0]
+    return sky_vectors
 
+def facade_window_points(facade_start, facade_end, floors, image_height, max_building_height, building_height, ground_z=0.0, samples_per_floor=5):
+    """place the windows of a facade photo on a facade of a BAG building, as sample points for window_exposure
 
-    sky_vectors = np.array(sky_vectors)
+    Every floor gets samples_per_floor points, spread evenly along the facade at the middle height of its windows. Pixel rows are translated to heights by taking the bottom of the photo as the ground and max_building_height as the top of the building.
 
-    return sky_vectors
\ No newline at end of file
+    Args:
+    facade_start (list): 2D start point of the facade, an edge of the footprint that runs counter-clockwise
+    facade_end (list): 2D end point of the facade
+    floors (DataFrame): floor information of the facade (output of facade_analysis.get_cluster_info), with avg_sill_height and avg_win_height in pixels
+    image_height (int): height of the photo in pixels
+    max_building_height (float): pixel row of the top of the building in the photo
+    building_height (float): height of the building in metres, e.g. b3_h_70p - b3_h_maaiveld of the BAG
+    ground_z (float): height of the ground, e.g. b3_h_maaiveld
+    samples_per_floor (int): number of sample points per floor
+
+    Returns:
+    origins (array): 3D sample points, samples_per_floor per floor
+    normals (array): outward facade normal at every sample point
+    floor_index (array): row in floors of every sample point
+    """
+    facade_start = np.asarray(facade_start, dtype=float)[:2]
+    facade_end = np.asarray(facade_end, dtype=float)[:2]
+    dx, dy = facade_end - facade_start
+    # for counter-clockwise footprints, the outside lies to the right of every edge
+    normal = np.array([dy, -dx, 0.0]) / np.hypot(dx, dy)
+
+    window_middle = (floors["avg_sill_height"] - floors["avg_win_height"] / 2).to_numpy(dtype=float)
+    z = ground_z + (image_height - window_middle) / (image_height - max_building_height) * building_height
+    along = (np.arange(samples_per_floor) + 0.5) / samples_per_floor
+
+    floor_index = np.repeat(np.arange(len(floors)), samples_per_floor)
+    xy = facade_start + np.tile(along, len(floors))[:, None] * (facade_end - facade_start)
+    origins = np.column_stack([xy, z[floor_index]])
+    normals = np.tile(normal, (len(origins), 1))
+    return origins, normals, floor_index
+
+def _slab_hits(origins, inverse, low, high, max_distance):
+    # distance at which every ray (origin, 1/direction) enters its box (low, high), and whether it passes through the box within max_distance;
+    # fmin and fmax skip the NaN of a ray that runs exactly along a side of the box
+    with np.errstate(invalid="ignore"):
+        t1 = (low - origins) * inverse
+        t2 = (high - origins) * inverse
+        near = np.fmin(t1, t2)
+        far = np.fmax(t1, t2)
+    t_near = np.fmax(np.fmax(near[:, 0], near[:, 1]), near[:, 2])
+    t_far = np.fmin(np.fmin(far[:, 0], far[:, 1]), far[:, 2])
+    return t_near, (t_far >= np.maximum(t_near, 0.0)) & (t_near <= max_distance)
+
+class RayContext:
+    """triangles of the surrounding buildings, prepared once for casting many batches of rays
+
+    All triangles are put in a bounding volume hierarchy when the context is made: a balanced binary tree that splits the triangles of every node in two halves at the median of their centres along the longest side, down to leaves of leaf_size triangles. A batch of rays walks down the tree with array operations, as (ray, node) pairs, so a ray is only tested against the triangles of the leaves whose box it passes through. This works the same for a dict of buildings and for a single joined context mesh.
+
+    Args:
+    building_meshes (dict): mesh (Trimesh) of every building, by building id; a single Trimesh is treated as one building
+    leaf_size (int): number of triangles per leaf of the tree
+    """
+    def __init__(self, building_meshes, leaf_size=8):
+        if isinstance(building_meshes, tm.Trimesh):
+            building_meshes = {0: building_meshes}
+        self.building_ids = list(building_meshes)
+        self.hashes = [mesh_hash(building_meshes[building_id]) for building_id in self.building_ids]
+        self.bounds = np.array([building_meshes[building_id].bounds for building_id in self.building_ids]).reshape(-1, 2, 3)
+        self.tree = shapely.STRtree(shapely.box(*self.bounds[:, :, :2].reshape(-1, 4).T))
+
+        triangles = [np.asarray(building_meshes[building_id].triangles, dtype=float).reshape(-1, 3, 3) for building_id in self.building_ids]
+        building = np.repeat(np.arange(len(triangles)), [len(t) for t in triangles])
+        triangles = np.concatenate(triangles) if triangles else np.zeros((0, 3, 3))
+
+        # pad to a power of two of leaves; padding triangles are degenerate and belong to no building, so they are never hit
+        self.leaf_size = leaf_size
+        self.depth = int(np.ceil(np.log2(max(-(-len(triangles) // leaf_size), 1))))
+        padded = leaf_size * 2**self.depth
+        triangles = np.concatenate([triangles, np.zeros((padded - len(triangles), 3, 3))])
+        building = np.concatenate([building, np.full(padded - len(building), -1)])
+
+        # split every node at the median of the centres along its longest side, one level at a time; padding sorts last
+        centres = np.where((building >= 0)[:, None], triangles.mean(axis=1), np.inf)
+        order = np.arange(padded)
+        for level in range(self.depth):
+            segments = centres[order].reshape(2**level, -1, 3)
+            real = np.isfinite(segments[:, :, :1])
+            extent = np.where(real, segments, -np.inf).max(axis=1) - np.where(real, segments, np.inf).min(axis=1)
+            axis = np.argmax(np.nan_to_num(extent, nan=0.0, neginf=0.0), axis=1)
+            key = np.take_along_axis(segments, axis[:, None, None], axis=2)[:, :, 0]
+            half = np.argpartition(key, segments.shape[1] // 2 - 1, axis=1)
+            order = np.take_along_axis(order.reshape(2**level, -1), half, axis=1).ravel()
+        triangles = triangles[order]
+        self.triangle_building = building[order]
+        # first vertex and the two edges from it of every triangle, as used by the Moller-Trumbore test
+        self.v0 = triangles[:, 0]
+        self.e1 = triangles[:, 1] - triangles[:, 0]
+        self.e2 = triangles[:, 2] - triangles[:, 0]
+
+        # boxes of the leaves, then of every level above them up to the root; a node without triangles gets a box at infinity that no ray reaches
+        real = (self.triangle_building >= 0)[:, None, None]
+        low = np.where(real, triangles, np.inf).min(axis=1).reshape(-1, leaf_size, 3).min(axis=1)
+        high = np.where(real, triangles, -np.inf).max(axis=1).reshape(-1, leaf_size, 3).max(axis=1)
+        self.levels = []
+        while True:
+            empty = np.isinf(low[:, :1])
+            self.levels.insert(0, (low, np.where(empty, np.inf, high)))
+            if len(low) == 1:
+                break
+            low, high = np.minimum(low[0::2], low[1::2]), np.maximum(high[0::2], high[1::2])
+
+    def neighbours(self, points, max_distance):
+        """indices of the buildings of which the bounding box lies within max_distance of the bounding box of the points"""
+        points = np.asarray(points, dtype=float).reshape(-1, 3)
+        reach = shapely.box(*(points[:, :2].min(axis=0) - max_distance), *(points[:, :2].max(axis=0) + max_distance))
+        return np.sort(self.tree.query(reach))
+
+    def _descend(self, origins, inverse, ray, node, level, to_level, max_distance):
+        # walk (ray, node) pairs down from level to to_level, keeping the pairs of which the ray passes through the box of the node
+        t_near = np.zeros(len(ray))
+        for level in range(level + 1, to_level + 1):
+            ray = np.repeat(ray, 2)
+            node = np.repeat(node * 2, 2) + np.tile([0, 1], len(node))
+            low, high = self.levels[level]
+            t_near, hit = _slab_hits(origins[ray], inverse[ray], low[node], high[node], max_distance)
+            ray, node, t_near = ray[hit], node[hit], t_near[hit]
+        return ray, node, t_near
+
+    def blocked(self, origins, directions, max_distance, buildings=None, chunk_size=2**20):
+        """check which rays hit a triangle within max_distance
+
+        The rays first walk down to subtrees of 16 leaves. The subtrees of every ray are then visited nearest first, in rounds of 1, 1, 2, 4, ... subtrees per ray, and rays that were blocked in a round are left out of the next ones.
+
+        Args:
+        origins (array): start point of every ray
+        directions (array): unit direction of every ray
+        max_distance (float): hits further away than this are ignored
+        buildings (array): indices of the buildings to test, defaults to all buildings
+        chunk_size (int): bounds the number of (ray, node) pairs in memory; rays are handled chunk_size // 256 at a time
+
+        Returns:
+        blocked (array): True for every ray that hits a triangle
+        """
+        origins = np.asarray(origins, dtype=float).reshape(-1, 3)
+        directions = np.asarray(directions, dtype=float).reshape(-1, 3)
+        blocked = np.zeros(len(origins), dtype=bool)
+        if len(origins) == 0 or not len(self.building_ids):
+            return blocked
+        allowed = np.ones(len(self.building_ids) + 1, dtype=bool)
+        if buildings is not None:
+            allowed[:] = False
+            allowed[np.asarray(buildings, dtype=np.int64)] = True
+        # the padding triangles have building -1, the last entry
+        allowed[-1] = False
+        triangle_allowed = allowed[self.triangle_building]
+
+        with np.errstate(divide="ignore"):
+            inverse = 1.0 / directions
+        split_level = max(self.depth - 4, 0)
+        offsets = np.arange(self.leaf_size)
+        step = max(1, chunk_size // 256)
+        for start in range(0, len(origins), step):
+            ray = np.arange(start, min(start + step, len(origins)))
+            node = np.zeros(len(ray), dtype=np.int64)
+            _, hit = _slab_hits(origins[ray], inverse[ray], *(bound[node] for bound in self.levels[0]), max_distance)
+            ray, node, t_near = self._descend(origins, inverse, ray[hit], node[hit], 0, split_level, max_distance)
+
+            # number the subtrees of every ray from near to far
+            order = np.lexsort((t_near, ray))
+            ray, node = ray[order], node[order]
+            rank = np.arange(len(ray)) - np.searchsorted(ray, ray)
+            first, count = 0, 1
+            while len(ray):
+                in_round = rank < first + count
+                r, n, _ = self._descend(origins, inverse, ray[in_round], node[in_round], split_level, self.depth, max_distance)
+                # test the rays against the triangles of the leaves they reached, leaf_size triangles per pair
+                triangle = (n[:, None] * self.leaf_size + offsets).ravel()
+                r = np.repeat(r, self.leaf_size)
+                keep = triangle_allowed[triangle]
+                r, triangle = r[keep], triangle[keep]
+                hit = _ray_triangle_hits(origins[r], directions[r], self.v0[triangle], self.e1[triangle], self.e2[triangle], max_distance)
+                blocked[r[hit]] = True
+
+                remaining = ~in_round & ~blocked[ray]
+                ray, node, rank = ray[remaining], node[remaining], rank[remaining]
+                first += count
+                count *= 2
+        return blocked
+
+def _ray_triangle_hits(origins, directions, v0, e1, e2, max_distance, epsilon=1e-9):
+    # Moller-Trumbore test of every ray against its own triangle (one row per pair), True for the pairs that hit within max_distance
+    p = np.cross(directions, e2)
+    det = np.einsum("nk,nk->n", p, e1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        inverse = 1.0 / det
+        s = origins - v0
+        u = np.einsum("nk,nk->n", s, p) * inverse
+        q = np.cross(s, e1)
+        v = np.einsum("nk,nk->n", directions, q) * inverse
+        t = np.einsum("nk,nk->n", e2, q) * inverse
+        return (np.abs(det) > epsilon) & (u >= 0.0) & (v >= 0.0) & (u + v <= 1.0) & (t > epsilon) & (t <= max_distance)
+
+@timed("exposure")
+def window_exposure(context, origins, normals, sun_vectors=None, subdivisions=2, max_distance=100.0, offset=0.05, batch_size=2**16, buildings=None):
+    """calculate the sky view factor and the sun hours of window sample points, by casting rays against the surrounding buildings
+
+    From every point, rays are cast to every sky position and sun position in front of the window, in batches of batch_size rays. A ray is blocked if it hits a building within max_distance.
+
+    The sky view factor is the cosine-weighted fraction of the hemisphere in front of the window that is open sky: 0.5 for an unobstructed vertical window. Sky positions on the horizon count for half.
+
+    Args:
+    context (RayContext or Trimesh): the surrounding buildings; build a RayContext once to reuse it for many calls
+    origins (array): 3D sample points, one row per point
+    normals (array): outward normal of the window at every point
+    sun_vectors (array): unit vectors towards the sun (see sun_positions), one per sampled hour; defaults to sun_positions()
+    subdivisions (int): subdivisions of the icosphere of sky positions (see sky_positions)
+    max_distance (float): obstructions further away than this are ignored
+    offset (float): the rays start this far in front of the window, so they do not hit the facade itself
+    batch_size (int): number of rays that are cast at a time
+    buildings (array): indices of the buildings of the context that can block the rays, defaults to all
+
+    Returns:
+    sky_view (array): sky view factor of every point
+    sun_hours (array): number of sun vectors that reach every point
+    """
+    if not isinstance(context, RayContext):
+        context = RayContext(context)
+    origins = np.asarray(origins, dtype=float).reshape(-1, 3)
+    normals = np.asarray(normals, dtype=float).reshape(-1, 3)
+    if sun_vectors is None:
+        sun_vectors = sun_positions()
+
+    sphere = tm.creation.icosphere(subdivisions=subdivisions).vertices
+    sphere = sphere / np.linalg.norm(sphere, axis=1, keepdims=True)
+    sky = sky_positions(subdivisions)
+    sky = sky / np.linalg.norm(sky, axis=1, keepdims=True)
+    horizon = sphere[np.abs(sphere[:, 2]) < 1e-9]
+    sky_weight = np.r_[np.ones(len(sky)), np.full(len(horizon), 0.5)]
+    directions = np.vstack([sky, horizon, sun_vectors])
+    sky_count = len(sky_weight)
+
+    # only the directions in front of a window are cast
+    facing = normals @ directions.T
+    point_index, direction_index = np.nonzero(facing > 0.0)
+    blocked = np.zeros(len(point_index), dtype=bool)
+    for start in range(0, len(point_index), batch_size):
+        p = point_index[start:start + batch_size]
+        d = direction_index[start:start + batch_size]
+        blocked[start:start + batch_size] = context.blocked(origins[p] + normals[p] * offset, directions[d], max_distance, buildings)
+
+    open_sky = np.zeros(facing.shape, dtype=bool)
+    open_sky[point_index, direction_index] = ~blocked
+    hemisphere = np.clip(normals @ sphere.T, 0.0, None).sum(axis=1)
+    sky_view = (np.clip(facing[:, :sky_count], 0.0, None) * sky_weight * open_sky[:, :sky_count]).sum(axis=1) / hemisphere
+    sun_hours = open_sky[:, sky_count:].sum(axis=1)
+    return sky_view, sun_hours
+
+def mesh_hash(mesh):
+    """hash the geometry of a mesh, to find out whether it changed"""
+    sha256 = hashlib.sha256()
+    sha256.update(np.ascontiguousarray(mesh.vertices, dtype=np.float64).tobytes())
+    sha256.update(np.ascontiguousarray(mesh.faces, dtype=np.int64).tobytes())
+    return sha256.hexdigest()
+
+def building_exposure(building_meshes, windows, cache=None, max_distance=100.0, **kwargs):
+    """calculate the sky view factor and sun hours of the windows of many buildings, reusing earlier results of buildings whose surroundings did not change
+
+    As obstructions further than max_distance are ignored, the result for the windows of a building only depends on the buildings within max_distance of them, and only those are tested. A result is reused if the windows and the geometry of all those buildings are the same as when it was cached, so changing one building only recomputes the buildings near it.
+
+    Args:
+    building_meshes (dict or RayContext): mesh (Trimesh) of every building by building id, or a RayContext made of them
+    windows (dict): origins and normals of the window sample points (see facade_window_points), by building id
+    cache (dict): results of an earlier call, updated in place
+    max_distance (float): obstructions further away than this are ignored
+    kwargs: passed on to window_exposure
+
+    Returns:
+    exposure (dict): sky view factor and sun hours of the sample points (see window_exposure), by building id
+    """
+    if cache is None:
+        cache = {}
+    context = building_meshes if isinstance(building_meshes, RayContext) else RayContext(building_meshes)
+
+    exposure = {}
+    for building_id, (origins, normals) in windows.items():
+        origins = np.asarray(origins, dtype=float).reshape(-1, 3)
+        normals = np.asarray(normals, dtype=float).reshape(-1, 3)
+        neighbours = context.neighbours(origins, max_distance)
+
+        key = hashlib.sha256()
+        key.update(origins.tobytes())
+        key.update(normals.tobytes())
+        key.update(repr(max_distance).encode())
+        for name, value in sorted(kwargs.items(), key=lambda item: item[0]):
+            key.update(name.encode())
+            key.update(value.tobytes() if isinstance(value, np.ndarray) else repr(value).encode())
+        for neighbour in neighbours:
+            key.update(f"{context.building_ids[neighbour]}:{context.hashes[neighbour]};".encode())
+        key = key.hexdigest()
+
+        if building_id in cache and cache[building_id][0] == key:
+            exposure[building_id] = cache[building_id][1]
+            continue
+        exposure[building_id] = window_exposure(context, origins, normals, max_distance=max_distance, buildings=neighbours, **kwargs)
+        cache[building_id] = (key, exposure[building_id])
+    return exposure
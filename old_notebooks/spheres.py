@@ -1,60 +1,67 @@
-def generate_spheres_from_image(image_path: str) -> (list, str):
-
-    # Use PIL to open and process the image
-    try:
-        image = Image.open(image_path)
-    except Exception as e:
-        return [], f"Failed to load image. Error: {e}"
+import numpy as np
+from PIL import Image
 
-    width, height = image.size
+try:
+    import Rhino.Geometry as rg
+except ImportError:
+    import rhino3dm as rg
 
-    try:
-        pixels = image.load()
-    except Exception as e:
-        return [], f"Failed to load pixels. Error: {e}"
-
-    spheres = []
 
-    # Use the double for loop to create geometries
-    for i in range(height):
-        for j in range(width):
-            if i % 2 == 0 and j % 2 == 0:
-                pixel_color = pixels[j, i]
+# pixels with a lower red value do not get a sphere
+MIN_RED_VALUE = 10
+# spheres are never smaller than this radius
+MIN_RADIUS = 0.1
+# the radius of a sphere is its red value divided by this
+RADIUS_SCALE = 150.0
 
 
-                r, g, b, _ = pixel_color
+def sphere_arrays(image_path: str, step: int = 2, min_red_value: int = MIN_RED_VALUE, min_radius: float = MIN_RADIUS) -> (np.ndarray, np.ndarray):
+    """calculate the centers and radii of the spheres for an image, for every step-th row and column
 
+    The image is read into an array once; black pixels and pixels with a red value below min_red_value are skipped, and the radii are clamped to min_radius, all as array operations.
 
-                center = rg.Point3d(i, height - 1 - j, 0)
-                radius = r / 150.0
+    Args:
+    image_path (string): location of the image
+    step (int): only every step-th row and column of pixels gets a sphere
+    min_red_value (int): pixels with a lower red value are skipped
+    min_radius (float): minimum radius of a sphere
 
-                # Explicitly check for zero or negative radius
-                if radius <= 0.0:
-                    return [], f"Invalid radius ({radius}) at center: {center}. Pixel RGB: ({r},{g},{b})"
+    Returns:
+    centers (array): x, y, z of every sphere, with x the row of the pixel and y the flipped column
+    radii (array): radius of every sphere
+    """
+    pixels = np.asarray(Image.open(image_path).convert("RGB"))
+    height = pixels.shape[0]
 
-                sphere = rg.Sphere(center, radius)
+    sampled = pixels[::step, ::step].astype(np.int32)
+    r, g, b = sampled[..., 0], sampled[..., 1], sampled[..., 2]
+    # Skip the black pixels and the pixels with red value below the threshold
+    keep = ((r > 0) | (g > 0) | (b > 0)) & (r >= min_red_value)
 
-                if not sphere.IsValid:
-                    return [], f"Sphere creation failed at center: {center}. Pixel RGB: ({r},{g},{b}), Radius: {radius}"
-                else:
-                    spheres.append(sphere.ToBrep())  # Convert to Brep for output
+    rows, columns = np.nonzero(keep)
+    centers = np.column_stack([rows * step, height - 1 - columns * step, np.zeros(len(rows))]).astype(float)
+    radii = np.maximum(r[keep] / RADIUS_SCALE, min_radius)
+    return centers, radii
 
-                # Skip the black pixels
-                if r == 0 and g == 0 and b == 0:
-                    continue  # Skip the current loop iteration
-
-
-                # Skip pixels with red value below the threshold
-                if r < MIN_RED_VALUE:
-                    continue
+def generate_spheres_from_image(image_path: str) -> (list, str):
+    """generate a Brep sphere for every sampled pixel of an image, prefer sphere_arrays when the spheres can be made in Grasshopper
 
-                center = rg.Point3d(i, height - 1 - j, 0)
-                radius = r / 150.0
+    Args:
+    image_path (string): location of the image
 
-                # If radius is still below the minimum threshold, assign a minimum radius
-                if radius < MIN_RADIUS:
-                    radius = MIN_RADIUS
+    Returns:
+    spheres (list): the spheres, as Breps
+    log (string): "Success" or the error message
+    """
+    try:
+        centers, radii = sphere_arrays(image_path)
+    except Exception as e:
+        return [], f"Failed to load image. Error: {e}"
 
-                sphere = rg.Sphere(center, radius)
+    spheres = []
+    for (x, y, z), radius in zip(centers.tolist(), radii.tolist()):
+        sphere = rg.Sphere(rg.Point3d(x, y, z), radius)
+        if not sphere.IsValid:
+            return [], f"Sphere creation failed at center: {(x, y, z)}, Radius: {radius}"
+        spheres.append(sphere.ToBrep())  # Convert to Brep for output
     return spheres, "Success"
-
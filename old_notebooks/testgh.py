@@ -2,6 +2,8 @@ from flask import Flask
 import ghhops_server as hs
 import rhino3dm
 
+from spheres import MIN_RED_VALUE, MIN_RADIUS, sphere_arrays
+
 
 # register hops app as middleware
 app = Flask(__name__)
@@ -53,70 +55,27 @@ def import_json(filepath):
         coords.append(features)
     return coords
 
-if __name__ == "__main__":
-    app.run()
-
-
-
-# @hops.component(
-#     "/Gen",
-#     name="GenerateSpheresFromImage",
-#     nickname="GSI",
-#     description="Generate spheres based on image RGB values",
-#     inputs=[
-#         hs.HopsString("ImagePath", "Image", "Path to the image file")
-#     ],
-#     outputs=[
-#         hs.HopsBrep("Spheres", "S", "List of spheres generated"),
-#         hs.HopsString("Log", "L", "Log or error message")
-#     ]
-# )
-
-
-# def generate_spheres_from_image(image_path: str) -> (list, str):
-#     try:
-#         image = Image.open(image_path)
-#     except Exception as e:
-#         return [], f"Failed to load image. Error: {e}"
-        
-#     # Use PIL to open and process the image
-#     try:
-#         image = Image.open(image_path)
-#     except Exception as e:
-#         return [], f"Failed to load image. Error: {e}"
-
-#     width, height = image.size
-
-#     try:
-#         pixels = image.load()
-#     except Exception as e:
-#         return [], f"Failed to load pixels. Error: {e}"
-
-#     spheres = []
-
-#     # Use the double for loop to create geometries
-#     for i in range(height):
-#         for j in range(width):
-#             if i % 2 == 0 and j % 2 == 0:
-#                 pixel_color = pixels[j, i]
-
-
-#                 r, g, b, _ = pixel_color
-
-
-#                 center = rg.Point3d(i, height - 1 - j, 0)
-#                 radius = r / 150.0
-
-#                 # Explicitly check for zero or negative radius
-#                 if radius <= 0.0:
-#                     return [], f"Invalid radius ({radius}) at center: {center}. Pixel RGB: ({r},{g},{b})"
+@hops.component(
+    "/spheres",
+    name="SpheresFromImage",
+    nickname="SFI",
+    description="Generate the centers and radii of spheres based on image RGB values, to make the spheres in grasshopper",
+    inputs=[
+        hs.HopsString("ImagePath", "Image", "Path to the image file"),
+        hs.HopsInteger("Step", "S", "Only every step-th row and column gets a sphere", default=2),
+        hs.HopsInteger("MinRed", "R", "Pixels with a lower red value are skipped", default=MIN_RED_VALUE),
+        hs.HopsNumber("MinRadius", "M", "Minimum radius of a sphere", default=MIN_RADIUS),
+    ],
+    outputs=[
+        hs.HopsPoint("Centers", "C", "Center of every sphere"),
+        hs.HopsNumber("Radii", "R", "Radius of every sphere"),
+    ]
+)
 
-#                 sphere = rg.Sphere(center, radius)
+def spheres_from_image(image_path, step=2, min_red_value=MIN_RED_VALUE, min_radius=MIN_RADIUS):
+    centers, radii = sphere_arrays(image_path, step, min_red_value, min_radius)
+    return [rhino3dm.Point3d(*center) for center in centers.tolist()], radii.tolist()
 
-#                 if not sphere.IsValid:
-#                     return [], f"Sphere creation failed at center: {center}. Pixel RGB: ({r},{g},{b}), Radius: {radius}"
-#                 else:
-#                     spheres.append(sphere.ToBrep())  # Convert to Brep for output
 
-#     return spheres, "Success"
-#     # Use PIL to open and process the image
+if __name__ == "__main__":
+    app.run()
@@ -0,0 +1,313 @@
+import os
+import gc
+import sys
+import json
+import time
+import shutil
+import tempfile
+import hashlib
+import argparse
+import threading
+import traceback
+import multiprocessing as mp
+
+from gis_layers import SOURCE_LAYERS, FGB_DIR, layer_cache, read_geojson_points, read_bytes
+from metrics import registry
+
+
+# serving defaults
+
+HOST = "127.0.0.1"
+PORT = 5000
+# seconds a compute task may run before it is cancelled
+COMPUTE_TIMEOUT = 120.0
+
+
+# process pool for CPU-heavy components
+
+def _run_task(sender, func, args, kwargs):
+    # runs in the compute process: send back the result, or the exception with its traceback, and the metrics the task recorded
+    # (e.g. the pipeline stages); the metrics that were copied from the server by the fork are cleared first, so only new values are sent
+    registry.clear()
+    try:
+        message = (True, func(*args, **kwargs))
+    except BaseException as e:
+        message = (False, (e, traceback.format_exc()))
+    try:
+        sender.send(message + (registry.snapshot(),))
+    except Exception:
+        # the result or the exception could not be pickled
+        sender.send((False, (RuntimeError(traceback.format_exc()), ""), registry.snapshot()))
+    finally:
+        sender.close()
+
+class ComputePool:
+    """bounded pool of processes for CPU-heavy component handlers, with a timeout per task
+
+    Every task runs in its own process, so a task that exceeds its timeout is cancelled by terminating only that process; the other tasks and the server keep running. The metrics that a task records are added to the metrics of the server when it finishes. Where available the processes are forked, so they share the preloaded datasets of the server copy-on-write; elsewhere (Windows) they are spawned and import the handler's module again. At most max_workers tasks run at once, other requests wait for a free worker within their timeout.
+
+    Args:
+    max_workers (int): number of tasks that run at the same time, defaults to the number of cores
+    timeout (float): default time in seconds before a task is cancelled, None waits forever
+    start_method (string): multiprocessing start method, defaults to "fork" where available and "spawn" elsewhere
+    """
+    def __init__(self, max_workers=None, timeout=COMPUTE_TIMEOUT, start_method=None):
+        self.configure(max_workers, timeout, start_method)
+
+    def configure(self, max_workers=None, timeout=COMPUTE_TIMEOUT, start_method=None):
+        """change the number of workers, the default timeout or the start method; only while no tasks are running"""
+        if start_method is None:
+            start_method = "fork" if "fork" in mp.get_all_start_methods() else "spawn"
+        self.max_workers = max_workers or os.cpu_count()
+        self.timeout = timeout
+        self._context = mp.get_context(start_method)
+        self._slots = threading.BoundedSemaphore(self.max_workers)
+        self._running = set()
+        self._lock = threading.Lock()
+
+    def run(self, func, *args, timeout=None, **kwargs):
+        """run a function in a compute process and wait for its result
+
+        Args:
+        func (callable): module-level function, so it can be found again in a spawned process
+        *args: arguments of the function
+        timeout (float): time in seconds for waiting for a worker and running the task, defaults to the timeout of the pool
+        **kwargs: keyword arguments of the function
+
+        Returns:
+        result: the return value of the function
+
+        Raises:
+        TimeoutError: if no worker became free or the task did not finish in time; the task is then terminated
+        RuntimeError: if the compute process exited without a result, e.g. because it ran out of memory
+        """
+        timeout = self.timeout if timeout is None else timeout
+        deadline = None if timeout is None else time.monotonic() + timeout
+        if not self._slots.acquire(timeout=timeout):
+            raise TimeoutError(f"no compute worker became free within {timeout} seconds")
+        receiver = None
+        process = None
+        try:
+            receiver, sender = self._context.Pipe(duplex=False)
+            task = self._context.Process(target=_run_task, args=(sender, func, args, kwargs), daemon=True)
+            task.start()
+            process = task
+            sender.close()
+            with self._lock:
+                self._running.add(process)
+
+            remaining = None if deadline is None else max(deadline - time.monotonic(), 0.0)
+            if not receiver.poll(remaining):
+                raise TimeoutError(f"{getattr(func, '__name__', func)} did not finish within {timeout} seconds and was cancelled")
+            try:
+                ok, value, task_metrics = receiver.recv()
+            except EOFError:
+                process.join()
+                raise RuntimeError(f"compute process of {getattr(func, '__name__', func)} exited with code {process.exitcode}") from None
+            registry.merge(task_metrics)
+            if ok:
+                return value
+            error, remote_traceback = value
+            if remote_traceback:
+                raise error from RuntimeError(f"in the compute process:\n{remote_traceback}")
+            raise error
+        finally:
+            if process is not None:
+                with self._lock:
+                    self._running.discard(process)
+                if process.is_alive():
+                    process.terminate()
+                process.join()
+                process.close()
+            if receiver is not None:
+                receiver.close()
+            self._slots.release()
+
+    def cancel_all(self):
+        """terminate all running tasks, their callers get a RuntimeError"""
+        with self._lock:
+            running = list(self._running)
+        for process in running:
+            process.terminate()
+
+
+compute_pool = ComputePool()
+
+
+# coalescing identical solves
+
+HOPS_COALESCED = registry.counter("hops_coalesced_total", "solve requests that were answered by an identical solve that was already running", ["component"])
+
+class _Flight:
+    # one solve that is running, and the requests that wait for it
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+def solve_key(uri, payload):
+    """identify a solve by its component and input values, ignoring the other fields of the request (e.g. tolerances, cache flags)"""
+    try:
+        values = json.dumps(json.loads(payload)["values"], sort_keys=True).encode("utf-8")
+    except (ValueError, KeyError, TypeError):
+        values = payload if isinstance(payload, bytes) else str(payload).encode("utf-8")
+    return uri, hashlib.sha256(values).hexdigest()
+
+def coalesce_solves(hops):
+    """merge concurrent identical solves of a Hops app into one computation
+
+    The first request for a component and set of input values runs the solve; requests with the same inputs that arrive while it runs wait for it and get the same response. Nothing is cached after the solve has finished, so a later request always sees the current data. Only requests that are handled by the same process can be merged, so serve with threads (see serve).
+
+    Args:
+    hops (HopsBase): the Hops middleware, as returned by ghhops_server.Hops(app)
+
+    Returns:
+    hops (HopsBase): the same instance
+    """
+    process_solve_request = hops._process_solve_request
+    flights = {}
+    lock = threading.Lock()
+
+    def coalesced_solve_request(comp, payload):
+        key = solve_key(comp.uri, payload)
+        with lock:
+            flight = flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = flights[key] = _Flight()
+        if not leader:
+            HOPS_COALESCED.inc(component=comp.uri)
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = process_solve_request(comp, payload)
+            return flight.result
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with lock:
+                del flights[key]
+            flight.done.set()
+
+    hops._process_solve_request = coalesced_solve_request
+    return hops
+
+
+# datasets that are loaded once, before the server forks
+
+def default_datasets():
+    """list the datasets of the Hops components that exist on disk, with the loader that layer_cache uses for them
+
+    Returns:
+    datasets (list): (path, loader) tuples
+    """
+    from facade_analysis import BATCH_RESULTS_PATH, read_batch_results
+    from facade_annotations import TRAIN_JSON, VAL_JSON, annotation_floors
+
+    datasets = [(path, read_geojson_points) for path in SOURCE_LAYERS if path.endswith(".geojson")]
+    if os.path.isdir(FGB_DIR):
+        datasets += [(os.path.join(FGB_DIR, name), read_bytes) for name in sorted(os.listdir(FGB_DIR)) if name.endswith(".fgb")]
+    datasets += [(TRAIN_JSON, annotation_floors), (VAL_JSON, annotation_floors), (BATCH_RESULTS_PATH, read_batch_results)]
+    return [(path, loader) for path, loader in datasets if os.path.exists(path)]
+
+def preload_datasets(datasets):
+    """load read-only datasets into layer_cache, so every request (and every forked worker) finds them there
+
+    The objects are moved to the permanent generation of the garbage collector afterwards, so collections in the forked workers do not touch (and copy) their memory pages.
+
+    Args:
+    datasets (list): (path, loader) tuples, see default_datasets
+
+    Returns:
+    loaded (list): paths of the datasets that were loaded
+    """
+    loaded = []
+    for path, loader in datasets:
+        layer_cache.get(path, loader)
+        loaded.append(path)
+    gc.collect()
+    if hasattr(gc, "freeze"):
+        gc.freeze()
+    return loaded
+
+
+# launcher
+
+def serve(app, host=HOST, port=PORT, workers=4, threads=4, timeout=COMPUTE_TIMEOUT, metrics_dir=None):
+    """serve a Flask app with several worker processes, or with threads where gunicorn is not available
+
+    gunicorn forks its workers from this process, after the datasets have been preloaded. The workers share their metrics through metrics_dir (see metrics.MetricsRegistry.share), so /metrics shows the sum of all workers whichever worker answers. Without gunicorn (e.g. on Windows) the Werkzeug server handles requests on threads in this single process.
+
+    Args:
+    app (Flask): the app, e.g. simplehops.app
+    host (string): address to listen on
+    port (int): port to listen on
+    workers (int): number of worker processes
+    threads (int): number of threads per worker process, so identical solves can be coalesced and slow solves do not block the worker
+    timeout (float): compute timeout, workers that stop responding for longer than this are restarted; None or 0 never restarts them
+    metrics_dir (string): empty folder for the metrics of the workers, defaults to a temporary folder that is removed afterwards
+    """
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        from werkzeug.serving import run_simple
+        print("gunicorn is not available, serving on threads in a single process", file=sys.stderr)
+        run_simple(host, port, app, threaded=True)
+        return
+
+    temporary_dir = metrics_dir is None
+    if temporary_dir:
+        metrics_dir = tempfile.mkdtemp(prefix="hops_metrics_")
+
+    def post_fork(server, worker):
+        registry.share(metrics_dir)
+
+    class HopsApplication(BaseApplication):
+        def load_config(self):
+            self.cfg.set("bind", f"{host}:{port}")
+            self.cfg.set("workers", workers)
+            self.cfg.set("threads", threads)
+            self.cfg.set("preload_app", True)
+            # gunicorn takes 0 as no timeout; otherwise leave a margin for the compute timeout
+            self.cfg.set("timeout", int(timeout) + 30 if timeout else 0)
+            self.cfg.set("post_fork", post_fork)
+
+        def load(self):
+            return app
+
+    try:
+        HopsApplication().run()
+    finally:
+        if temporary_dir:
+            shutil.rmtree(metrics_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="serve the Hops components with preloaded datasets and a compute process pool")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--workers", type=int, default=4, help="number of server processes")
+    parser.add_argument("--threads", type=int, default=4, help="threads per server process")
+    parser.add_argument("--compute-workers", type=int, default=None, help="compute processes per server process, defaults to the number of cores")
+    parser.add_argument("--timeout", type=float, default=COMPUTE_TIMEOUT, help="seconds before a compute task is cancelled, 0 waits forever")
+    parser.add_argument("--cache-mb", type=int, default=1024, help="memory cap of the cached datasets, as estimated from their parsed objects")
+    parser.add_argument("--no-preload", action="store_true", help="load the datasets on the first request instead")
+    parser.add_argument("--metrics-dir", default=None, help="empty folder in which the workers share their metrics, defaults to a temporary folder")
+    args = parser.parse_args()
+
+    layer_cache.max_bytes = args.cache_mb * 2**20
+    # this file runs as __main__, so simplehops imports serving as a second module; configure the pool that its handlers use
+    import serving
+    from simplehops import app, compute_pool as handler_pool
+    if handler_pool is not serving.compute_pool:
+        raise RuntimeError("the Hops handlers do not use the compute pool of the serving module")
+    handler_pool.configure(args.compute_workers, args.timeout or None)
+    print(f"compute pool: {handler_pool.max_workers} workers, timeout {handler_pool.timeout}", file=sys.stderr)
+    if not args.no_preload:
+        for path in preload_datasets(default_datasets()):
+            print(f"preloaded {path}", file=sys.stderr)
+    serve(app, args.host, args.port, args.workers, args.threads, args.timeout, args.metrics_dir)
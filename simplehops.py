@@ -1,12 +1,26 @@
-from flask import Flask
+from flask import Flask, Response
 import ghhops_server as hs
 import rhino3dm
 import json
 import flatgeobuf as fgb
 
+from gis_layers import layer_cache, read_geojson_points, read_bytes, filter_points, group_points, feature_point, corners_to_bbox, query_fgb
+from metrics import registry, instrument_hops, CONTENT_TYPE
+from serving import compute_pool, coalesce_solves
+from facade_analysis import BATCH_RESULTS_PATH, ENGINES, process_mask, read_batch_results
+from facade_annotations import TRAIN_JSON, VAL_JSON, annotation_floors
+from facade_store import RESULTS_DB_PATH, building_floors
+
 # register hops app as middleware
 app = Flask(__name__)
-hops = hs.Hops(app)
+# concurrent identical solves are computed once; the metrics still count every request
+hops = instrument_hops(coalesce_solves(hs.Hops(app)))
+
+
+@app.route("/metrics")
+def metrics():
+    # call counts, latency histograms and payload sizes of the components and pipeline stages, for Prometheus
+    return Response(registry.render(), content_type=CONTENT_TYPE)
 
 @hops.component(
     "/pointat",
@@ -26,6 +40,36 @@ def pointat(curve, t):
     return curve.PointAt(t)
 
 
+def _match_branch(tree, path):
+    # the branch with the same path, or the only branch of a tree with a single branch
+    if path in tree:
+        return tree[path]
+    if len(tree) == 1:
+        return next(iter(tree.values()))
+    raise ValueError(f"no branch {path} in a tree with {len(tree)} branches")
+
+@hops.component(
+    "/pointsat",
+    name="PointsAt",
+    description="Get points along curves, for a whole tree of parameters in one request",
+    inputs=[
+        hs.HopsCurve("Curve", "C", "Curves to evaluate: one per branch, or one per parameter", access=hs.HopsParamAccess.TREE),
+        hs.HopsNumber("t", "t", "Parameters on the curves to evaluate", access=hs.HopsParamAccess.TREE),
+    ],
+    outputs=[
+        hs.HopsPoint("P", "P", "Points on the curves at t, in the tree structure of t", access=hs.HopsParamAccess.TREE)
+    ]
+)
+
+def pointsat(curves, t):
+    points = {}
+    for path, parameters in t.items():
+        branch_curves = _match_branch(curves, path)
+        # like Grasshopper's longest list, the last curve is used for the remaining parameters
+        points[path] = [branch_curves[min(i, len(branch_curves) - 1)].PointAt(parameter) for i, parameter in enumerate(parameters)]
+    return points
+
+
 "-----------------------------------------------------------"
 
 @hops.component(
@@ -35,73 +79,167 @@ def pointat(curve, t):
         description="import GIS point based information from a JSON file to grasshopper",
         inputs=[
             hs.HopsString("Filepath", "JSON", "Path to JSON file"),
+            hs.HopsString("Attribute", "A", "Only import features with this attribute (optional)", optional=True),
+            hs.HopsString("Value", "V", "Value of the attribute to filter on (optional)", optional=True),
         ],
         outputs=[
             hs.HopsPoint("P", "P", "point list from GIS")
         ]
 )
 
-def geojsonfile(filepath):
-    with open(filepath) as json_file:
-        data = json.load(json_file)
-        # retrieve the valuable data out of dictionary
-        # tiles = (data["features"][0]["geometry"]["coordinates"])
-    #     tiles = (data["features"])
-
-    # coords = []
-
-    # # for n in range(20):
-    # for n in range(len(tiles)):
-    #     features = (data["features"][n]["geometry"]["coordinates"])
-    #     coords.append(features)
-    return(data)
-
-
-# def geojsonfile(filepath): 
-    # coords = []
-    # # load input coordinates from a geojson file
-    # with open(filepath) as json_file:
-    #     # with open("data/tile_index.fgb", "rb") as f:
-    #     reader = fgb.Reader(json_file)
-    #     # for index, item in enumerate(items):
-    #     # print(index, item)
-    #     for index, feature in enumerate(reader):
-    #     # print(feature)
-    #         coords.append(feature["features"][index]["geometry"]["coordinates"])
-    #         # clean_tiles_dict.append(feature["properties"]["tile_id"])
-    
-    
-    #     # data = json.load(json_file)
-    #     # retrieve the valuable data out of dictionary
-    #     # tiles = (data["features"][0]["geometry"]["coordinates"])
-    #     # tiles = (data["features"])
-
-
-    # # for n in range(len(tiles)):
-    # #     features = (data["features"][n]["geometry"]["coordinates"])
-
-    #     # json.dumps(features)
-    
-    # # coords = json.dumps(coords)
-    
-    # return coords
-
-
-
-# @hops.component(
-#     "importOSM", 
-#     name="importOSM", 
-#     nickname="OSM",
-#     description="import OSM information based on a bounding box",
-#     inputs=[
-#         hs.HopsPoint("corner1", "p1", 'first corner bounding box')
-#         hs.HopsPoint("corner2", "p2", 'first corner bounding box')
-#         hs.HopsPoint("corner3", "p3", 'first corner bounding box')
-#         hs.HopsPoint("corner4", "p4", 'first corner bounding box')
-#     ]
-# )
+def geojsonfile(filepath, attribute="", value=""):
+    # the parsed file is cached until it changes on disk, so repeated solves skip json.load
+    layer = layer_cache.get(filepath, read_geojson_points)
+    points = filter_points(layer, attribute, value)
+    return [rhino3dm.Point3d(*point) for point in points]
+
+
+@hops.component(
+        "/geojsonpoints",
+        name="importjsonvalues",
+        nickname="jsonvalues",
+        description="import the GIS points of many attribute values from a JSON file at once, one branch per value",
+        inputs=[
+            hs.HopsString("Filepath", "JSON", "Path to JSON file"),
+            hs.HopsString("Attribute", "A", "attribute to filter on"),
+            hs.HopsString("Values", "V", "values of the attribute, one branch of points per value", access=hs.HopsParamAccess.LIST),
+        ],
+        outputs=[
+            hs.HopsPoint("P", "P", "point tree from GIS, branch i holds the features with value i", access=hs.HopsParamAccess.TREE)
+        ]
+)
+
+def geojsonpoints(filepath, attribute, values):
+    # one pass over the cached features for all values
+    groups = group_points(layer_cache.get(filepath, read_geojson_points), attribute, values)
+    return {f"{{{i}}}": [rhino3dm.Point3d(*point) for point in points] for i, points in enumerate(groups)}
+
+
+@hops.component(
+        "/fgbbbox",
+        name="importfgb",
+        nickname="fgb",
+        description="import the GIS features within a bounding box from an indexed FlatGeobuf file to grasshopper",
+        inputs=[
+            hs.HopsString("Filepath", "FGB", "Path to FlatGeobuf file"),
+            hs.HopsPoint("Corners", "C", "corner points of the bounding box, e.g. four rectangle corners or the corners of a box", access=hs.HopsParamAccess.LIST),
+        ],
+        outputs=[
+            hs.HopsPoint("P", "P", "one point per feature within the bounding box"),
+            hs.HopsString("Properties", "A", "attributes of every feature, as JSON"),
+        ]
+)
+
+def fgbbbox(filepath, corners):
+    # the file is kept in memory (and preloaded by serving.py); only the features in the bounding box are decoded, via its spatial index
+    features = query_fgb(layer_cache.get(filepath, read_bytes), corners_to_bbox(corners))
+    points = [rhino3dm.Point3d(*feature_point(feature["geometry"])) for feature in features]
+    properties = [json.dumps(feature["properties"]) for feature in features]
+    return points, properties
+
+
+# facade floors and WWR
+
+# default files of every source and the loader that indexes them by building; the floors of all files are joined, like run_annotations does
+FLOOR_SOURCES = {"batch": ((BATCH_RESULTS_PATH,), read_batch_results), "annotations": ((TRAIN_JSON, VAL_JSON), annotation_floors)}
+
+def _floors_by_building(IDs, source, filepath):
+    # the floors of every building in IDs, read in one go from the chosen source
+    if source == "store":
+        # lookups in the primary key of the SQLite store, nothing else is read
+        grouped = {}
+        for floor in building_floors(IDs, filepath or RESULTS_DB_PATH).to_dict("records"):
+            grouped.setdefault(floor["identificatie"], []).append(floor)
+        indexes = [grouped]
+    elif source in FLOOR_SOURCES:
+        default_paths, loader = FLOOR_SOURCES[source]
+        # the floors of every file are indexed once and cached (and preloaded by serving.py)
+        indexes = [layer_cache.get(path, loader) for path in ([filepath] if filepath else default_paths)]
+    else:
+        raise ValueError(f"unknown source {source!r}, choose one of {list(FLOOR_SOURCES) + ['store']}")
+    return [[floor for grouped in indexes for floor in grouped.get(str(ID), [])] for ID in IDs]
+
+def _floor_outputs(floors):
+    return ([floor["floor_level"] for floor in floors], [floor["roof_level"] for floor in floors],
+        [floor["WWR"] for floor in floors], [floor["file_name"] for floor in floors])
+
+
+@hops.component(
+        "/facadewwr",
+        name="facadeWWR",
+        nickname="wwr",
+        description="look up the floors and window-to-wall ratios of a building in the processed facade dataset",
+        inputs=[
+            hs.HopsString("Identificatie", "ID", "BAG identificatie of the building"),
+            hs.HopsString("Source", "S", "batch (results of facade_analysis.run_batch), store (facade_store results) or annotations (train.json and val.json of the dataset, or the COCO file in Filepath)", optional=True),
+            hs.HopsString("Filepath", "F", "results or COCO file, defaults to the file of the source (optional)", optional=True),
+        ],
+        outputs=[
+            hs.HopsNumber("FloorLevel", "F", "pixel row of the floor of every floor"),
+            hs.HopsNumber("RoofLevel", "R", "pixel row of the roof of every floor"),
+            hs.HopsNumber("WWR", "W", "window-to-wall ratio of every floor"),
+            hs.HopsString("FileName", "N", "facade image of every floor"),
+        ]
+)
+
+def facadewwr(identificatie, source="batch", filepath=""):
+    return _floor_outputs(_floors_by_building([identificatie], source, filepath)[0])
+
+
+@hops.component(
+        "/facadewwrs",
+        name="facadeWWRs",
+        nickname="wwrs",
+        description="look up the floors and window-to-wall ratios of many buildings at once, one branch per building",
+        inputs=[
+            hs.HopsString("Identificatie", "ID", "BAG identificatie of every building", access=hs.HopsParamAccess.LIST),
+            hs.HopsString("Source", "S", "batch (results of facade_analysis.run_batch), store (facade_store results) or annotations (train.json and val.json of the dataset, or the COCO file in Filepath)", optional=True),
+            hs.HopsString("Filepath", "F", "results or COCO file, defaults to the file of the source (optional)", optional=True),
+        ],
+        outputs=[
+            hs.HopsNumber("FloorLevel", "F", "pixel row of the floor of every floor, one branch per building", access=hs.HopsParamAccess.TREE),
+            hs.HopsNumber("RoofLevel", "R", "pixel row of the roof of every floor, one branch per building", access=hs.HopsParamAccess.TREE),
+            hs.HopsNumber("WWR", "W", "window-to-wall ratio of every floor, one branch per building", access=hs.HopsParamAccess.TREE),
+            hs.HopsString("FileName", "N", "facade image of every floor, one branch per building", access=hs.HopsParamAccess.TREE),
+        ]
+)
+
+def facadewwrs(identificatie, source="batch", filepath=""):
+    outputs = ({}, {}, {}, {})
+    for i, floors in enumerate(_floors_by_building(identificatie, source, filepath)):
+        for tree, values in zip(outputs, _floor_outputs(floors)):
+            tree[f"{{{i}}}"] = values
+    return outputs
+
+
+@hops.component(
+        "/maskfloors",
+        name="maskFloors",
+        nickname="floors",
+        description="detect the floors and window-to-wall ratios in a facade mask, in a separate compute process",
+        inputs=[
+            hs.HopsString("Filepath", "M", "path to the facade mask"),
+            hs.HopsString("Engine", "E", "floor detection engine, contours or projection", optional=True),
+        ],
+        outputs=[
+            hs.HopsNumber("FloorLevel", "F", "pixel row of the floor of every floor"),
+            hs.HopsNumber("RoofLevel", "R", "pixel row of the roof of every floor"),
+            hs.HopsNumber("WWR", "W", "window-to-wall ratio of every floor"),
+        ]
+)
+
+def maskfloors(filepath, engine="contours"):
+    if engine not in ENGINES:
+        raise ValueError(f"unknown engine {engine!r}, choose one of {ENGINES}")
+    # CPU-heavy, so it runs on the compute pool and is cancelled when it exceeds the timeout
+    record = compute_pool.run(process_mask, filepath, None, engine)
+    if "error" in record:
+        raise ValueError(record["error"])
+    floors = record["floors"]
+    return [floor["floor_level"] for floor in floors], [floor["roof_level"] for floor in floors], [floor["WWR"] for floor in floors]
 
 
 if __name__ == "__main__":
+    # development server, see serving.py for serving several Grasshopper clients at once
     app.run()
 